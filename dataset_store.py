@@ -0,0 +1,548 @@
+import json
+import os
+import hashlib
+import shutil
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, List, Optional
+
+import numpy as np
+
+STORE_VERSION = 1
+STORE_DIRNAME = "full_data.store"
+META_FILENAME = "meta.json"
+
+# 列定义：列名 -> (所属表, dtype, 每行的尾部形状)
+# 每一列都是一个裸二进制文件 <列名>.bin，行数记录在 meta.json 中，打开时用 np.memmap 映射
+COLUMNS = {
+    # 图片表
+    "picture_image_path": ("picture", "int32", ()),
+    "picture_file_name": ("picture", "int32", ()),
+    "picture_person_start": ("picture", "int64", ()),
+    "picture_person_count": ("picture", "int32", ()),
+    "picture_object_start": ("picture", "int64", ()),
+    "picture_object_count": ("picture", "int32", ()),
+    "picture_blob_start": ("picture", "int64", ()),
+    "picture_blob_length": ("picture", "int64", ()),
+    # 人物表（只包含未删除的人物）
+    "person_picture": ("person", "int32", ()),
+    "person_raw_index": ("person", "int32", ()),
+    "person_face_box": ("person", "float64", (4,)),
+    "person_body_box": ("person", "float64", (4,)),
+    "person_skeleton": ("person", "int32", ()),
+    "person_has_facex": ("person", "uint8", ()),
+    "person_face_attr": ("person", "float64", None),  # 尾部形状由属性名个数决定
+    "person_headpose": ("person", "float64", (3,)),
+    "person_face_seen": ("person", "int8", ()),
+    "person_background": ("person", "int8", ()),
+    "person_hoi_start": ("person", "int64", ()),
+    "person_hoi_count": ("person", "int32", ()),
+    # 物体表（包含已删除的物体，以保持原始下标）
+    "object_deleted": ("object", "uint8", ()),
+    "object_box": ("object", "float64", (4,)),
+    "object_name": ("object", "int32", ()),
+    "object_possible_name_start": ("object", "int64", ()),
+    "object_possible_name_count": ("object", "int32", ()),
+    "object_possible_name": ("object_possible_name", "int32", ()),
+    # 人-物交互表
+    "hoi_object": ("hoi", "int32", ()),
+    "hoi_raw_index": ("hoi", "int32", ()),
+    "hoi_action_start": ("hoi", "int64", ()),
+    "hoi_action_count": ("hoi", "int32", ()),
+    # 每行是 (部位字符串id, 动作字符串id)，部位未经 POSITION_SIMPLIFIER 化简
+    "hoi_action": ("hoi_action", "int32", (2,)),
+    # 每张图片的原始json（紧凑编码），用于按需解码未列化的字段
+    "blob": ("blob", "uint8", ()),
+}
+TABLES = ["picture", "person", "object", "object_possible_name", "hoi", "hoi_action", "blob"]
+# 存放字符串id的列，合并数据块时需要重映射到全局字符串表
+STRING_COLUMNS = {"picture_image_path", "picture_file_name", "object_name", "object_possible_name", "hoi_action"}
+# 存放其它表行号的列，合并数据块时需要加上该表已有的行数
+OFFSET_COLUMNS = {
+    "picture_person_start": "person",
+    "picture_object_start": "object",
+    "picture_blob_start": "blob",
+    "person_picture": "picture",
+    "person_hoi_start": "hoi",
+    "object_possible_name_start": "object_possible_name",
+    "hoi_action_start": "hoi_action",
+}
+
+# 以int8存储的qwen_detailing布尔字段：-1表示缺失
+DETAILING_FLAGS = {"face_seen": "person_face_seen", "background": "person_background"}
+HEADPOSE_KEYS = ["pitch", "yaw", "roll"]
+
+_NAN_BOX = [np.nan] * 4
+
+
+def _column_path(path, name):
+    return os.path.join(path, name + ".bin")
+
+
+def _tail_shape(name, face_attr_names):
+    tail = COLUMNS[name][2]
+    if tail is None:
+        return (len(face_attr_names),)
+    return tail
+
+
+def _detailing_flag(detailing, key):
+    if not isinstance(detailing, dict) or key not in detailing:
+        return -1
+    return 1 if detailing[key] else 0
+
+
+class DatasetChunk:
+    """一批图片的列数据，带有自己的局部字符串表，行号从0开始
+
+    写入器和并行解析的工作进程都用它来构建列数据，合并到数据集时再重映射字符串id和行偏移。
+    """
+
+    def __init__(self, face_attr_names: List[str]):
+        self.face_attr_names = list(face_attr_names)
+        self.strings: List[str] = []
+        self._string_ids: Dict[str, int] = {}
+        self.rows = {table: 0 for table in TABLES}
+        self._buffers = {name: [] for name in COLUMNS}
+
+    def intern(self, s: str) -> int:
+        sid = self._string_ids.get(s)
+        if sid is None:
+            sid = len(self.strings)
+            self.strings.append(s)
+            self._string_ids[s] = sid
+        return sid
+
+    def _push(self, name, value):
+        self._buffers[name].append(value)
+
+    def add_picture(self, data: dict, file_name: str = "") -> int:
+        """追加一张图片的原始json数据，返回其在本块中的下标；数据不合法时回滚并抛出异常"""
+        buffer_lengths = {name: len(buffer) for name, buffer in self._buffers.items()}
+        rows = dict(self.rows)
+        string_count = len(self.strings)
+        try:
+            return self._add_picture(data, file_name)
+        except Exception:
+            for name, length in buffer_lengths.items():
+                del self._buffers[name][length:]
+            self.rows = rows
+            for s in self.strings[string_count:]:
+                del self._string_ids[s]
+            del self.strings[string_count:]
+            raise
+
+    def _add_picture(self, data, file_name):
+        picture_index = self.rows["picture"]
+        detect_results = data.get("detect_results", {})
+        blob = json.dumps(data, separators=(",", ":"), ensure_ascii=False).encode("utf-8")
+
+        objects = data.get("objects", [])
+        self._push("picture_image_path", self.intern(data.get("image_path", "")))
+        self._push("picture_file_name", self.intern(file_name))
+        self._push("picture_object_start", self.rows["object"])
+        self._push("picture_object_count", len(objects))
+        self._push("picture_blob_start", self.rows["blob"])
+        self._push("picture_blob_length", len(blob))
+        self._push("blob", blob)
+        self.rows["blob"] += len(blob)
+
+        for obj in objects:
+            possible_names = obj.get("possible_names", [])
+            box = obj.get("box", None)
+            self._push("object_deleted", 1 if obj.get("deleted") is True else 0)
+            self._push("object_box", _NAN_BOX if box is None else list(box)[:4])
+            self._push("object_name", self.intern(obj.get("name", "")))
+            self._push("object_possible_name_start", self.rows["object_possible_name"])
+            self._push("object_possible_name_count", len(possible_names))
+            for name in possible_names:
+                self._push("object_possible_name", self.intern(name))
+            self.rows["object_possible_name"] += len(possible_names)
+            self.rows["object"] += 1
+
+        persons = [(i, p) for i, p in enumerate(data.get("persons", [])) if p.get("deleted") is not True]
+        self._push("picture_person_start", self.rows["person"])
+        self._push("picture_person_count", len(persons))
+        for raw_index, person in persons:
+            self._add_person(picture_index, raw_index, person, objects, detect_results)
+
+        self.rows["picture"] += 1
+        return picture_index
+
+    def _add_person(self, picture_index, raw_index, person, objects, detect_results):
+        if person.get("without_face") is not True and person.get("face_box") is not None:
+            face_box = list(detect_results["face_boxes"][person["face_box"]])[:4]
+        else:
+            face_box = _NAN_BOX
+        if person.get("body_box") is not None:
+            body_box = list(detect_results["body_boxes"][person["body_box"]])[:4]
+        else:
+            body_box = _NAN_BOX
+
+        facex = person.get("facex_detailing")
+        if facex:
+            attrs = facex.get("attributes", {})
+            face_attr = [attrs.get(name, 0) for name in self.face_attr_names]
+            headpose = facex.get("headpose", {})
+            headpose = [headpose.get(key, np.nan) for key in HEADPOSE_KEYS]
+        else:
+            face_attr = [np.nan] * len(self.face_attr_names)
+            headpose = [np.nan] * len(HEADPOSE_KEYS)
+
+        detailing = person.get("qwen_detailing", {})
+        self._push("person_picture", picture_index)
+        self._push("person_raw_index", raw_index)
+        self._push("person_face_box", face_box)
+        self._push("person_body_box", body_box)
+        self._push("person_skeleton", -1 if person.get("skeleton") is None else person["skeleton"])
+        self._push("person_has_facex", 1 if facex else 0)
+        self._push("person_face_attr", face_attr)
+        self._push("person_headpose", headpose)
+        for key, column in DETAILING_FLAGS.items():
+            self._push(column, _detailing_flag(detailing, key))
+
+        # 与 Person.init_hoi_objects 的筛选规则保持一致
+        hoi_count = 0
+        self._push("person_hoi_start", self.rows["hoi"])
+        for hoi_index, hoi in enumerate(person.get("hoi", [])):
+            actions = hoi["relationship"].get("action", [])
+            if "no interaction" in [i[1] for i in actions]:
+                continue
+            obj_index = hoi.get("object")
+            if hoi.get("deleted") is True or objects[obj_index].get("deleted") is True:
+                continue
+            self._push("hoi_object", obj_index)
+            self._push("hoi_raw_index", hoi_index)
+            self._push("hoi_action_start", self.rows["hoi_action"])
+            self._push("hoi_action_count", len(actions))
+            for action in actions:
+                self._push("hoi_action", [self.intern(action[0]), self.intern(action[1])])
+            self.rows["hoi_action"] += len(actions)
+            self.rows["hoi"] += 1
+            hoi_count += 1
+        self._push("person_hoi_count", hoi_count)
+        self.rows["person"] += 1
+
+    def to_arrays(self) -> Dict[str, np.ndarray]:
+        """把缓冲区转换成numpy数组，便于跨进程传输"""
+        arrays = {}
+        for name, buffer in self._buffers.items():
+            if name == "blob":
+                arrays[name] = np.frombuffer(b"".join(buffer), dtype=np.uint8)
+            else:
+                tail = _tail_shape(name, self.face_attr_names)
+                arrays[name] = np.asarray(buffer, dtype=COLUMNS[name][1]).reshape((-1,) + tail)
+        return arrays
+
+
+class DatasetStoreWriter:
+    """列式数据集写入器，按块追加写入各列文件，最后写入meta.json"""
+
+    def __init__(self, path: str, face_attr_names: List[str], append: bool = False):
+        self.path = path
+        self.face_attr_names = list(face_attr_names)
+        self.strings: List[str] = []
+        self._string_ids: Dict[str, int] = {}
+        self.rows = {table: 0 for table in TABLES}
+        self.extra_meta = {}
+        self._chunk = DatasetChunk(self.face_attr_names)
+
+        if append:
+            with open(os.path.join(path, META_FILENAME), "r") as f:
+                meta = json.load(f)
+            if meta.get("version") != STORE_VERSION or meta.get("face_attr_names") != self.face_attr_names:
+                raise ValueError(f"Incompatible dataset store at {path}")
+            self.strings = meta["strings"]
+            self._string_ids = {s: i for i, s in enumerate(self.strings)}
+            self.rows.update(meta["rows"])
+            self.extra_meta = meta.get("extra", {})
+            # 截掉上次异常中断时可能残留在文件末尾的半块数据
+            for name in COLUMNS:
+                row_size = np.dtype(COLUMNS[name][1]).itemsize * int(np.prod(_tail_shape(name, self.face_attr_names)))
+                with open(_column_path(path, name), "r+b") as f:
+                    f.truncate(self.rows[COLUMNS[name][0]] * row_size)
+        else:
+            if os.path.exists(path):
+                shutil.rmtree(path)
+            os.makedirs(path)
+            for name in COLUMNS:
+                open(_column_path(path, name), "wb").close()
+
+    def intern(self, s: str) -> int:
+        sid = self._string_ids.get(s)
+        if sid is None:
+            sid = len(self.strings)
+            self.strings.append(s)
+            self._string_ids[s] = sid
+        return sid
+
+    def add_picture(self, data: dict, file_name: str = "") -> int:
+        """追加一张图片的原始json数据，返回其图片下标"""
+        return self.rows["picture"] + self._chunk.add_picture(data, file_name)
+
+    def add_chunk(self, chunk_arrays: Dict[str, np.ndarray], strings: List[str], rows: Dict[str, int]):
+        """把一块列数据追加写入各列文件：字符串id映射到全局字符串表，行偏移加上已有行数"""
+        remap = np.array([self.intern(s) for s in strings], dtype=np.int32)
+        for name, array in chunk_arrays.items():
+            if len(array) == 0:
+                continue
+            if name in STRING_COLUMNS:
+                array = remap[array]
+            elif name in OFFSET_COLUMNS:
+                array = array + self.rows[OFFSET_COLUMNS[name]]
+            with open(_column_path(self.path, name), "ab") as f:
+                np.ascontiguousarray(array, dtype=COLUMNS[name][1]).tofile(f)
+        for table in TABLES:
+            self.rows[table] += rows[table]
+
+    def flush(self):
+        """把缓冲中的图片写入各列文件"""
+        if self._chunk.rows["picture"] == 0:
+            return
+        self.add_chunk(self._chunk.to_arrays(), self._chunk.strings, self._chunk.rows)
+        self._chunk = DatasetChunk(self.face_attr_names)
+
+    def close(self):
+        """写入剩余数据和meta.json，meta写入后数据集才对读者可见"""
+        self.flush()
+        meta = {
+            "version": STORE_VERSION,
+            "face_attr_names": self.face_attr_names,
+            "rows": self.rows,
+            "strings": self.strings,
+            "extra": self.extra_meta,
+        }
+        tmp_path = os.path.join(self.path, META_FILENAME + ".tmp")
+        with open(tmp_path, "w") as f:
+            json.dump(meta, f, ensure_ascii=False)
+        os.replace(tmp_path, os.path.join(self.path, META_FILENAME))
+
+
+class DatasetStore:
+    """内存映射的只读列式数据集"""
+
+    def __init__(self, path: str):
+        self.path = path
+        with open(os.path.join(path, META_FILENAME), "r") as f:
+            meta = json.load(f)
+        if meta.get("version") != STORE_VERSION:
+            raise ValueError(f"Unsupported dataset store version {meta.get('version')} at {path}")
+        self.face_attr_names: List[str] = meta["face_attr_names"]
+        self.face_attr_index = {name: i for i, name in enumerate(self.face_attr_names)}
+        self.strings: List[str] = meta["strings"]
+        self.rows: Dict[str, int] = meta["rows"]
+        self.extra_meta: dict = meta.get("extra", {})
+        # {文件名: [大小, mtime_ns, 内容哈希, 图片下标]}，由旧缓存迁移而来的数据集没有manifest
+        self.manifest: Optional[Dict[str, list]] = self.extra_meta.get("manifest")
+        self.columns: Dict[str, np.ndarray] = {}
+        for name, (table, dtype, _) in COLUMNS.items():
+            shape = (self.rows[table],) + _tail_shape(name, self.face_attr_names)
+            if shape[0] == 0:
+                self.columns[name] = np.zeros(shape, dtype=dtype)
+            else:
+                self.columns[name] = np.memmap(_column_path(path, name), dtype=dtype, mode="r", shape=shape)
+
+    @staticmethod
+    def exists(path: str) -> bool:
+        return os.path.exists(os.path.join(path, META_FILENAME))
+
+    def __len__(self):
+        return self.rows["picture"]
+
+    def live_indices(self) -> List[int]:
+        """当前有效的图片下标，按文件名排序；被替换或删除的图片不包含在内"""
+        if self.manifest is None:
+            return list(range(len(self)))
+        return [entry[3] for _, entry in sorted(self.manifest.items()) if entry[3] >= 0]
+
+    def string(self, sid: int) -> str:
+        return self.strings[sid]
+
+    def picture_raw(self, index: int) -> dict:
+        """解码第index张图片的原始json，每次调用返回一份新的字典"""
+        start = int(self.columns["picture_blob_start"][index])
+        length = int(self.columns["picture_blob_length"][index])
+        return json.loads(self.columns["blob"][start:start + length].tobytes())
+
+    def detailing_flag(self, person_row: int, key: str) -> Optional[bool]:
+        """读取以列存储的qwen_detailing布尔字段，缺失时返回None"""
+        value = self.columns[DETAILING_FLAGS[key]][person_row]
+        if value < 0:
+            return None
+        return bool(value)
+
+
+def compile_dataset(raw_pictures, path: str, face_attr_names: List[str], file_names=None, chunk_size: int = 1000):
+    """把原始图片json列表编译成列式数据集"""
+    writer = DatasetStoreWriter(path, face_attr_names)
+    for i, data in enumerate(raw_pictures):
+        writer.add_picture(data, file_names[i] if file_names is not None else "")
+        if (i + 1) % chunk_size == 0:
+            writer.flush()
+    writer.close()
+    return DatasetStore(path)
+
+
+def _file_digest(content: bytes) -> str:
+    return hashlib.blake2b(content, digest_size=16).hexdigest()
+
+
+def _parse_files(paths: List[str], face_attr_names: List[str]):
+    """工作进程：解析一批标注json，返回列数据块、各文件的manifest信息和解析失败的文件"""
+    chunk = DatasetChunk(face_attr_names)
+    files = []  # (文件名, 大小, mtime_ns, 内容哈希, 块内图片下标；解析失败为-1)
+    errors = []
+    for path in paths:
+        file_name = os.path.basename(path)
+        try:
+            stat = os.stat(path)
+            with open(path, "rb") as f:
+                content = f.read()
+        except OSError as e:
+            errors.append((file_name, f"{type(e).__name__}: {e}"))
+            continue
+        try:
+            picture = chunk.add_picture(json.loads(content), file_name)
+        except Exception as e:
+            errors.append((file_name, f"{type(e).__name__}: {e}"))
+            picture = -1
+        files.append((file_name, stat.st_size, stat.st_mtime_ns, _file_digest(content), picture))
+    return chunk.to_arrays(), chunk.strings, chunk.rows, files, errors
+
+
+def _ingest_into(writer: DatasetStoreWriter, paths: List[str], workers: Optional[int], chunk_size: int):
+    """用进程池并行解析标注json，按块流式追加到writer
+
+    Returns:
+        (manifest条目 {文件名: [大小, mtime_ns, 内容哈希, 图片下标]}, 跳过的 (文件名, 错误信息) 列表)
+    """
+    workers = workers or os.cpu_count() or 1
+    batches = [paths[i:i + chunk_size] for i in range(0, len(paths), chunk_size)]
+    entries = {}
+    errors = []
+    done = 0
+    start_time = time.time()
+
+    def merge(batch, result):
+        nonlocal done
+        arrays, strings, rows, files, batch_errors = result
+        base = writer.rows["picture"]
+        writer.add_chunk(arrays, strings, rows)
+        for file_name, size, mtime_ns, digest, picture in files:
+            entries[file_name] = [size, mtime_ns, digest, base + picture if picture >= 0 else -1]
+        errors.extend(batch_errors)
+        done += len(batch)
+        elapsed = max(time.time() - start_time, 1e-6)
+        print(f"Ingested {done}/{len(paths)} files ({done / elapsed:.1f} files/s), {len(errors)} skipped.")
+
+    if workers > 1 and len(batches) > 1:
+        # 限制在途批次数，避免解析结果堆积在内存里
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            pending = deque()
+            for batch in batches:
+                pending.append((batch, executor.submit(_parse_files, batch, writer.face_attr_names)))
+                if len(pending) >= workers * 2:
+                    done_batch, future = pending.popleft()
+                    merge(done_batch, future.result())
+            while pending:
+                done_batch, future = pending.popleft()
+                merge(done_batch, future.result())
+    else:
+        for batch in batches:
+            merge(batch, _parse_files(batch, writer.face_attr_names))
+
+    for file_name, message in errors:
+        print(f"Skipped malformed file {file_name}: {message}")
+    return entries, errors
+
+
+def ingest_json_files(paths: List[str], path: str, face_attr_names: List[str], workers: Optional[int] = None, chunk_size: int = 256):
+    """用进程池并行解析标注json，按块流式写入新的列式数据集，并记录每个文件的manifest
+
+    解析失败的文件会被跳过并汇报，不会中断整个导入。
+
+    Returns:
+        (打开的DatasetStore, 跳过的 (文件名, 错误信息) 列表)
+    """
+    writer = DatasetStoreWriter(path, face_attr_names)
+    manifest, errors = _ingest_into(writer, list(paths), workers, chunk_size)
+    writer.extra_meta["manifest"] = manifest
+    writer.close()
+    return DatasetStore(path), errors
+
+
+def _compact(store: "DatasetStore", face_attr_names: List[str], chunk_size: int = 1000):
+    """丢弃已被替换或删除的图片，重写数据集；每chunk_size张图片写出一块，内存占用和数据集大小无关"""
+    tmp_path = store.path + ".compact"
+    writer = DatasetStoreWriter(tmp_path, face_attr_names)
+    manifest = {}
+    added = 0
+    for file_name, entry in sorted(store.manifest.items()):
+        size, mtime_ns, digest, picture = entry
+        if picture >= 0:
+            picture = writer.add_picture(store.picture_raw(picture), file_name)
+            added += 1
+            if added % chunk_size == 0:
+                writer.flush()
+        manifest[file_name] = [size, mtime_ns, digest, picture]
+    writer.extra_meta["manifest"] = manifest
+    writer.close()
+    old_path = store.path + ".old"
+    os.replace(store.path, old_path)
+    os.replace(tmp_path, store.path)
+    shutil.rmtree(old_path)
+
+
+def sync_store(path: str, dataset_dir: str, face_attr_names: List[str], workers: Optional[int] = None, chunk_size: int = 256, store: Optional["DatasetStore"] = None):
+    """按manifest增量更新数据集：只重新解析新增或内容变化的文件，删除的文件从manifest中移除
+
+    大小和mtime都没变的文件直接跳过；mtime变了但内容哈希相同的文件只更新manifest。
+    被替换或删除的图片行留在列文件里，当它们多于有效行时整体压缩一次。
+
+    Args:
+        store: 已经打开的path处的数据集，避免重复打开
+
+    Returns:
+        (打开的DatasetStore, 跳过的 (文件名, 错误信息) 列表)
+    """
+    if store is None:
+        store = DatasetStore(path)
+    manifest = dict(store.manifest)
+    current = {}
+    for entry in os.scandir(dataset_dir):
+        if entry.name.endswith(".json") and entry.is_file():
+            current[entry.name] = entry.stat()
+
+    changed = []
+    for file_name, stat in sorted(current.items()):
+        old = manifest.get(file_name)
+        if old is not None and old[0] == stat.st_size and old[1] == stat.st_mtime_ns:
+            continue
+        if old is not None:
+            with open(os.path.join(dataset_dir, file_name), "rb") as f:
+                if _file_digest(f.read()) == old[2]:
+                    manifest[file_name] = [stat.st_size, stat.st_mtime_ns, old[2], old[3]]
+                    continue
+        changed.append(file_name)
+    deleted = [file_name for file_name in manifest if file_name not in current]
+
+    if not changed and not deleted and manifest == store.manifest:
+        return store, []
+    print(f"Dataset changed: {len(changed)} added or modified, {len(deleted)} deleted files.")
+    for file_name in deleted:
+        del manifest[file_name]
+
+    writer = DatasetStoreWriter(path, face_attr_names, append=True)
+    entries, errors = _ingest_into(writer, [os.path.join(dataset_dir, file_name) for file_name in changed], workers, chunk_size)
+    manifest.update(entries)
+    writer.extra_meta["manifest"] = manifest
+    writer.close()
+
+    store = DatasetStore(path)
+    live = len(store.live_indices())
+    if len(store) - live > max(live, 1000):
+        print(f"Compacting dataset store: {len(store) - live} stale pictures, {live} live.")
+        _compact(store, face_attr_names)
+        store = DatasetStore(path)
+    return store, errors
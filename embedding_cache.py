@@ -0,0 +1,148 @@
+import json
+import os
+from typing import Callable, Dict, List, Sequence
+
+import numpy as np
+
+EMBEDDING_CACHE_DIRNAME = "embedding_cache"
+META_FILENAME = "meta.json"
+VECTORS_FILENAME = "vectors.bin"
+
+# 每个模型一个目录：向量以float32逐行追加写入vectors.bin，文本列表（行号即下标）和维度记录在meta.json中，
+# 读取时用 np.memmap 映射；meta.json 总是在向量写入之后原子替换，中断时多出的半截向量在下次打开时截掉
+
+
+class EmbeddingCache:
+    """按模型名和文本持久化的句向量缓存，只对没有缓存过的文本调用模型"""
+
+    def __init__(self, model_name: str, root: str = EMBEDDING_CACHE_DIRNAME):
+        self.model_name = model_name
+        self.path = os.path.join(root, model_name.replace("/", "__"))
+        self.texts: List[str] = []
+        self.rows: Dict[str, int] = {}
+        self.dim = 0
+        os.makedirs(self.path, exist_ok=True)
+        meta_path = os.path.join(self.path, META_FILENAME)
+        if os.path.exists(meta_path):
+            with open(meta_path, "r", encoding="utf-8") as f:
+                meta = json.load(f)
+            if meta.get("model_name") != model_name:
+                raise ValueError(f"Embedding cache at {self.path} belongs to model {meta.get('model_name')}")
+            self.texts = meta["texts"]
+            self.rows = {text: i for i, text in enumerate(self.texts)}
+            self.dim = meta["dim"]
+        with open(self._vectors_path(), "ab") as f:
+            f.truncate(len(self.texts) * self.dim * 4)
+
+    def _vectors_path(self):
+        return os.path.join(self.path, VECTORS_FILENAME)
+
+    def _write_meta(self):
+        meta = {"model_name": self.model_name, "dim": self.dim, "texts": self.texts}
+        tmp_path = os.path.join(self.path, META_FILENAME + ".tmp")
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(meta, f, ensure_ascii=False)
+        os.replace(tmp_path, os.path.join(self.path, META_FILENAME))
+
+    def vectors(self) -> np.ndarray:
+        """所有已缓存的向量，第i行对应texts[i]"""
+        if not self.texts:
+            return np.zeros((0, self.dim), dtype=np.float32)
+        return np.memmap(self._vectors_path(), dtype=np.float32, mode="r", shape=(len(self.texts), self.dim))
+
+    def encode(self, texts: Sequence[str], encode_batch: Callable[[List[str]], np.ndarray], batch_size: int = 4096) -> Dict[str, np.ndarray]:
+        """返回 {文本: 向量}，缺失的文本按batch_size分批交给encode_batch编码并追加到缓存
+
+        Args:
+            texts: 需要向量的文本
+            encode_batch: 把一批文本编码成 (批大小, 维度) 数组的函数，只有存在缺失文本时才会被调用
+            batch_size: 每批编码并落盘的文本数
+        """
+        missing = [text for text in dict.fromkeys(texts) if text not in self.rows]
+        if missing:
+            print(f"Encoding {len(missing)} new texts with {self.model_name} ({len(self.texts)} cached).")
+            for start in range(0, len(missing), batch_size):
+                batch = missing[start:start + batch_size]
+                vectors = np.ascontiguousarray(encode_batch(batch), dtype=np.float32).reshape(len(batch), -1)
+                if self.dim and vectors.shape[1] != self.dim:
+                    raise ValueError(f"Embedding dimension changed from {self.dim} to {vectors.shape[1]} for model {self.model_name}")
+                self.dim = vectors.shape[1]
+                with open(self._vectors_path(), "ab") as f:
+                    vectors.tofile(f)
+                for text in batch:
+                    self.rows[text] = len(self.texts)
+                    self.texts.append(text)
+                self._write_meta()
+                print(f"Encoded {min(start + batch_size, len(missing))}/{len(missing)} texts.")
+        vectors = self.vectors()
+        return {text: np.array(vectors[self.rows[text]]) for text in texts}
+
+
+def _normalized(vectors) -> np.ndarray:
+    matrix = np.asarray(vectors, dtype=np.float32).reshape(len(vectors), -1)
+    return matrix / np.maximum(np.linalg.norm(matrix, axis=1, keepdims=True), 1e-8)
+
+
+def similar_pairs(vectors, threshold: float, block_size: int = 2048) -> np.ndarray:
+    """余弦相似度不低于threshold的所有下标对 (i, j)，i < j，按 (i, j) 排序（即itertools.combinations的顺序）
+
+    先把向量归一化，再按 block_size × block_size 分块做矩阵乘法，同一时刻只保留一块相似度，内存和词表大小无关。
+    零向量和任何向量的相似度都视为0。
+    """
+    if len(vectors) == 0:
+        return np.zeros((0, 2), dtype=np.int64)
+    matrix = _normalized(vectors)
+    n = len(matrix)
+    pairs = []
+    for row_start in range(0, n, block_size):
+        rows = matrix[row_start:row_start + block_size]
+        block_pairs = []
+        # 只算上三角：列块从当前行块开始
+        for col_start in range(row_start, n, block_size):
+            similarity = rows @ matrix[col_start:col_start + block_size].T
+            i, j = np.nonzero(similarity >= threshold)
+            i += row_start
+            j += col_start
+            upper = i < j
+            block_pairs.append(np.stack([i[upper], j[upper]], axis=1))
+        block_pairs = np.concatenate(block_pairs)
+        pairs.append(block_pairs[np.lexsort((block_pairs[:, 1], block_pairs[:, 0]))])
+    return np.concatenate(pairs)
+
+
+def top_k_similar_pairs(vectors, top_k: int, threshold: float, block_size: int = 1024) -> np.ndarray:
+    """每个词只和余弦相似度最高的top_k个邻居组成候选词对，同样要求相似度不低于threshold
+
+    按 block_size 行分块和整个矩阵相乘，逐行用argpartition取前top_k，不保留整张相似度矩阵。
+    返回去重后的 (i, j)，i < j，按 (i, j) 排序。
+    """
+    n = len(vectors)
+    if n < 2 or top_k <= 0:
+        return np.zeros((0, 2), dtype=np.int64)
+    matrix = _normalized(vectors)
+    k = min(top_k, n - 1)
+    pairs = []
+    for row_start in range(0, n, block_size):
+        similarity = matrix[row_start:row_start + block_size] @ matrix.T
+        rows = np.arange(row_start, row_start + len(similarity))
+        similarity[rows - row_start, rows] = -np.inf
+        neighbors = np.argpartition(-similarity, k - 1, axis=1)[:, :k]
+        keep = np.take_along_axis(similarity, neighbors, axis=1) >= threshold
+        i = np.repeat(rows, k)[keep.ravel()]
+        j = neighbors.ravel()[keep.ravel()]
+        pairs.append(np.stack([np.minimum(i, j), np.maximum(i, j)], axis=1))
+    return np.unique(np.concatenate(pairs), axis=0)
+
+
+def similar_pairs_of_rows(vectors, rows: List[int], threshold: float) -> List[tuple]:
+    """包含rows中某个词、余弦相似度不低于threshold的所有 (i, j) 词对，用于在抽样词上和穷举结果对比"""
+    if not len(rows):
+        return []
+    matrix = _normalized(vectors)
+    similarity = matrix[rows] @ matrix.T
+    result = []
+    for row, j in zip(*np.nonzero(similarity >= threshold)):
+        i = rows[row]
+        if i != j:
+            result.append((min(i, int(j)), max(i, int(j))))
+    return result
@@ -0,0 +1,204 @@
+import contextlib
+import json
+import threading
+import time
+from collections import Counter, deque
+from typing import Dict, Optional, Tuple
+
+# 延迟直方图的桶上界（秒），和Prometheus histogram的le标签对应
+LATENCY_BUCKETS = (0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 40, 80, 160, 320, 640)
+# 每个序列保留最近这么多次延迟用于计算分位数
+LATENCY_SAMPLES = 4096
+PERCENTILES = (50, 90, 99)
+
+
+class _RequestSeries:
+    """一组 (API函数, 调用者, 端点) 的请求统计"""
+    __slots__ = ("requests", "errors", "bucket_counts", "latency_sum", "samples", "prompt_tokens", "completion_tokens")
+
+    def __init__(self):
+        self.requests = 0
+        self.errors = Counter()
+        self.bucket_counts = [0] * (len(LATENCY_BUCKETS) + 1)
+        self.latency_sum = 0.0
+        self.samples = deque(maxlen=LATENCY_SAMPLES)
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
+
+
+class _CallSeries:
+    """一组 (API函数, 调用者) 的调用统计：重试、缓存命中、合并的请求"""
+    __slots__ = ("retries", "cache_hits", "shared")
+
+    def __init__(self):
+        self.retries = Counter()
+        self.cache_hits = 0
+        self.shared = 0
+
+
+class _Measurement:
+    __slots__ = ("usage",)
+
+    def __init__(self):
+        self.usage = None
+
+
+def _percentile(sorted_values, q):
+    if not sorted_values:
+        return None
+    index = min(len(sorted_values) - 1, max(0, round(q / 100 * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+
+def _escape(value: str) -> str:
+    return str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+
+def _labels(**labels) -> str:
+    return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in labels.items()) + "}"
+
+
+class LLMMetrics:
+    """LLM调用的统计：按API函数、调用者和端点记录请求数、延迟、token用量、重试和错误类别
+
+    所有方法都是线程安全的，运行中可以在其他线程调用snapshot()/to_prometheus()查看。
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._requests: Dict[Tuple[str, str, str], _RequestSeries] = {}
+        self._calls: Dict[Tuple[str, str], _CallSeries] = {}
+        self.started = time.time()
+
+    def _call_series(self, function: str, caller: str) -> _CallSeries:
+        series = self._calls.get((function, caller))
+        if series is None:
+            series = self._calls[(function, caller)] = _CallSeries()
+        return series
+
+    @contextlib.contextmanager
+    def measure(self, function: str, caller: str, endpoint: str):
+        """with metrics.measure(...) as m: 包住一次请求，成功时记录延迟和m.usage中的token数，失败时记录异常类别"""
+        measurement = _Measurement()
+        start = time.monotonic()
+        try:
+            yield measurement
+        except BaseException as e:
+            self._record_request(function, caller, endpoint, None, None, type(e).__name__)
+            raise
+        self._record_request(function, caller, endpoint, time.monotonic() - start, measurement.usage, None)
+
+    def _record_request(self, function, caller, endpoint, latency: Optional[float], usage, error: Optional[str]):
+        with self._lock:
+            key = (function, caller, endpoint)
+            series = self._requests.get(key)
+            if series is None:
+                series = self._requests[key] = _RequestSeries()
+            series.requests += 1
+            if error is not None:
+                series.errors[error] += 1
+                return
+            bucket = next((i for i, bound in enumerate(LATENCY_BUCKETS) if latency <= bound), len(LATENCY_BUCKETS))
+            series.bucket_counts[bucket] += 1
+            series.latency_sum += latency
+            series.samples.append(latency)
+            if usage is not None:
+                series.prompt_tokens += getattr(usage, "prompt_tokens", 0) or 0
+                series.completion_tokens += getattr(usage, "completion_tokens", 0) or 0
+
+    def record_retry(self, function: str, caller: str, error: Exception):
+        with self._lock:
+            self._call_series(function, caller).retries[type(error).__name__] += 1
+
+    def record_cache_hit(self, function: str, caller: str):
+        with self._lock:
+            self._call_series(function, caller).cache_hits += 1
+
+    def record_shared(self, function: str, caller: str):
+        with self._lock:
+            self._call_series(function, caller).shared += 1
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            requests = [
+                {
+                    "function": function,
+                    "caller": caller,
+                    "endpoint": endpoint,
+                    "requests": series.requests,
+                    "errors": dict(series.errors),
+                    "latency_seconds": dict(
+                        {"count": sum(series.bucket_counts), "sum": series.latency_sum},
+                        **{f"p{q}": _percentile(sorted(series.samples), q) for q in PERCENTILES},
+                    ),
+                    "latency_buckets": dict(zip([str(bound) for bound in LATENCY_BUCKETS] + ["+Inf"], series.bucket_counts)),
+                    "prompt_tokens": series.prompt_tokens,
+                    "completion_tokens": series.completion_tokens,
+                }
+                for (function, caller, endpoint), series in self._requests.items()
+            ]
+            calls = [
+                {
+                    "function": function,
+                    "caller": caller,
+                    "retries": dict(series.retries),
+                    "cache_hits": series.cache_hits,
+                    "shared": series.shared,
+                }
+                for (function, caller), series in self._calls.items()
+            ]
+        return {"started": self.started, "uptime_seconds": time.time() - self.started, "requests": requests, "calls": calls}
+
+    def to_json(self) -> str:
+        return json.dumps(self.snapshot(), indent=4)
+
+    def to_prometheus(self) -> str:
+        """Prometheus文本格式"""
+        snapshot = self.snapshot()
+        lines = []
+
+        def family(name, kind, help_text):
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {kind}")
+
+        family("llm_requests_total", "counter", "Requests sent to an LLM endpoint, including failed ones.")
+        for item in snapshot["requests"]:
+            lines.append(f"llm_requests_total{_labels(function=item['function'], caller=item['caller'], endpoint=item['endpoint'])} {item['requests']}")
+        family("llm_request_errors_total", "counter", "Failed LLM requests by exception class.")
+        for item in snapshot["requests"]:
+            for error, count in item["errors"].items():
+                lines.append(f"llm_request_errors_total{_labels(function=item['function'], caller=item['caller'], endpoint=item['endpoint'], error=error)} {count}")
+        family("llm_request_latency_seconds", "histogram", "Latency of successful LLM requests.")
+        for item in snapshot["requests"]:
+            labels = dict(function=item["function"], caller=item["caller"], endpoint=item["endpoint"])
+            cumulative = 0
+            for bound, count in item["latency_buckets"].items():
+                cumulative += count
+                lines.append(f"llm_request_latency_seconds_bucket{_labels(**labels, le=bound)} {cumulative}")
+            lines.append(f"llm_request_latency_seconds_sum{_labels(**labels)} {item['latency_seconds']['sum']}")
+            lines.append(f"llm_request_latency_seconds_count{_labels(**labels)} {item['latency_seconds']['count']}")
+        for name, field, help_text in (
+            ("llm_prompt_tokens_total", "prompt_tokens", "Prompt tokens reported in usage."),
+            ("llm_completion_tokens_total", "completion_tokens", "Completion tokens reported in usage."),
+        ):
+            family(name, "counter", help_text)
+            for item in snapshot["requests"]:
+                lines.append(f"{name}{_labels(function=item['function'], caller=item['caller'], endpoint=item['endpoint'])} {item[field]}")
+        family("llm_retries_total", "counter", "Retries by exception class.")
+        for item in snapshot["calls"]:
+            for error, count in item["retries"].items():
+                lines.append(f"llm_retries_total{_labels(function=item['function'], caller=item['caller'], error=error)} {count}")
+        for name, field, help_text in (
+            ("llm_cache_hits_total", "cache_hits", "Calls answered from the response cache."),
+            ("llm_shared_calls_total", "shared", "Calls that shared an identical in-flight request."),
+        ):
+            family(name, "counter", help_text)
+            for item in snapshot["calls"]:
+                lines.append(f"{name}{_labels(function=item['function'], caller=item['caller'])} {item[field]}")
+        return "\n".join(lines) + "\n"
+
+    def dump(self, path: str):
+        """写出统计，.prom/.txt 结尾写Prometheus文本格式，其他写JSON"""
+        text = self.to_prometheus() if path.endswith((".prom", ".txt")) else self.to_json()
+        with open(path, "w", encoding="utf-8") as f:
+            f.write(text)
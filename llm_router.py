@@ -0,0 +1,143 @@
+import asyncio
+import contextlib
+import itertools
+import os
+import threading
+import time
+import weakref
+from typing import Callable, List
+
+from openai import AsyncOpenAI, OpenAI
+
+# 连续失败这么多次的端点暂时移出路由，移出时长从BASE_EJECT_SECONDS开始每次加倍，不超过MAX_EJECT_SECONDS
+EJECT_AFTER_FAILURES = 2
+BASE_EJECT_SECONDS = 5
+MAX_EJECT_SECONDS = 300
+
+
+def endpoint_urls(default_url: str) -> List[str]:
+    """环境变量 LLM_ENDPOINTS 中逗号分隔的服务地址，未设置时只使用default_url"""
+    value = os.getenv("LLM_ENDPOINTS", "")
+    urls = [url.strip() for url in value.split(",") if url.strip()]
+    return urls or [default_url]
+
+
+class Endpoint:
+    """一个OpenAI兼容的推理服务副本
+
+    同步客户端全局复用（内部有HTTP连接池）；异步客户端的连接池绑定事件循环，每个事件循环各自创建一个。
+    客户端自身不重试，失败直接交给路由和retry_api_call处理，以便换到其他副本。
+    """
+
+    def __init__(self, base_url: str, api_key: str):
+        self.base_url = base_url
+        self.api_key = api_key
+        self.client = OpenAI(base_url=base_url, api_key=api_key, max_retries=0)
+        # 按事件循环分别保存的异步客户端；弱引用键，事件循环被回收时对应的客户端一起释放
+        self._async_clients = weakref.WeakKeyDictionary()
+        self._lock = threading.Lock()
+        self.outstanding = 0
+        self.requests = 0
+        self.failures = 0
+        self.consecutive_failures = 0
+        self.ejections = 0
+        self.ejected_until = 0.0
+
+    def async_client(self) -> AsyncOpenAI:
+        loop = asyncio.get_running_loop()
+        with self._lock:
+            client = self._async_clients.get(loop)
+            if client is None:
+                # 已关闭的事件循环的客户端无法再使用或关闭，丢掉引用由垃圾回收释放连接；仍在运行的其他循环的客户端保留
+                for closed_loop in [other for other in self._async_clients if other.is_closed()]:
+                    del self._async_clients[closed_loop]
+                client = self._async_clients[loop] = AsyncOpenAI(base_url=self.base_url, api_key=self.api_key, max_retries=0)
+        return client
+
+    async def aclose_async_client(self):
+        """关闭当前事件循环的异步客户端，须在该循环关闭前调用"""
+        with self._lock:
+            client = self._async_clients.pop(asyncio.get_running_loop(), None)
+        if client is not None:
+            await client.close()
+
+    def healthy(self, now: float) -> bool:
+        return now >= self.ejected_until
+
+
+class EndpointPool:
+    """多个推理服务副本，每个请求发给在途请求最少的健康副本"""
+
+    def __init__(self, base_urls: List[str], api_key: str):
+        if not base_urls:
+            raise ValueError("At least one LLM endpoint is required")
+        self.endpoints = [Endpoint(url, api_key) for url in base_urls]
+        self._lock = threading.Lock()
+        # 在途请求数相同时轮流选择，避免总是落到第一个副本
+        self._rotation = itertools.count()
+
+    async def aclose_async_clients(self):
+        """关闭所有副本在当前事件循环中的异步客户端"""
+        await asyncio.gather(*(endpoint.aclose_async_client() for endpoint in self.endpoints))
+
+    def has_healthy(self) -> bool:
+        now = time.monotonic()
+        return any(endpoint.healthy(now) for endpoint in self.endpoints)
+
+    def acquire(self) -> Endpoint:
+        """选出在途请求最少的健康副本并占用一个在途名额；全部被移出时选最早恢复的副本"""
+        with self._lock:
+            now = time.monotonic()
+            candidates = [endpoint for endpoint in self.endpoints if endpoint.healthy(now)]
+            if not candidates:
+                candidates = [min(self.endpoints, key=lambda endpoint: endpoint.ejected_until)]
+            start = next(self._rotation) % len(candidates)
+            endpoint = min(candidates[start:] + candidates[:start], key=lambda endpoint: endpoint.outstanding)
+            endpoint.outstanding += 1
+            endpoint.requests += 1
+            return endpoint
+
+    def release(self, endpoint: Endpoint, failed: bool):
+        """归还在途名额；连接失败累计到EJECT_AFTER_FAILURES次时把副本暂时移出，成功一次即恢复"""
+        with self._lock:
+            endpoint.outstanding -= 1
+            if not failed:
+                if endpoint.ejections:
+                    print(f"Endpoint {endpoint.base_url} is responding again.")
+                endpoint.consecutive_failures = 0
+                endpoint.ejections = 0
+                endpoint.ejected_until = 0.0
+                return
+            endpoint.failures += 1
+            endpoint.consecutive_failures += 1
+            now = time.monotonic()
+            if endpoint.consecutive_failures >= EJECT_AFTER_FAILURES and endpoint.healthy(now):
+                duration = min(BASE_EJECT_SECONDS * (2 ** endpoint.ejections), MAX_EJECT_SECONDS)
+                endpoint.ejections += 1
+                endpoint.ejected_until = now + duration
+                print(f"Endpoint {endpoint.base_url} ejected for {duration} s after {endpoint.consecutive_failures} consecutive connection failures.")
+
+    @contextlib.contextmanager
+    def route(self, is_failure: Callable[[Exception], bool]):
+        """with pool.route(...) as endpoint: 期间占用endpoint，is_failure判定抛出的异常是否算作该副本连接失败"""
+        endpoint = self.acquire()
+        try:
+            yield endpoint
+        except BaseException as e:
+            self.release(endpoint, isinstance(e, Exception) and is_failure(e))
+            raise
+        self.release(endpoint, False)
+
+    def stats(self) -> List[dict]:
+        now = time.monotonic()
+        with self._lock:
+            return [
+                {
+                    "base_url": endpoint.base_url,
+                    "outstanding": endpoint.outstanding,
+                    "requests": endpoint.requests,
+                    "failures": endpoint.failures,
+                    "healthy": endpoint.healthy(now),
+                }
+                for endpoint in self.endpoints
+            ]
@@ -1,26 +1,24 @@
-import json
 import os
-from typing import Dict, List
+from typing import Dict, Optional
 import itertools
 import concurrent.futures
 import threading
 from test_framework import Person, QuestionGenerator, POSITION_INCLUDE_MAP, POSITION_EXCLUDE_MAP, POSITION_SIMPLIFIER
 from utils import ask_question, bounding_box_iou
+from synonyms import SynonymTable, load_synonym_table
 from sentence_transformers import SentenceTransformer, util
 from thefuzz import fuzz
 import random
 
-CLOTHING_SYNONYMS = None
-HOI_SYNONYMS = None
+CLOTHING_SYNONYMS: Optional[SynonymTable] = None
+HOI_SYNONYMS: Optional[SynonymTable] = None
 
 
-def load_synonym_dicts() -> Dict[str, Dict[str, List[str]]]:
+def load_synonym_dicts() -> Dict[str, SynonymTable]:
+    """加载并编译服饰和HOI同义词词典，文件未修改时复用已编译的结果"""
     global CLOTHING_SYNONYMS, HOI_SYNONYMS
-    if CLOTHING_SYNONYMS is None or HOI_SYNONYMS is None:
-        with open("clothing_synonym_dict.json", "r", encoding="utf-8") as f:
-            CLOTHING_SYNONYMS = json.load(f)["synonyms"]
-        with open("hoi_synonym_dict.json", "r", encoding="utf-8") as f:
-            HOI_SYNONYMS = json.load(f)["synonyms"]
+    CLOTHING_SYNONYMS = load_synonym_table("clothing_synonym_dict.json")
+    HOI_SYNONYMS = load_synonym_table("hoi_synonym_dict.json")
     return {
         "clothing_synonyms": CLOTHING_SYNONYMS,
         "hoi_synonyms": HOI_SYNONYMS
@@ -219,10 +217,10 @@ class ManyPersonMixedFeatureQuestionGenerator(QuestionGenerator):
         return filtered_pictures
     
     def _construct_synonym_dict(self):
-        """加载同义词词典"""
-        load_synonym_dicts()
-        self.clothing_synonyms = CLOTHING_SYNONYMS
-        self.hoi_synonyms = HOI_SYNONYMS
+        """加载编译后的同义词词典"""
+        tables = load_synonym_dicts()
+        self.clothing_synonyms = tables["clothing_synonyms"]
+        self.hoi_synonyms = tables["hoi_synonyms"]
 
     def feature_set_substract(self, a, b):
         # 减去别人相同或者不明确的特征
@@ -255,11 +253,11 @@ class ManyPersonMixedFeatureQuestionGenerator(QuestionGenerator):
             if feat_a["attr_type"] == "clothing":
                 found = False
                 for feat_b in sub_b:
-                    type_match = feat_a["attr_value"]["name"] in self.clothing_synonyms[feat_b["attr_value"]["name"]] or feat_a["attr_value"]["name"] == feat_b["attr_value"]["name"]
+                    type_match = self.clothing_synonyms.are_synonyms(feat_a["attr_value"]["name"], feat_b["attr_value"]["name"])
                     color_match = False
                     for a_color in feat_a["attr_value"]["color"]:
                         for b_color in feat_b["attr_value"]["color"]:
-                            if a_color in self.clothing_synonyms[b_color] or a_color == b_color:
+                            if self.clothing_synonyms.are_synonyms(a_color, b_color):
                                 color_match = True
                                 break
                         if color_match:
@@ -276,14 +274,14 @@ class ManyPersonMixedFeatureQuestionGenerator(QuestionGenerator):
                     action_position_match = False
                     for a_position, a_action in feat_a["attr_value"]["relation"]:
                         for b_position, b_action in feat_b["attr_value"]["relation"]:
-                            action_synonym = a_action in self.hoi_synonyms[b_action]
+                            action_synonym = self.hoi_synonyms.are_synonyms(a_action, b_action, reflexive=False)
                             position_exclude = a_position in (POSITION_EXCLUDE_MAP.get(b_position, []) + [b_position])
                             if action_synonym and position_exclude:
                                 action_position_match = True
                                 break
                         if action_position_match:
                             break
-                    name_match = feat_a["attr_value"]["object"] in self.hoi_synonyms.get(feat_b["attr_value"]["object"], []) or feat_b["attr_value"]["object"] == feat_a["attr_value"]["object"]
+                    name_match = self.hoi_synonyms.are_synonyms(feat_a["attr_value"]["object"], feat_b["attr_value"]["object"])
                     if action_position_match and name_match:
                         found = True
                         break
@@ -321,14 +319,14 @@ class ManyPersonMixedFeatureQuestionGenerator(QuestionGenerator):
             if feat_a["attr_type"] == "clothing":
                 found = False
                 for feat_b in sub_b:
-                    type_match = feat_a["attr_value"]["name"] in self.clothing_synonyms[feat_b["attr_value"]["name"]] or feat_a["attr_value"]["name"] == feat_b["attr_value"]["name"]
+                    type_match = self.clothing_synonyms.are_synonyms(feat_a["attr_value"]["name"], feat_b["attr_value"]["name"])
                     color_match = False
                     a_color_match = False
                     b_color_match = False
                     for a_color in feat_a["attr_value"]["color"]:
                         a_color_match = False
                         for b_color in feat_b["attr_value"]["color"]:
-                            if a_color in self.clothing_synonyms[b_color] or a_color == b_color:
+                            if self.clothing_synonyms.are_synonyms(a_color, b_color):
                                 a_color_match = True
                                 break
                         if not a_color_match:
@@ -336,7 +334,7 @@ class ManyPersonMixedFeatureQuestionGenerator(QuestionGenerator):
                     for b_color in feat_b["attr_value"]["color"]:
                         b_color_match = False
                         for a_color in feat_a["attr_value"]["color"]:
-                            if b_color in self.clothing_synonyms[a_color] or b_color == a_color:
+                            if self.clothing_synonyms.are_synonyms(b_color, a_color):
                                 b_color_match = True
                                 break
                         if not b_color_match:
@@ -354,13 +352,13 @@ class ManyPersonMixedFeatureQuestionGenerator(QuestionGenerator):
                     position_match = False
                     for a_position, a_action in feat_a["attr_value"]["relation"]:
                         for b_position, b_action in feat_b["attr_value"]["relation"]:
-                            action_synonym = a_action in self.hoi_synonyms[b_action]
+                            action_synonym = self.hoi_synonyms.are_synonyms(a_action, b_action, reflexive=False)
                             position_include = a_position in (POSITION_INCLUDE_MAP.get(b_position, []) + [b_position])
                             if action_synonym:
                                 action_match = True
                             if position_include:
                                 position_match = True
-                    name_match = feat_a["attr_value"]["object"] in self.hoi_synonyms.get(feat_b["attr_value"]["object"], []) or feat_b["attr_value"]["object"] == feat_a["attr_value"]["object"]
+                    name_match = self.hoi_synonyms.are_synonyms(feat_a["attr_value"]["object"], feat_b["attr_value"]["object"])
                     if action_match and position_match and name_match:
                         if bounding_box_iou(feat_a["attr_value"]["bbox"], feat_b["attr_value"]["bbox"]) > 0.99:
                             c.append(feat_a)
@@ -1,19 +1,26 @@
 import json
 import os
-from typing import Dict, List
-import itertools
-import concurrent.futures
-import threading
+from typing import Dict, List, Optional
 from test_framework import QuestionGenerator
-from utils import ask_question
+from utils import ask_question_async, llm_call_label, llm_map
+from synonyms import PAIR_BATCH_SIZE, SynonymTable, judge_pair_batch, ngram_candidate_pairs, overlap_pairs, pair_batches, report_candidate_recall
 
 class MultiPersonClothingFeatureQuestionGenerator(QuestionGenerator):
     """多图人体服装特征题型生成器"""
-    def __init__(self, dataset_pictures):
+    def __init__(self, dataset_pictures, synonym_top_k: Optional[int] = None, pair_batch_size: int = PAIR_BATCH_SIZE):
+        """
+        Args:
+            dataset_pictures: 图片列表
+            synonym_top_k: 构建同义词词典时每个词只和共享字符n-gram最多的这么多个词配对，None为穷举所有词对
+            pair_batch_size: 每次请求判定的词对数，1为逐对提问
+        """
         super().__init__(dataset_pictures)
+        self.synonym_top_k = synonym_top_k
+        self.pair_batch_size = pair_batch_size
         self.clothing_color_name_2_picture_dict: Dict[str, Dict[str, List]] = {}
         self.clothing_name_color_2_picture_dict: Dict[str, Dict[str, List]] = {}
         self.synonym_dict: Dict[str, List[str]] = {}
+        self.synonyms = SynonymTable(self.synonym_dict)
         self.distinguishable_dict: Dict[str, List[str]] = {}
         self.clothing_freq_dict: Dict[str, int] = {}
 
@@ -40,11 +47,10 @@ class MultiPersonClothingFeatureQuestionGenerator(QuestionGenerator):
         print(f"All {len(self.clothing_name_color_2_picture_dict)} clothing name-color mappings constructed: {', '.join(list(self.clothing_name_color_2_picture_dict.keys()))}")
         print(f"All {len(self.clothing_color_name_2_picture_dict)} clothing color-name mappings constructed: {', '.join(list(self.clothing_color_name_2_picture_dict.keys()))}")
         self._construct_synonym_dict(list(self.clothing_name_color_2_picture_dict.keys()), list(self.clothing_color_name_2_picture_dict.keys()))
+        self.synonyms = SynonymTable(self.synonym_dict)
 
     def _construct_synonym_dict(self, name_list, color_list):
-        """构建同义词词典，使用16个并发线程，支持增量更新"""
-        # 创建线程锁保护共享资源
-        lock = threading.Lock()
+        """构建同义词词典，并发请求数由llm_limiter自适应控制，支持增量更新"""
         cnt = 0
         
         # 读取已有的同义词字典文件
@@ -64,20 +70,15 @@ class MultiPersonClothingFeatureQuestionGenerator(QuestionGenerator):
         self.synonym_dict.update(existing_synonyms)
         self.distinguishable_dict.update(existing_distinguishable)
         
-        def process_name_combination(combo):
+        def wording_overlap(text1, text2):
+            """一方的某个单词出现在另一方中"""
+            return any(word in text2 for word in text1.split()) or any(word in text1 for word in text2.split())
+
+        async def process_name_combination(combo):
             name1, name2 = combo
-            wording_overlap = False
-            for word in name1.split():
-                if word in name2:
-                    wording_overlap = True
-                    break
-            for word in name2.split():
-                if word in name1:
-                    wording_overlap = True
-                    break
-            if not wording_overlap:
+            if not wording_overlap(name1, name2):
                 return (name1, name2, False)
-            ans = ask_question(f"'{name1}' and '{name2}' are words discribing two wearable items. Please analyze their meanings and decide if they are looking alike, of same meaning, or one of them belong to the other. At the end of your answer, please put 'yes' if they are some kind of synonymous as said or 'no' if they are not.")
+            ans = await ask_question_async(f"'{name1}' and '{name2}' are words discribing two wearable items. Please analyze their meanings and decide if they are looking alike, of same meaning, or one of them belong to the other. At the end of your answer, please put 'yes' if they are some kind of synonymous as said or 'no' if they are not.")
             yes_idx = ans[::-1].lower().find("yes"[::-1])
             no_idx = ans[::-1].lower().find("no"[::-1])
             if yes_idx == -1:
@@ -89,20 +90,11 @@ class MultiPersonClothingFeatureQuestionGenerator(QuestionGenerator):
                 print(yes_idx, no_idx)
             return (name1, name2, yes_idx < no_idx)
         
-        def process_color_combination(combo):
+        async def process_color_combination(combo):
             color1, color2 = combo
-            wording_overlap = False
-            for word in color1.split():
-                if word in color2:
-                    wording_overlap = True
-                    break
-            for word in color2.split():
-                if word in color1:
-                    wording_overlap = True
-                    break
-            if not wording_overlap:
+            if not wording_overlap(color1, color2):
                 return (color1, color2, False)
-            ans = ask_question(f"'{color1}' and '{color2}' are words discribing two color types of some wearings. Please analyze their meanings and decide if they are looking alike, of same meaning, possibly hard to distinguish, or one of them belong to the other. At the end of your answer, please put 'yes' if they are this kind of similar color pattern or 'no' if they are not.")
+            ans = await ask_question_async(f"'{color1}' and '{color2}' are words discribing two color types of some wearings. Please analyze their meanings and decide if they are looking alike, of same meaning, possibly hard to distinguish, or one of them belong to the other. At the end of your answer, please put 'yes' if they are this kind of similar color pattern or 'no' if they are not.")
             print(ans)
             yes_idx = ans[::-1].lower().find("yes"[::-1])
             no_idx = ans[::-1].lower().find("no"[::-1])
@@ -114,6 +106,12 @@ class MultiPersonClothingFeatureQuestionGenerator(QuestionGenerator):
                 print(ans)
                 print(yes_idx, no_idx)
             return (color1, color2, yes_idx < no_idx)
+
+        async def judge_name_batch(batch):
+            return await judge_pair_batch(batch, "words discribing two wearable items", "if they are looking alike, of same meaning, or one of them belong to the other", process_name_combination)
+
+        async def judge_color_batch(batch):
+            return await judge_pair_batch(batch, "words discribing two color types of some wearings", "if they are looking alike, of same meaning, possibly hard to distinguish, or one of them belong to the other", process_color_combination)
         
         def combination_already_processed(item1, item2):
             """检查组合是否已经处理过"""
@@ -124,6 +122,21 @@ class MultiPersonClothingFeatureQuestionGenerator(QuestionGenerator):
                 return True
             return False
         
+        def candidate_combinations(words, label):
+            """有单词重叠、且没有处理过的词对，顺序和itertools.combinations相同
+
+            默认由单词倒排表直接生成所有有单词重叠的词对；设置了synonym_top_k时先用字符n-gram分块，并报告相对穷举结果的召回率。
+            """
+            words = list(words)
+            if self.synonym_top_k is None:
+                combos = [(words[i], words[j]) for i, j in overlap_pairs(words).tolist()]
+            else:
+                pairs = ngram_candidate_pairs(words, self.synonym_top_k)
+                report_candidate_recall(f"Top-{self.synonym_top_k} n-gram blocking for {label}", pairs, len(words), lambda rows: [(i, j) for i in rows for j in range(len(words)) if j != i and wording_overlap(words[i], words[j])])
+                combos = [(words[i], words[j]) for i, j in pairs.tolist() if wording_overlap(words[i], words[j])]
+            print(f"{len(combos)} of {len(words) * (len(words) - 1) // 2} {label} pairs share a word.")
+            return [combo for combo in combos if not combination_already_processed(*combo)]
+
         # 初始化字典
         for name in name_list:
             if name not in self.synonym_dict:
@@ -137,68 +150,64 @@ class MultiPersonClothingFeatureQuestionGenerator(QuestionGenerator):
             if color not in self.distinguishable_dict:
                 self.distinguishable_dict[color] = []
         
-        # 处理名称组合，跳过已处理的组合
-        name_combinations = [combo for combo in itertools.combinations(name_list, 2) 
-                           if not combination_already_processed(combo[0], combo[1])]
+        # 处理有单词重叠的名称组合，跳过已处理的组合
+        name_combinations = candidate_combinations(name_list, "clothing names")
         total_name_combinations = len(name_combinations)
         
         print(f"Found {total_name_combinations} new name combinations to process.")
         
         if total_name_combinations > 0:
-            with concurrent.futures.ThreadPoolExecutor(max_workers=16) as executor:
-                future_to_combo = {executor.submit(process_name_combination, combo): combo for combo in name_combinations}
-                
-                for future in concurrent.futures.as_completed(future_to_combo):
-                    name1, name2, is_synonym = future.result()
-                    
-                    with lock:
-                        if is_synonym:
-                            self.synonym_dict[name1].append(name2)
-                            self.synonym_dict[name2].append(name1)
-                        else:
-                            self.distinguishable_dict[name1].append(name2)
-                            self.distinguishable_dict[name2].append(name1)
-                        
-                        cnt += 1
-                        if cnt % 2000 == 0:
-                            print(f"Processed {cnt}/{total_name_combinations} name combinations so far.")
-                            with open("clothing_synonym_dict.json", "w") as f:
-                                json.dump({
-                                    "synonyms": self.synonym_dict,
-                                    "distinguishable": self.distinguishable_dict
-                                }, f)
+            def merge_name_results(index, batch, results):
+                nonlocal cnt
+                for name1, name2, is_synonym in results:
+                    if is_synonym:
+                        self.synonym_dict[name1].append(name2)
+                        self.synonym_dict[name2].append(name1)
+                    else:
+                        self.distinguishable_dict[name1].append(name2)
+                        self.distinguishable_dict[name2].append(name1)
+
+                    cnt += 1
+                    if cnt % 2000 == 0:
+                        print(f"Processed {cnt}/{total_name_combinations} name combinations so far.")
+                        with open("clothing_synonym_dict.json", "w") as f:
+                            json.dump({
+                                "synonyms": self.synonym_dict,
+                                "distinguishable": self.distinguishable_dict
+                            }, f)
+
+            with llm_call_label("clothing names"):
+                llm_map(judge_name_batch, pair_batches(name_combinations, self.pair_batch_size), on_result=merge_name_results)
         
-        # 处理颜色组合，跳过已处理的组合
-        color_combinations = [combo for combo in itertools.combinations(color_list, 2) 
-                            if not combination_already_processed(combo[0], combo[1])]
+        # 处理有单词重叠的颜色组合，跳过已处理的组合
+        color_combinations = candidate_combinations(color_list, "clothing colors")
         total_color_combinations = len(color_combinations)
         processed_colors = 0
         
         print(f"Found {total_color_combinations} new color combinations to process.")
         
         if total_color_combinations > 0:
-            with concurrent.futures.ThreadPoolExecutor(max_workers=16) as executor:
-                future_to_combo = {executor.submit(process_color_combination, combo): combo for combo in color_combinations}
-                
-                for future in concurrent.futures.as_completed(future_to_combo):
-                    color1, color2, is_synonym = future.result()
-                    
-                    with lock:
-                        if is_synonym:
-                            self.synonym_dict[color1].append(color2)
-                            self.synonym_dict[color2].append(color1)
-                        else:
-                            self.distinguishable_dict[color1].append(color2)
-                            self.distinguishable_dict[color2].append(color1)
-                        
-                        processed_colors += 1
-                        if processed_colors % 100 == 0:  # 更频繁地保存，避免丢失进度
-                            print(f"Processed {processed_colors}/{total_color_combinations} color combinations so far.")
-                            with open("clothing_synonym_dict.json", "w") as f:
-                                json.dump({
-                                    "synonyms": self.synonym_dict,
-                                    "distinguishable": self.distinguishable_dict
-                                }, f)
+            def merge_color_results(index, batch, results):
+                nonlocal processed_colors
+                for color1, color2, is_synonym in results:
+                    if is_synonym:
+                        self.synonym_dict[color1].append(color2)
+                        self.synonym_dict[color2].append(color1)
+                    else:
+                        self.distinguishable_dict[color1].append(color2)
+                        self.distinguishable_dict[color2].append(color1)
+
+                    processed_colors += 1
+                    if processed_colors % 100 == 0:  # 更频繁地保存，避免丢失进度
+                        print(f"Processed {processed_colors}/{total_color_combinations} color combinations so far.")
+                        with open("clothing_synonym_dict.json", "w") as f:
+                            json.dump({
+                                "synonyms": self.synonym_dict,
+                                "distinguishable": self.distinguishable_dict
+                            }, f)
+
+            with llm_call_label("clothing colors"):
+                llm_map(judge_color_batch, pair_batches(color_combinations, self.pair_batch_size), on_result=merge_color_results)
         
         # 最终保存
         with open("clothing_synonym_dict.json", "w") as f:
@@ -220,13 +229,8 @@ class MultiPersonClothingFeatureQuestionGenerator(QuestionGenerator):
 
         def find_image_partial_clothing(clothing_list, fit_count):
             """找出恰好满足clothing_list中fit_count个服饰的图片-服饰对"""
-            clothing_word_buckets = [set(self.synonym_dict.get(clothing['name'], []) + [clothing['name']]) for clothing in clothing_list]
-            color_word_buckets = []
-            for clothing in clothing_list:
-                color_bucket = set(clothing.get('color', []))
-                for color in clothing.get('color', []):
-                    color_bucket.update(self.synonym_dict.get(color, []) + [color])
-                color_word_buckets.append(color_bucket)
+            clothing_word_buckets = [self.synonyms.expand([clothing['name']]) for clothing in clothing_list]
+            color_word_buckets = [self.synonyms.expand(clothing.get('color', [])) for clothing in clothing_list]
             image_clothing_list = []
             for picture in self.dataset_pictures:
                 matched_clothing_results = []
@@ -273,8 +277,7 @@ class MultiPersonClothingFeatureQuestionGenerator(QuestionGenerator):
                     first_image_clothing_list.append((picture, top_clothings))
                     color_appeared = set()
                     for clothing in top_clothings:
-                        for color in clothing.get('color', []):
-                            color_appeared.update(self.synonym_dict.get(color, []) + [color])
+                        color_appeared.update(self.synonyms.expand(clothing.get('color', [])))
                     self.picture_occurrence[picture] = self.picture_occurrence.get(picture, 0) + 1
                     # 再找出部分符合的图片
                     partial_clothing = find_image_partial_clothing(top_clothings, fit_count=2)
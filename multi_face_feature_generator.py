@@ -1,10 +1,258 @@
 import json
-import itertools
+import math
+import os
+import tempfile
+import textwrap
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, Iterator, List, Optional, Sequence, Tuple
+import numpy as np
 from rich.progress import track
-from test_framework import QuestionGenerator, FACE_ATTR_NAMES
+from test_framework import QuestionGenerator, FaceAttrTable, Picture, FACE_ATTR_NAMES, FACE_ATTR_INDEX, get_face_attr_table, set_default
+
+if hasattr(np, "bitwise_count"):
+    _popcount = np.bitwise_count
+else:
+    def _popcount(x):
+        """uint64逐元素popcount（SWAR），用于没有np.bitwise_count的旧版numpy"""
+        x = x - ((x >> np.uint64(1)) & np.uint64(0x5555555555555555))
+        x = (x & np.uint64(0x3333333333333333)) + ((x >> np.uint64(2)) & np.uint64(0x3333333333333333))
+        x = (x + (x >> np.uint64(4))) & np.uint64(0x0F0F0F0F0F0F0F0F)
+        return (x * np.uint64(0x0101010101010101)) >> np.uint64(56)
+
+
+class FaceAttrCombinationEngine:
+    """用位掩码批量判定属性组合的 fullfit/duo/solo/none 图片
+
+    只考虑有面部框且面部占比超过min_face_area的人（下称合格人脸），每人的admit/deny集合编码为uint64位掩码，
+    一个组合的四类图片都由popcount和掩码运算对所有合格人脸一次性算出，再按图片归并。判定规则：
+      - fullfit：图中有人admit组合中的全部属性
+      - duo：图中有人admit其中k-1个、deny剩下的1个，且其他合格人脸都不admit被deny的属性
+      - solo：图中有人只admit其中1个、deny其余k-1个，且其他合格人脸都deny这k-1个属性
+      - none：图中所有合格人脸都deny组合中的全部属性
+    duo/solo取图中第一个满足条件的人。
+    """
+
+    # 判定组合只需要这些数组，多进程时存成.npy供子进程mmap
+    ARRAY_NAMES = ("person_picture", "admit_mask", "deny_mask", "picture_any_admit", "picture_all_deny")
+
+    def __init__(self, table: FaceAttrTable, min_face_area: float = 0.03):
+        self.table = table
+        self.pictures: List[Picture] = table.pictures
+        eligible = table.has_face_box & (table.face_area > min_face_area)
+        self.person_picture = table.person_picture[eligible]
+        self.admit_mask = table.admit_mask[eligible]
+        # 和逐人判定一致：已经admit的属性不再算作deny
+        self.deny_mask = table.deny_mask[eligible] & ~self.admit_mask
+        # 按图片归并：图中任一合格人脸admit的位，以及所有合格人脸都deny的位（没有合格人脸时视为全部deny）
+        self.picture_any_admit = np.zeros(len(self.pictures), dtype=np.uint64)
+        np.bitwise_or.at(self.picture_any_admit, self.person_picture, self.admit_mask)
+        self.picture_all_deny = np.full(len(self.pictures), np.iinfo(np.uint64).max, dtype=np.uint64)
+        np.bitwise_and.at(self.picture_all_deny, self.person_picture, self.deny_mask)
+        self.occurrence = np.zeros(len(self.pictures), dtype=np.int64)
+
+    def save(self, directory: str):
+        """把判定用的数组写到directory下"""
+        for name in self.ARRAY_NAMES:
+            np.save(os.path.join(directory, f"{name}.npy"), getattr(self, name))
+
+    @classmethod
+    def load(cls, directory: str) -> "FaceAttrCombinationEngine":
+        """以只读mmap方式打开save写出的数组，得到只能judge、不能to_pictures的引擎"""
+        engine = cls.__new__(cls)
+        engine.table = None
+        engine.pictures = None
+        for name in cls.ARRAY_NAMES:
+            setattr(engine, name, np.load(os.path.join(directory, f"{name}.npy"), mmap_mode="r"))
+        engine.occurrence = np.zeros(len(engine.picture_any_admit), dtype=np.int64)
+        return engine
+
+    def _first_per_picture(self, persons: np.ndarray):
+        """persons是按人排序的合格人脸下标，返回每张图片第一个候选人的下标"""
+        _, first = np.unique(self.person_picture[persons], return_index=True)
+        return persons[first]
+
+    def _has_fullfit(self, combo_mask: int) -> bool:
+        mask = np.uint64(combo_mask)
+        return bool(np.any((self.admit_mask & mask) == mask))
+
+    def candidate_combinations(self, k: int) -> List[tuple]:
+        """逐层（Apriori）生成可能有fullfit图片的k元属性组合
+
+        fullfit要求同一个人admit组合中的全部属性，所以只要某个子组合没有fullfit，它的所有超集也不会有。
+        第j层只由第j-1层都有fullfit的组合拼接得到，且要求所有(j-1)元子组合都在上一层中；
+        结果按FACE_ATTR_NAMES的字典序排列，和itertools.combinations的顺序一致。
+        """
+        level = [(index,) for index in range(len(FACE_ATTR_NAMES)) if self._has_fullfit(1 << index)]
+        for size in range(2, k + 1):
+            previous = set(level)
+            candidates = []
+            for i, left in enumerate(level):
+                for right in level[i + 1:]:
+                    if left[:-1] != right[:-1]:
+                        break
+                    combo = left + right[-1:]
+                    if all(combo[:j] + combo[j + 1:] in previous for j in range(size - 2)):
+                        candidates.append(combo)
+            if size < k:
+                candidates = [combo for combo in candidates if self._has_fullfit(sum(1 << index for index in combo))]
+            level = candidates
+        return [tuple(FACE_ATTR_NAMES[index] for index in combo) for combo in level]
+
+    def judge(self, combo: Sequence[str]) -> Optional[Dict[str, np.ndarray]]:
+        """判定一个属性组合，没有fullfit图片时返回None，不计入出现次数
+
+        Returns:
+            {"combo": 组合, "combo_mask": 组合掩码, "fullfit": 图片下标, "none": 图片下标, "duo"/"solo": 每张图片选中的合格人脸下标}
+        """
+        combo_mask = np.uint64(sum(1 << FACE_ATTR_INDEX[name] for name in combo))
+        k = len(combo)
+        admit = self.admit_mask & combo_mask
+        admit_count = _popcount(admit)
+        person_picture = self.person_picture
+
+        fullfit = np.unique(person_picture[admit_count == k])
+        if len(fullfit) == 0:
+            return None
+        deny = self.deny_mask & combo_mask
+        deny_count = _popcount(deny)
+
+        # duo：被deny的那一位，图中不能有合格人脸admit它（候选人自己没有admit它）
+        duo = np.flatnonzero((admit_count == k - 1) & (deny_count == 1))
+        duo = duo[(self.picture_any_admit[person_picture[duo]] & deny[duo]) == 0]
+        duo = self._first_per_picture(duo)
+
+        # solo：被deny的k-1位，图中所有合格人脸（包括候选人自己）都要deny它们
+        solo = np.flatnonzero((admit_count == 1) & (deny_count == k - 1))
+        solo = solo[(self.picture_all_deny[person_picture[solo]] & deny[solo]) == deny[solo]]
+        solo = self._first_per_picture(solo)
+
+        none = np.flatnonzero((self.picture_all_deny & combo_mask) == combo_mask)
+        return {"combo": tuple(combo), "combo_mask": combo_mask, "fullfit": fullfit, "duo": duo, "solo": solo, "none": none}
+
+    def record(self, domain: Dict[str, np.ndarray]):
+        """把一个组合判定出的四类图片计入出现次数"""
+        self.occurrence[domain["fullfit"]] += 1
+        self.occurrence[self.person_picture[domain["duo"]]] += 1
+        self.occurrence[self.person_picture[domain["solo"]]] += 1
+        self.occurrence[domain["none"]] += 1
+
+    def evaluate(self, combo: Sequence[str]) -> Optional[Dict[str, np.ndarray]]:
+        """判定一个属性组合并计入出现次数，没有fullfit图片时返回None"""
+        domain = self.judge(combo)
+        if domain is not None:
+            self.record(domain)
+        return domain
+
+    def evaluate_all(self, combos: List[tuple], workers: int = 1, shard_size: int = 256, record: bool = True) -> Iterator[Tuple[tuple, Optional[Dict[str, np.ndarray]]]]:
+        """按combos的顺序逐个产出(组合, 判定结果)，record为True时计入出现次数
+
+        workers大于1时把组合切成分片交给进程池，子进程从临时目录mmap判定用的数组，不需要传图片列表；
+        结果按提交顺序取回、在主进程里计入出现次数，所以和串行运行完全一致。
+        """
+        shards = [combos[i:i + shard_size] for i in range(0, len(combos), shard_size)]
+        if workers <= 1 or len(shards) <= 1:
+            for combo in combos:
+                yield combo, self.evaluate(combo) if record else self.judge(combo)
+            return
+
+        def merge(shard, results):
+            for combo, domain in zip(shard, results):
+                if domain is not None and record:
+                    self.record(domain)
+                yield combo, domain
+
+        with tempfile.TemporaryDirectory(prefix="face_attr_engine_") as directory:
+            self.save(directory)
+            with ProcessPoolExecutor(max_workers=workers, initializer=_init_engine_worker, initargs=(directory,)) as executor:
+                # 限制在途分片数，避免判定结果堆积在内存里
+                pending = deque()
+                for shard in shards:
+                    pending.append((shard, executor.submit(_judge_shard, shard)))
+                    if len(pending) >= workers * 2:
+                        done_shard, future = pending.popleft()
+                        yield from merge(done_shard, future.result())
+                while pending:
+                    done_shard, future = pending.popleft()
+                    yield from merge(done_shard, future.result())
+
+    @staticmethod
+    def _shared_pairs(combo: Sequence[str]):
+        """每个组合的duo/solo只有k种(admit, deny)取值，按被deny/被admit的那一位共享同一对不可变集合"""
+        duo_pairs = {}
+        solo_pairs = {}
+        for name in combo:
+            bit = 1 << FACE_ATTR_INDEX[name]
+            others = frozenset(other for other in combo if other != name)
+            duo_pairs[bit] = (others, frozenset([name]))
+            solo_pairs[bit] = (frozenset([name]), others)
+        return duo_pairs, solo_pairs
+
+    def candidate_pairs(self, domain: Dict[str, np.ndarray], kind: str):
+        """duo/solo候选人的(图片下标数组, 被deny/被admit的那一位数组, {位: (admit集合, deny集合)})"""
+        persons = domain[kind]
+        duo_pairs, solo_pairs = self._shared_pairs(domain["combo"])
+        if kind == "duo":
+            return self.person_picture[persons], self.deny_mask[persons] & domain["combo_mask"], duo_pairs
+        return self.person_picture[persons], self.admit_mask[persons] & domain["combo_mask"], solo_pairs
+
+    def to_pictures(self, domain: Dict[str, np.ndarray]):
+        """把evaluate的结果转换成图片列表和(图片, admit集合, deny集合)元组"""
+        pictures = self.pictures
+        result = {
+            "fullfit": [pictures[i] for i in domain["fullfit"].tolist()],
+            "none": [pictures[i] for i in domain["none"].tolist()],
+        }
+        for kind in ("duo", "solo"):
+            indices, bits, pairs = self.candidate_pairs(domain, kind)
+            result[kind] = [(pictures[i], *pairs[bit]) for i, bit in zip(indices.tolist(), bits.tolist())]
+        return result
+
+    def merge_occurrence(self, picture_occurrence: Dict[Picture, int]):
+        """把累计的出现次数合并进生成器的picture_occurrence"""
+        for i in np.flatnonzero(self.occurrence).tolist():
+            picture = self.pictures[i]
+            picture_occurrence[picture] = picture_occurrence.get(picture, 0) + int(self.occurrence[i])
+        self.occurrence[:] = 0
+
+def _lowest_penalty(penalty: np.ndarray, k: int) -> np.ndarray:
+    """惩罚值最小的k个下标，和sorted(range(n), key=penalty.__getitem__)[:k]一致（相等时保持原顺序），用argpartition代替全排序"""
+    if k >= len(penalty):
+        return np.argsort(penalty, kind="stable")
+    threshold = penalty[np.argpartition(penalty, k - 1)[k - 1]]
+    below = np.flatnonzero(penalty < threshold)
+    ties = np.flatnonzero(penalty == threshold)[:k - len(below)]
+    chosen = np.concatenate([below, ties])
+    return chosen[np.argsort(penalty[chosen], kind="stable")]
+
+# 进程池子进程中的引擎，由_init_engine_worker在进程启动时打开
+_worker_engine: Optional[FaceAttrCombinationEngine] = None
+
+def _init_engine_worker(directory: str):
+    global _worker_engine
+    _worker_engine = FaceAttrCombinationEngine.load(directory)
+
+def _judge_shard(combos: List[tuple]):
+    return [_worker_engine.judge(combo) for combo in combos]
 
 class MultiFaceFeatureQuestionGenerator(QuestionGenerator):
     """多图人脸特征题型生成器"""
+
+    MIN_COMBO_SIZE = 2
+    MAX_COMBO_SIZE = 5
+
+    def __init__(self, dataset_pictures, combo_size: int = 3, workers: int = 1):
+        """
+        Args:
+            dataset_pictures: 图片列表
+            combo_size: 每道题组合的人脸属性个数，取值2~5
+            workers: 判定属性组合使用的进程数，1为串行
+        """
+        super().__init__(dataset_pictures)
+        if not self.MIN_COMBO_SIZE <= combo_size <= self.MAX_COMBO_SIZE:
+            raise ValueError(f"combo_size需要在{self.MIN_COMBO_SIZE}到{self.MAX_COMBO_SIZE}之间，当前为{combo_size}")
+        self.combo_size = combo_size
+        self.workers = workers
     
     def filter_pictures(self):
         """过滤符合条件的图片"""
@@ -22,135 +270,56 @@ class MultiFaceFeatureQuestionGenerator(QuestionGenerator):
         print(f"Filtered down to {len(filtered_pictures)} records after applying face feature criteria.")
         return filtered_pictures
     
+    def _candidate_combinations(self, engine: FaceAttrCombinationEngine):
+        """逐层剪枝得到可能有fullfit的combo_size元组合"""
+        candidates = engine.candidate_combinations(self.combo_size)
+        print(f"{len(candidates)} of {math.comb(len(FACE_ATTR_NAMES), self.combo_size)} {self.combo_size}-attribute combinations survived pruning.")
+        return candidates
+
     def _process_attribute_combinations(self, filtered_pictures):
-        """处理人脸属性组合"""
+        """处理人脸属性组合
+
+        Returns:
+            (引擎, {组合: 引擎判定结果})，判定结果可以用engine.to_pictures转换成图片列表
+        """
+        engine = FaceAttrCombinationEngine(get_face_attr_table(filtered_pictures))
         combine_domains = {}
         cnt = 0
-        
-        # 遍历FACE_ATTR_NAMES中任意三个特征组成的三元组，添加rich进度条
-        for combo in track(itertools.combinations(FACE_ATTR_NAMES, 3), description="Processing face attribute combinations..."):
-            # 过滤符合条件的图片:图中存在一人符合三元组
-            fullfit_filtered = self._find_fullfit_pictures(filtered_pictures, combo)
-            
-            if len(fullfit_filtered) == 0:
-                continue
 
-            # 过滤符合条件的图片:图中存在一人（a）仅符合三元组中任意两个条件
-            duo_filtered = self._find_duo_pictures(filtered_pictures, combo)
-            
-            # 过滤符合条件的图片：图中存在一人（a）仅符合三元组中任意一个条件
-            solo_filtered = self._find_solo_pictures(filtered_pictures, combo)
-            
-            # 过滤符合条件的图片：图中所有人都否定了所有的属性
-            none_filtered = self._find_none_pictures(filtered_pictures, combo)
-
-            if len(fullfit_filtered) + len(duo_filtered) + len(solo_filtered) + len(none_filtered) == 0:
+        # 逐个判定剪枝后的组合，添加rich进度条
+        candidates = self._candidate_combinations(engine)
+        for combo, domain in track(engine.evaluate_all(candidates, workers=self.workers), description="Processing face attribute combinations...", total=len(candidates)):
+            if domain is None:
                 continue
-
-            combine_domains[frozenset(combo)] = {
-                "fullfit": fullfit_filtered,
-                "duo": duo_filtered,
-                "solo": solo_filtered,
-                "none": none_filtered
-            }
+            combine_domains[frozenset(combo)] = domain
             cnt += 1
             if cnt % 1000 == 0:
                 print(f"Processed {cnt} combinations so far.")
-        
-        return combine_domains
-    
-    def _find_fullfit_pictures(self, filtered_pictures, combo):
-        """找出完全符合三元组属性的图片"""
-        fullfit_filtered = []
-        for picture in filtered_pictures:
-            found = False
-            for person in picture.persons:
-                # 只考虑有面部框且面部区域占比超过3%的人
-                if person.face_box is not None and person.face_area() > 0.03:
-                    # 检查该人是否同时具备三元组中的所有属性
-                    has_all_attrs = True
-                    for attr in combo:
-                        if attr not in person.get_face_attr_admit_list():
-                            has_all_attrs = False
-                            break
-                    if has_all_attrs:
-                        found = True
-                        break
-            if found:
-                fullfit_filtered.append(picture)
-                self.picture_occurrence[picture] = self.picture_occurrence.get(picture, 0) + 1
-        return fullfit_filtered
-    
-    def _find_duo_pictures(self, filtered_pictures, combo):
-        """找出符合两个属性、否定一个属性的图片"""
-        duo_filtered = []
-        for picture in filtered_pictures:
-            found = False
-            for person in picture.persons:
-                if person.face_box is not None and person.face_area() > 0.03:
-                    # 检查该人是否同时具备三元组中的任意两个属性，并确定要否定的属性
-                    admit_count = 0
-                    admit_subset = set()
-                    deny_attr = None
-                    for attr in combo:
-                        if attr in person.get_face_attr_admit_list():
-                            admit_count += 1
-                            admit_subset.add(attr)
-                        elif attr in person.get_face_attr_deny_list():
-                            deny_attr = attr
-                    if admit_count == 2 and deny_attr is not None:
-                        # 检查其他人是否都否定了deny_attr
-                        if all(deny_attr not in other_person.get_face_attr_admit_list() 
-                               for other_person in picture.persons 
-                               if (other_person != person and other_person.face_box is not None and other_person.face_area() > 0.03)):
-                            found = True
-                            break
-            if found:
-                duo_filtered.append((picture, admit_subset, set([deny_attr])))
-                self.picture_occurrence[picture] = self.picture_occurrence.get(picture, 0) + 1
-        return duo_filtered
-    
-    def _find_solo_pictures(self, filtered_pictures, combo):
-        """找出符合一个属性、否定两个属性的图片"""
-        solo_filtered = []
-        for picture in filtered_pictures:
-            found = False
-            for person in picture.persons:
-                if person.face_box is not None and person.face_area() > 0.03:
-                    # 检查该人是否同时具备三元组中的任意一个属性，并确定要否定的属性
-                    admit_count = 0
-                    admit_attr = None
-                    deny_attrs = set()
-                    for attr in combo:
-                        if attr in person.get_face_attr_admit_list():
-                            admit_count += 1
-                            admit_attr = attr
-                        elif attr in person.get_face_attr_deny_list():
-                            deny_attrs.add(attr)
-                    if admit_count == 1 and (len(deny_attrs) == 2):
-                        # 检查其他人是否都否定了deny_attr
-                        if all(other_person.get_face_attr_deny_list().issuperset(deny_attrs)
-                               for other_person in picture.persons 
-                               if (other_person != person and other_person.face_box is not None and other_person.face_area() > 0.03)):
-                            found = True
-                            break
-            if found:
-                solo_filtered.append((picture, set([admit_attr]), deny_attrs))
-                self.picture_occurrence[picture] = self.picture_occurrence.get(picture, 0) + 1
-        return solo_filtered
-    
-    def _find_none_pictures(self, filtered_pictures, combo):
-        """找出所有人都否定所有属性的图片"""
-        none_filtered = []
-        deny_attrs = set(combo)
-        for picture in filtered_pictures:
-            if all(other_person.get_face_attr_deny_list().issuperset(deny_attrs)
-                   for other_person in picture.persons
-                   if (other_person.face_box is not None and other_person.face_area() > 0.03)):
-                none_filtered.append(picture)
-                self.picture_occurrence[picture] = self.picture_occurrence.get(picture, 0) + 1
-        return none_filtered
-    
+
+        engine.merge_occurrence(self.picture_occurrence)
+        return engine, combine_domains
+
+    def _iter_questions(self, filtered_pictures):
+        """流式产出每个组合的题目列表，不在内存中保留所有组合的判定结果
+
+        惩罚值依赖所有组合累计的出现次数，所以先完整判定一遍只累计出现次数，
+        再重新判定每个组合、当场出题，产出的内容和顺序与generate_questions一致。
+        """
+        engine = FaceAttrCombinationEngine(get_face_attr_table(filtered_pictures))
+        candidates = self._candidate_combinations(engine)
+        for _ in track(engine.evaluate_all(candidates, workers=self.workers), description="Counting face attribute occurrences...", total=len(candidates)):
+            pass
+        engine.merge_occurrence(self.picture_occurrence)
+
+        occurrence = self._occurrence_array(engine)
+        for combo, domain in track(engine.evaluate_all(candidates, workers=self.workers, record=False), description="Processing face attribute combinations...", total=len(candidates)):
+            if domain is not None:
+                yield self._domain_questions(engine, occurrence, frozenset(combo), domain)
+
+    def _occurrence_array(self, engine: FaceAttrCombinationEngine) -> np.ndarray:
+        """按属性表图片顺序排列的picture_occurrence"""
+        return np.array([self.picture_occurrence.get(picture, 0) for picture in engine.pictures], dtype=np.int64)
+
     def _calculate_penalty(self, **kwargs):
         """计算图片的惩罚值"""
         confidence = 0
@@ -164,50 +333,74 @@ class MultiFaceFeatureQuestionGenerator(QuestionGenerator):
         occurrence = self.picture_occurrence.get(picture, 0)
         return occurrence * (1 - confidence)
     
+    def _domain_questions(self, engine: FaceAttrCombinationEngine, occurrence: np.ndarray, combine, domain):
+        """把一个组合的判定结果转换成题目
+
+        惩罚值和_calculate_penalty相同，但对所有候选一次性用属性矩阵算出，再用部分选择取惩罚最小的若干个，
+        只有被选中的候选才转换成图片。
+        """
+        table = engine.table
+        fullfit = domain["fullfit"]
+        none = domain["none"]
+        duo_pictures, duo_bits, duo_pairs = engine.candidate_pairs(domain, "duo")
+        solo_pictures, solo_bits, solo_pairs = engine.candidate_pairs(domain, "solo")
+        # 任何一类图片为空都凑不出题目
+        if not (len(fullfit) and len(duo_pictures) and len(solo_pictures) and len(none)):
+            return []
+
+        def penalty(pictures, admit_attrs=(), deny_attrs=()):
+            return occurrence[pictures] * (1 - table.picture_confidence(pictures, admit_attrs, deny_attrs))
+
+        def pair_penalty(pictures, bits, pairs):
+            result = np.empty(len(pictures), dtype=np.float64)
+            for bit, (admit_attrs, deny_attrs) in pairs.items():
+                selected = bits == bit
+                if selected.any():
+                    result[selected] = penalty(pictures[selected], admit_attrs, deny_attrs)
+            return result
+
+        if len(fullfit) > 10:
+            fullfit = fullfit[_lowest_penalty(penalty(fullfit, admit_attrs=combine), 10)]
+        if len(duo_pictures) > len(fullfit):
+            duo = _lowest_penalty(pair_penalty(duo_pictures, duo_bits, duo_pairs), len(fullfit))
+        else:
+            duo = np.resize(np.arange(len(duo_pictures)), len(fullfit))
+        if len(solo_pictures) > 10:
+            solo = _lowest_penalty(pair_penalty(solo_pictures, solo_bits, solo_pairs), 10)
+        else:
+            solo = np.resize(np.arange(len(solo_pictures)), len(fullfit))
+        if len(none) > 10:
+            none = none[_lowest_penalty(penalty(none, deny_attrs=combine), 10)]
+        else:
+            none = np.resize(none, len(fullfit))
+
+        pictures = engine.pictures
+        questions = []
+        for fullfit_index, duo_index, solo_index, none_index in zip(fullfit.tolist(), duo.tolist(), solo.tolist(), none.tolist()):
+            question = {
+                "type": "multi_face_feature",
+                "combine": list(combine),
+                "fullfit": pictures[fullfit_index].image_path(),
+                "duo": pictures[duo_pictures[duo_index]].image_path(),
+                "duo_admit": list(duo_pairs[int(duo_bits[duo_index])][0]),
+                "solo": pictures[solo_pictures[solo_index]].image_path(),
+                "solo_admit": list(solo_pairs[int(solo_bits[solo_index])][0]),
+                "none": pictures[none_index].image_path()
+            }
+            questions.append(question)
+        return questions
+
     def generate_questions(self):
         """生成多图人脸特征题目"""
         filtered_pictures = self.filter_pictures()
-        combine_domains = self._process_attribute_combinations(filtered_pictures)
+        engine, combine_domains = self._process_attribute_combinations(filtered_pictures)
+        occurrence = self._occurrence_array(engine)
         
         # 取得出题用的数据，准备往模板里填充
         questions = []
         cnt = 0
         for combine, domain in combine_domains.items():
-            fullfit_pictures = domain["fullfit"]
-            duo_pictures = domain["duo"]
-            solo_pictures = domain["solo"]
-            none_pictures = domain["none"]
-            
-            if len(fullfit_pictures) > 10:
-                fullfit_pictures = sorted(fullfit_pictures, key=lambda pic: self._calculate_penalty(picture=pic, admit_attrs=combine), reverse=False)[:10]
-            if len(duo_pictures) > len(fullfit_pictures):
-                duo_pictures = sorted(duo_pictures, key=lambda item: self._calculate_penalty(picture=item[0], admit_attrs=item[1], deny_attrs=item[2]), reverse=False)[:len(fullfit_pictures)]
-            else:
-                duo_pictures = duo_pictures * (len(fullfit_pictures) // len(duo_pictures) + 1)
-                duo_pictures = duo_pictures[:len(fullfit_pictures)]
-            if len(solo_pictures) > 10:
-                solo_pictures = sorted(solo_pictures, key=lambda item: self._calculate_penalty(picture=item[0], admit_attrs=item[1], deny_attrs=item[2]), reverse=False)[:10]
-            else:
-                solo_pictures = solo_pictures * (len(fullfit_pictures) // len(solo_pictures) + 1)
-                solo_pictures = solo_pictures[:len(fullfit_pictures)]
-            if len(none_pictures) > 10:
-                none_pictures = sorted(none_pictures, key=lambda pic: self._calculate_penalty(picture=pic, deny_attrs=combine), reverse=False)[:10]
-            else:
-                none_pictures = none_pictures * (len(fullfit_pictures) // len(none_pictures) + 1)
-                none_pictures = none_pictures[:len(fullfit_pictures)]
-
-            for fullfit_pic, duo_pic, solo_pic, none_pic in zip(fullfit_pictures, duo_pictures, solo_pictures, none_pictures):
-                question = {
-                    "type": "multi_face_feature",
-                    "combine": list(combine),
-                    "fullfit": fullfit_pic.image_path(),
-                    "duo": duo_pic[0].image_path(),
-                    "duo_admit": list(duo_pic[1]),
-                    "solo": solo_pic[0].image_path(),
-                    "solo_admit": list(solo_pic[1]),
-                    "none": none_pic.image_path()
-                }
-                questions.append(question)
+            questions.extend(self._domain_questions(engine, occurrence, combine, domain))
             cnt += 1
             if cnt % 2000 == 0:
                 with open("questions_partial.json", "w") as f:
@@ -215,3 +408,25 @@ class MultiFaceFeatureQuestionGenerator(QuestionGenerator):
                 print(f"Generated {len(questions)} questions so far.")
         
         return questions
+
+    def stream_questions(self, filename):
+        """流式生成多图人脸特征题目并逐题写入filename，内存中只保留出现次数
+
+        写出的文件和generate_questions后再save_questions得到的完全一致。
+
+        Returns:
+            生成的题目数
+        """
+        filtered_pictures = self.filter_pictures()
+        count = 0
+        with open(filename, "w") as f:
+            f.write("[")
+            for domain_questions in self._iter_questions(filtered_pictures):
+                for question in domain_questions:
+                    # 和json.dump(questions, f, indent=4)的排版保持一致
+                    f.write(",\n" if count else "\n")
+                    f.write(textwrap.indent(json.dumps(question, indent=4, default=set_default), "    "))
+                    count += 1
+            f.write("\n]" if count else "]")
+        print(f"Generated {count} questions and saved to {filename}")
+        return count
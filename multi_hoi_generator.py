@@ -1,38 +1,123 @@
 import json
 import os
-from typing import Dict, List
-import itertools
-import concurrent.futures
-import threading
-from test_framework import QuestionGenerator, POSITION_INCLUDE_MAP, POSITION_EXCLUDE_MAP, POSITION_SIMPLIFIER
-from utils import ask_question
-from sentence_transformers import SentenceTransformer, util
+from typing import Dict, Iterable, List, Optional, Set
+from test_framework import QuestionGenerator, Picture, POSITION_INCLUDE_MAP, POSITION_EXCLUDE_MAP, POSITION_SIMPLIFIER
+from utils import ask_question_async, llm_call_label, llm_map
+from synonyms import PAIR_BATCH_SIZE, SynonymTable, judge_pair_batch, pair_batches, report_candidate_recall
+from embedding_cache import EmbeddingCache, similar_pairs, similar_pairs_of_rows, top_k_similar_pairs
+from sentence_transformers import SentenceTransformer
 
+SENTENCE_MODEL_NAME = "all-MiniLM-L6-v2"
+# 句向量余弦相似度低于该值的词对直接判为非同义词，不交给大模型
+SYNONYM_SIMILARITY_THRESHOLD = 0.2
+
+
+class HoiIndex:
+    """HOI倒排索引，在filter_pictures之后对图片列表构建一次
+
+    交互按图片顺序、full_hoi顺序编号，hoi_picture[i]是第i个交互所在图片的编号。
+      - hoi_objects/hoi_actions/hoi_positions：物体可能名、动作、化简后的部位 -> 含有它的交互编号
+      - picture_objects/picture_actions/picture_positions：图片的物体名、图中所有交互的动作和部位 -> 图片编号
+    """
+
+    def __init__(self, pictures: List[Picture]):
+        self.pictures = pictures
+        self.picture_index: Dict[Picture, int] = {picture: i for i, picture in enumerate(pictures)}
+        self.hoi_picture: List[int] = []
+        self.hoi_objects: Dict[str, Set[int]] = {}
+        self.hoi_actions: Dict[str, Set[int]] = {}
+        self.hoi_positions: Dict[str, Set[int]] = {}
+        self.picture_objects: Dict[str, Set[int]] = {}
+        self.picture_actions: Dict[str, Set[int]] = {}
+        self.picture_positions: Dict[str, Set[int]] = {}
+        for picture_id, picture in enumerate(pictures):
+            for hoi in picture.full_hoi():
+                hoi_id = len(self.hoi_picture)
+                self.hoi_picture.append(picture_id)
+                for postings, picture_postings, keys in ((self.hoi_objects, None, hoi.get_object_name_set()),
+                                                         (self.hoi_actions, self.picture_actions, hoi.get_actions()),
+                                                         (self.hoi_positions, self.picture_positions, hoi.get_positions())):
+                    for key in keys:
+                        postings.setdefault(key, set()).add(hoi_id)
+                        if picture_postings is not None:
+                            picture_postings.setdefault(key, set()).add(picture_id)
+            for name in picture.object_name_set:
+                self.picture_objects.setdefault(name, set()).add(picture_id)
+        print(f"Indexed {len(self.hoi_picture)} HOIs in {len(pictures)} pictures.")
+
+    @staticmethod
+    def _union(postings: Dict[str, Set[int]], keys: Iterable[str]) -> Set[int]:
+        result = set()
+        for key in keys:
+            result |= postings.get(key, set())
+        return result
+
+    def match(self, objs=None, actions=None, positions=None, exclude_objs=None, exclude_actions=None, exclude_positions=None, exclude_picture: Optional[Picture] = None) -> List[Picture]:
+        """按图片顺序返回满足条件的图片，参数为None表示不限制
+
+        图片需要有一个交互同时命中objs/actions/positions中的某一个、且不含任何exclude_*；
+        此外图片的物体名不能落在exclude_objs中，图中所有交互的动作和部位都不能落在exclude_actions/exclude_positions中。
+        """
+        hois = None
+        for postings, keys in ((self.hoi_objects, objs), (self.hoi_actions, actions), (self.hoi_positions, positions)):
+            if keys is None:
+                continue
+            matched = self._union(postings, keys)
+            hois = matched if hois is None else hois & matched
+        if hois is None:
+            hois = set(range(len(self.hoi_picture)))
+        for postings, keys in ((self.hoi_objects, exclude_objs), (self.hoi_actions, exclude_actions), (self.hoi_positions, exclude_positions)):
+            if keys is not None and hois:
+                hois -= self._union(postings, keys)
+
+        pictures = {self.hoi_picture[hoi_id] for hoi_id in hois}
+        for postings, keys in ((self.picture_objects, exclude_objs), (self.picture_actions, exclude_actions), (self.picture_positions, exclude_positions)):
+            if keys is not None and pictures:
+                pictures -= self._union(postings, keys)
+        if exclude_picture is not None:
+            pictures.discard(self.picture_index.get(exclude_picture))
+        return [self.pictures[i] for i in sorted(pictures)]
 
 
 class MultiImageHoiFeatureQuestionGenerator(QuestionGenerator):
     """多图人-物交互特征题型生成器"""
-    def __init__(self, dataset_pictures):
+    def __init__(self, dataset_pictures, synonym_top_k: Optional[int] = None, pair_batch_size: int = PAIR_BATCH_SIZE):
+        """
+        Args:
+            dataset_pictures: 图片列表
+            synonym_top_k: 构建同义词词典时每个词只和句向量最相似的这么多个词配对，None为穷举所有词对
+            pair_batch_size: 每次请求判定的词对数，1为逐对提问
+        """
         super().__init__(dataset_pictures)
+        self.synonym_top_k = synonym_top_k
+        self.pair_batch_size = pair_batch_size
         self.synonym_dict = {}
-        self.sentence_model = SentenceTransformer("all-MiniLM-L6-v2")
+        self.synonyms = SynonymTable(self.synonym_dict)
+        self._sentence_model = None
+        self.embedding_cache = EmbeddingCache(SENTENCE_MODEL_NAME)
         self.word_embs = {}
         self.position_include_map = POSITION_INCLUDE_MAP
         self.position_exclude_map = POSITION_EXCLUDE_MAP
+        self.hoi_index: Optional[HoiIndex] = None
 
 
     
 
+    @property
+    def sentence_model(self):
+        """句向量模型，第一次需要编码新词时才加载"""
+        if self._sentence_model is None:
+            self._sentence_model = SentenceTransformer(SENTENCE_MODEL_NAME)
+        return self._sentence_model
+
     def generate_questions(self):
+        if self.hoi_index is None:
+            self.hoi_index = HoiIndex(self.dataset_pictures)
         questions = []
         def synonym_expand(word_list):
-            result = set(word_list)
-            for word in word_list:
-                result.update(self.synonym_dict.get(word, []))
-            return result
+            return self.synonyms.expand(word_list)
 
         def find_hoi_match(objs=None, actions=None, positions=None, exclude_objs=None, exclude_actions=None, exclude_positions=None, exclude_picture=None):
-            results = []
             if objs is not None:
                 objs = synonym_expand(objs)
             if actions is not None:
@@ -58,40 +143,7 @@ class MultiImageHoiFeatureQuestionGenerator(QuestionGenerator):
                 if exclude_actions is not None:
                     exclude_actions = synonym_expand(exclude_actions)
 
-            for picture in self.dataset_pictures:
-                has_match = False
-                for hoi in picture.full_hoi():
-                    if exclude_picture is not None and picture == exclude_picture:
-                        continue
-                    if objs is not None and len(objs & set(hoi.get_object_names())) == 0:
-                        continue
-                    if actions is not None and len(actions & set(hoi.get_actions())) == 0:
-                        continue
-                    if positions is not None and len(positions & set(hoi.get_positions())) == 0:
-                        continue
-                    if exclude_objs is not None and len(exclude_objs & set(hoi.get_object_names())) > 0:
-                        continue
-                    if exclude_actions is not None and len(exclude_actions & set(hoi.get_actions())) > 0:
-                        continue
-                    if exclude_positions is not None and len(exclude_positions & set(hoi.get_positions())) > 0:
-                        continue
-                    has_match = True
-                    break
-                if not has_match:
-                    continue
-                for hoi in picture.full_hoi():
-                    if exclude_objs is not None and len(exclude_objs & set(picture.object_names())) > 0:
-                        has_match = False
-                        break
-                    if exclude_actions is not None and len(exclude_actions & set(hoi.get_actions())) > 0:
-                        has_match = False
-                        break
-                    if exclude_positions is not None and len(exclude_positions & set(hoi.get_positions())) > 0:
-                        has_match = False
-                        break
-                if has_match:
-                    results.append(picture)
-            return results
+            return self.hoi_index.match(objs, actions, positions, exclude_objs, exclude_actions, exclude_positions, exclude_picture)
 
         for idx, picture in enumerate(self.dataset_pictures):
             for person in picture.persons:
@@ -129,10 +181,10 @@ class MultiImageHoiFeatureQuestionGenerator(QuestionGenerator):
                         diff_obj.sort(key=lambda x: self.picture_occurrence.get(x, 0))
                         
                         position_diff = []
-                        happen_to_obj = set(synonym_expand(hoi.get_object_names())) | set(hoi.get_object_names())
+                        happen_to_obj = set(synonym_expand(hoi.get_object_names())) | hoi.get_object_name_set()
                         
                         for p in diff_pos[0].full_hoi():
-                            if len(set(p.get_object_names()) & happen_to_obj) > 0:
+                            if not happen_to_obj.isdisjoint(p.get_object_name_set()):
                                 position_diff.extend(p.get_positions())
 
                         extra_pos_diff = []
@@ -150,7 +202,7 @@ class MultiImageHoiFeatureQuestionGenerator(QuestionGenerator):
                         if len(diff_pos) > 1:
                             diff_ext = diff_pos[1]
                             for p in diff_pos[1].full_hoi():
-                                if len(set(p.get_object_names()) & happen_to_obj) > 0:
+                                if not happen_to_obj.isdisjoint(p.get_object_name_set()):
                                     extra_pos_diff.extend(p.get_positions())
                             q["extra_type"] = "position"
                             q["extra_diff"] = extra_pos_diff
@@ -187,7 +239,7 @@ class MultiImageHoiFeatureQuestionGenerator(QuestionGenerator):
                     object_set.update(hoi.get_object_names())
 
         for obj in picture.hoi_objects:
-            object_set.update(obj.raw_data.get("possible_names", []))
+            object_set.update(obj.possible_names)
 
         print(f"actions: {action_set}")
         print("-"*20)
@@ -195,11 +247,10 @@ class MultiImageHoiFeatureQuestionGenerator(QuestionGenerator):
         print("-"*20)
         print(f"positions: {position_set}")
         print("-"*20)
-        for action in action_set:
-            self.word_embs[action] = self.sentence_model.encode(action, convert_to_tensor=True)
-        for obj in object_set:
-            self.word_embs[obj] = self.sentence_model.encode(obj, convert_to_tensor=True)
+        # 词表整体查缓存，只有新词才分批交给模型编码
+        self.word_embs = self.embedding_cache.encode(sorted(action_set | object_set), lambda texts: self.sentence_model.encode(texts, batch_size=256, convert_to_numpy=True))
         self._construct_synonym_dict(object_set, action_set)
+        self.synonyms = SynonymTable(self.synonym_dict)
 
     def filter_pictures(self):
         """过滤符合条件的图片"""
@@ -210,13 +261,12 @@ class MultiImageHoiFeatureQuestionGenerator(QuestionGenerator):
                 filtered_pictures.append(picture)
         print(f"Filtered down to {len(filtered_pictures)} records for multi-person clothing feature questions.")
         self.dataset_pictures = filtered_pictures
+        self.hoi_index = HoiIndex(filtered_pictures)
         self._construct_infos()
         return filtered_pictures
     
     def _construct_synonym_dict(self, name_list, action_list):
-        """构建同义词词典，使用16个并发线程，支持增量更新"""
-        # 创建线程锁保护共享资源
-        lock = threading.Lock()
+        """构建同义词词典，并发请求数由llm_limiter自适应控制，支持增量更新"""
         cnt = 0
         
         # 读取已有的同义词字典文件
@@ -233,12 +283,9 @@ class MultiImageHoiFeatureQuestionGenerator(QuestionGenerator):
         # 合并已有数据到当前实例
         self.synonym_dict.update(existing_synonyms)
         
-        def process_name_combination(combo):
+        async def process_name_combination(combo):
             name1, name2 = combo
-            if util.cos_sim(self.word_embs[name1], self.word_embs[name2]).item() < 0.2:
-                ans = "no"
-            else:
-                ans = ask_question(f"'{name1}' and '{name2}' are words discribing two objects. Please analyze their meanings and decide if they are looking alike, of same meaning, or one of them can be a part of the other visually. At the end of your answer, please put a single line of 'yes' if they are some kind of synonymous or might have some visual belonging relationship as said, put 'no' if they are not.")
+            ans = await ask_question_async(f"'{name1}' and '{name2}' are words discribing two objects. Please analyze their meanings and decide if they are looking alike, of same meaning, or one of them can be a part of the other visually. At the end of your answer, please put a single line of 'yes' if they are some kind of synonymous or might have some visual belonging relationship as said, put 'no' if they are not.")
             yes_idx = ans[::-1].lower().find("yes"[::-1])
             no_idx = ans[::-1].lower().find("no"[::-1])
             if yes_idx == -1:
@@ -250,12 +297,9 @@ class MultiImageHoiFeatureQuestionGenerator(QuestionGenerator):
                 print(yes_idx, no_idx)
             return (name1, name2, yes_idx < no_idx)
 
-        def process_action_combination(combo):
+        async def process_action_combination(combo):
             action1, action2 = combo
-            if util.cos_sim(self.word_embs[action1], self.word_embs[action2]).item() < 0.2:
-                ans = "no"
-            else:
-                ans = ask_question(f"'{action1}' and '{action2}' are words discribing two actions for human to interact with objects. Please analyze their meanings and decide if they are possoible look alike in static images, of same meaning, or one of them belong to the other. At the end of your answer, please put a single line of 'yes' if they might look alike as said or 'no' if they are not.")
+            ans = await ask_question_async(f"'{action1}' and '{action2}' are words discribing two actions for human to interact with objects. Please analyze their meanings and decide if they are possoible look alike in static images, of same meaning, or one of them belong to the other. At the end of your answer, please put a single line of 'yes' if they might look alike as said or 'no' if they are not.")
             yes_idx = ans[::-1].lower().find("yes"[::-1])
             no_idx = ans[::-1].lower().find("no"[::-1])
             if yes_idx == -1:
@@ -266,6 +310,12 @@ class MultiImageHoiFeatureQuestionGenerator(QuestionGenerator):
                 print(ans)
                 print(yes_idx, no_idx)
             return (action1, action2, yes_idx < no_idx)
+
+        async def judge_name_batch(batch):
+            return await judge_pair_batch(batch, "words discribing two objects", "if they are looking alike, of same meaning, or one of them can be a part of the other visually", process_name_combination)
+
+        async def judge_action_batch(batch):
+            return await judge_pair_batch(batch, "words discribing two actions for human to interact with objects", "if they possibly look alike in static images, of same meaning, or one of them belong to the other", process_action_combination)
         
         def combination_already_processed(item1, item2):
             """检查组合是否已经处理过"""
@@ -274,6 +324,21 @@ class MultiImageHoiFeatureQuestionGenerator(QuestionGenerator):
                 return True
             return False
         
+        def candidate_combinations(words):
+            """句向量相似度不低于阈值、且没有处理过的词对，顺序和itertools.combinations相同
+
+            设置了synonym_top_k时只保留每个词最相似的synonym_top_k个邻居，并在抽样词上报告相对穷举结果的召回率。
+            """
+            words = list(words)
+            vectors = [self.word_embs[word] for word in words]
+            if self.synonym_top_k is None:
+                pairs = similar_pairs(vectors, SYNONYM_SIMILARITY_THRESHOLD)
+            else:
+                pairs = top_k_similar_pairs(vectors, self.synonym_top_k, SYNONYM_SIMILARITY_THRESHOLD)
+                report_candidate_recall(f"Top-{self.synonym_top_k} embedding neighbours", pairs, len(words), lambda rows: similar_pairs_of_rows(vectors, rows, SYNONYM_SIMILARITY_THRESHOLD))
+            print(f"{len(pairs)} of {len(words) * (len(words) - 1) // 2} pairs passed the similarity prefilter.")
+            return [(words[i], words[j]) for i, j in pairs.tolist() if not combination_already_processed(words[i], words[j])]
+
         # 初始化字典
         for name in name_list:
             if name not in self.synonym_dict:
@@ -283,61 +348,57 @@ class MultiImageHoiFeatureQuestionGenerator(QuestionGenerator):
             if action not in self.synonym_dict:
                 self.synonym_dict[action] = []
 
-        # 处理名称组合，跳过已处理的组合
-        name_combinations = [combo for combo in itertools.combinations(name_list, 2) 
-                           if not combination_already_processed(combo[0], combo[1])]
+        # 处理相似度过线的名称组合，跳过已处理的组合
+        name_combinations = candidate_combinations(name_list)
         total_name_combinations = len(name_combinations)
         
         print(f"Found {total_name_combinations} new name combinations to process.")
         
         if total_name_combinations > 0:
-            with concurrent.futures.ThreadPoolExecutor(max_workers=16) as executor:
-                future_to_combo = {executor.submit(process_name_combination, combo): combo for combo in name_combinations}
-                
-                for future in concurrent.futures.as_completed(future_to_combo):
-                    name1, name2, is_synonym = future.result()
-                    
-                    with lock:
-                        if is_synonym:
-                            self.synonym_dict[name1].append(name2)
-                            self.synonym_dict[name2].append(name1)
-                        
-                        cnt += 1
-                        print(f"Processed {cnt}/{total_name_combinations} name combinations so far.")
-                        if cnt % 2000 == 0:
-                            
-                            with open("hoi_synonym_dict.json", "w") as f:
-                                json.dump({
-                                    "synonyms": self.synonym_dict,
-                                }, f)
+            def merge_name_results(index, batch, results):
+                nonlocal cnt
+                for name1, name2, is_synonym in results:
+                    if is_synonym:
+                        self.synonym_dict[name1].append(name2)
+                        self.synonym_dict[name2].append(name1)
+
+                    cnt += 1
+                    print(f"Processed {cnt}/{total_name_combinations} name combinations so far.")
+                    if cnt % 2000 == 0:
+
+                        with open("hoi_synonym_dict.json", "w") as f:
+                            json.dump({
+                                "synonyms": self.synonym_dict,
+                            }, f)
+
+            with llm_call_label("hoi object names"):
+                llm_map(judge_name_batch, pair_batches(name_combinations, self.pair_batch_size), on_result=merge_name_results)
         
-        # 处理动作组合，跳过已处理的组合
-        action_combinations = [combo for combo in itertools.combinations(action_list, 2) 
-                            if not combination_already_processed(combo[0], combo[1])]
+        # 处理相似度过线的动作组合，跳过已处理的组合
+        action_combinations = candidate_combinations(action_list)
         total_action_combinations = len(action_combinations)
         processed_actions = 0
 
         print(f"Found {total_action_combinations} new action combinations to process.")
 
         if total_action_combinations > 0:
-            with concurrent.futures.ThreadPoolExecutor(max_workers=16) as executor:
-                future_to_combo = {executor.submit(process_action_combination, combo): combo for combo in action_combinations}
-                
-                for future in concurrent.futures.as_completed(future_to_combo):
-                    action1, action2, is_synonym = future.result()
-
-                    with lock:
-                        if is_synonym:
-                            self.synonym_dict[action1].append(action2)
-                            self.synonym_dict[action2].append(action1)
-
-                        processed_actions += 1
-                        if processed_actions % 100 == 0:  # 更频繁地保存，避免丢失进度
-                            print(f"Processed {processed_actions}/{total_action_combinations} action combinations so far.")
-                            with open("hoi_synonym_dict.json", "w") as f:
-                                json.dump({
-                                    "synonyms": self.synonym_dict
-                                }, f)
+            def merge_action_results(index, batch, results):
+                nonlocal processed_actions
+                for action1, action2, is_synonym in results:
+                    if is_synonym:
+                        self.synonym_dict[action1].append(action2)
+                        self.synonym_dict[action2].append(action1)
+
+                    processed_actions += 1
+                    if processed_actions % 100 == 0:  # 更频繁地保存，避免丢失进度
+                        print(f"Processed {processed_actions}/{total_action_combinations} action combinations so far.")
+                        with open("hoi_synonym_dict.json", "w") as f:
+                            json.dump({
+                                "synonyms": self.synonym_dict
+                            }, f)
+
+            with llm_call_label("hoi actions"):
+                llm_map(judge_action_batch, pair_batches(action_combinations, self.pair_batch_size), on_result=merge_action_results)
         
         # 最终保存
         with open("hoi_synonym_dict.json", "w") as f:
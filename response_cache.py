@@ -0,0 +1,108 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from typing import Optional
+
+RESPONSE_CACHE_PATH = os.getenv("LLM_CACHE_PATH", "llm_response_cache.sqlite")
+RESPONSE_CACHE_MAX_BYTES = int(os.getenv("LLM_CACHE_MAX_BYTES", str(2 * 1024 ** 3)))
+# 命中时last_used比这更旧才更新，淘汰只需要粗略的使用时间，大部分读取不用写库
+TOUCH_INTERVAL_SECONDS = 3600
+
+# 一张表保存 {请求哈希: 回答}；size是回答的字节数，last_used用于按最近使用淘汰。
+# WAL模式下多个进程/线程可以同时读，写入互相排队，不会读到写了一半的记录
+
+
+def cache_key(request: dict) -> str:
+    """请求内容（模型、消息、解码参数）的sha256，字典按键排序后序列化，和参数顺序无关"""
+    payload = json.dumps(request, sort_keys=True, ensure_ascii=False, separators=(",", ":"))
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class ResponseCache:
+    """磁盘上的LLM回答缓存（SQLite + WAL），每个线程使用自己的连接"""
+
+    def __init__(self, path: str = RESPONSE_CACHE_PATH, max_bytes: int = RESPONSE_CACHE_MAX_BYTES):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._written_since_check = 0
+
+    def _connection(self) -> sqlite3.Connection:
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=60, isolation_level=None)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS responses ("
+                "key TEXT PRIMARY KEY, response TEXT NOT NULL, size INTEGER NOT NULL, last_used REAL NOT NULL)"
+            )
+            connection.execute("CREATE INDEX IF NOT EXISTS responses_last_used ON responses(last_used)")
+            self._local.connection = connection
+        return connection
+
+    def get(self, key: str) -> Optional[str]:
+        connection = self._connection()
+        row = connection.execute("SELECT response, last_used FROM responses WHERE key = ?", (key,)).fetchone()
+        with self._lock:
+            if row is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        if row is None:
+            return None
+        response, last_used = row
+        now = time.time()
+        if now - last_used > TOUCH_INTERVAL_SECONDS:
+            connection.execute("UPDATE responses SET last_used = ? WHERE key = ?", (now, key))
+        return response
+
+    def put(self, key: str, response: str):
+        size = len(response.encode("utf-8"))
+        self._connection().execute(
+            "INSERT OR REPLACE INTO responses (key, response, size, last_used) VALUES (?, ?, ?, ?)",
+            (key, response, size, time.time()),
+        )
+        with self._lock:
+            self._written_since_check += size
+            check = self._written_since_check > self.max_bytes // 20
+            if check:
+                self._written_since_check = 0
+        if check:
+            self.evict()
+
+    def evict(self):
+        """总大小超过max_bytes时，从最久未使用的记录开始删除，直到降到max_bytes的90%"""
+        connection = self._connection()
+        total = connection.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        target = total - int(self.max_bytes * 0.9)
+        freed = 0
+        keys = []
+        for key, size in connection.execute("SELECT key, size FROM responses ORDER BY last_used"):
+            keys.append((key,))
+            freed += size
+            if freed >= target:
+                break
+        connection.executemany("DELETE FROM responses WHERE key = ?", keys)
+        print(f"LLM response cache: evicted {len(keys)} entries ({freed} bytes).")
+
+    def stats(self) -> dict:
+        entries, total = self._connection().execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM responses").fetchone()
+        with self._lock:
+            hits, misses = self.hits, self.misses
+        lookups = hits + misses
+        return {
+            "hits": hits,
+            "misses": misses,
+            "hit_rate": hits / lookups if lookups else 0.0,
+            "entries": entries,
+            "bytes": total,
+        }
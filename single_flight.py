@@ -0,0 +1,95 @@
+import asyncio
+import threading
+from typing import Awaitable, Callable, Dict, Hashable, Tuple, TypeVar
+
+T = TypeVar("T")
+
+
+class _Call:
+    __slots__ = ("done", "result", "error")
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight:
+    """合并同时进行的相同请求：同一个key只有第一个调用真正执行，其余调用等待并共享它的结果（或异常）
+
+    线程和协程分开合并：do供同步代码使用，do_async只合并同一个事件循环中的协程。
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls: Dict[Hashable, _Call] = {}
+        self._async_calls: Dict[Tuple[asyncio.AbstractEventLoop, Hashable], asyncio.Future] = {}
+        self.executed = 0
+        self.shared = 0
+
+    def do(self, key: Hashable, fn: Callable[[], T]) -> T:
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+                self.executed += 1
+            else:
+                self.shared += 1
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+        try:
+            call.result = fn()
+            return call.result
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+
+    async def do_async(self, key: Hashable, fn: Callable[[], Awaitable[T]]) -> T:
+        loop = asyncio.get_running_loop()
+        while True:
+            with self._lock:
+                future = self._async_calls.get((loop, key))
+                leader = future is None
+                if leader:
+                    future = self._async_calls[(loop, key)] = loop.create_future()
+                    # 没有等待者时也标记异常已读取，避免"exception was never retrieved"警告
+                    future.add_done_callback(lambda f: f.cancelled() or f.exception())
+                    self.executed += 1
+                else:
+                    self.shared += 1
+            if leader:
+                break
+            try:
+                return await asyncio.shield(future)
+            except asyncio.CancelledError:
+                # 执行者被取消时自己重新发起；自己被取消时照常抛出
+                if not future.cancelled():
+                    raise
+                with self._lock:
+                    self.shared -= 1
+        try:
+            result = await fn()
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        else:
+            future.set_result(result)
+            return result
+        finally:
+            with self._lock:
+                del self._async_calls[(loop, key)]
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"executed": self.executed, "shared": self.shared}
@@ -0,0 +1,267 @@
+import asyncio
+import json
+import os
+import random
+from collections import Counter
+from functools import lru_cache
+from typing import Awaitable, Callable, Dict, FrozenSet, Iterable, List, Optional, Set, Tuple
+
+import numpy as np
+
+from utils import ask_question_async
+
+# expand结果缓存的词集合个数上限，词集合来自数据集中的标注，超过后按最近最少使用淘汰
+EXPAND_CACHE_SIZE = 65536
+
+# ================== 编译后的同义词表 ==================
+
+class SynonymTable:
+    """编译后的同义词词典，判定和扩展都是O(1)查表
+
+    词典格式和 hoi_synonym_dict.json / clothing_synonym_dict.json 的 "synonyms" 字段相同：{词: [同义词, ...]}，
+    "a是b的同义词"指a出现在词典中b的列表里。每个词分配一个整数编号：
+      - 如果词典已经是等价关系（经过make_synonyms_transitive.py处理，每个词的列表恰好是所在连通分量中的其他词），
+        同一连通分量的词共享一个类编号，判定只比较类编号；
+      - 否则为每个词保留一份邻居编号集合，判定时查集合。
+    """
+
+    def __init__(self, synonym_dict: Dict[str, List[str]]):
+        self.synonym_dict = synonym_dict
+        self.term_id: Dict[str, int] = {}
+        for word, synonym_list in synonym_dict.items():
+            self._id(word)
+            for synonym in synonym_list:
+                self._id(synonym)
+        self.neighbors: List[FrozenSet[int]] = [frozenset()] * len(self.term_id)
+        for word, synonym_list in synonym_dict.items():
+            self.neighbors[self.term_id[word]] = frozenset(self.term_id[synonym] for synonym in synonym_list)
+        self.class_id: Optional[List[int]] = self._equivalence_classes()
+        self._expand = lru_cache(maxsize=EXPAND_CACHE_SIZE)(self._expand_uncached)
+
+    def _id(self, term: str) -> int:
+        if term not in self.term_id:
+            self.term_id[term] = len(self.term_id)
+        return self.term_id[term]
+
+    def _equivalence_classes(self) -> Optional[List[int]]:
+        """按连通分量分配类编号；词典不是等价关系时返回None"""
+        class_id = [-1] * len(self.term_id)
+        members: List[List[int]] = []
+        for start in range(len(self.term_id)):
+            if class_id[start] != -1:
+                continue
+            class_id[start] = len(members)
+            component = [start]
+            for current in component:
+                for neighbor in self.neighbors[current]:
+                    if class_id[neighbor] == -1:
+                        class_id[neighbor] = class_id[start]
+                        component.append(neighbor)
+            members.append(component)
+        for component in members:
+            component_set = frozenset(component)
+            for term in component:
+                if self.neighbors[term] != component_set - {term}:
+                    return None
+        return class_id
+
+    def are_synonyms(self, a: str, b: str, reflexive: bool = True) -> bool:
+        """a是否是b的同义词；reflexive为True时同一个词也算同义词"""
+        if a == b and reflexive:
+            return True
+        a_id = self.term_id.get(a)
+        b_id = self.term_id.get(b)
+        if a_id is None or b_id is None:
+            return False
+        if self.class_id is not None:
+            # 等价关系下列表里不含词本身
+            return a_id != b_id and self.class_id[a_id] == self.class_id[b_id]
+        return a_id in self.neighbors[b_id]
+
+    def _expand_uncached(self, terms: FrozenSet[str]) -> FrozenSet[str]:
+        result = set(terms)
+        for term in terms:
+            result.update(self.synonym_dict.get(term, []))
+        return frozenset(result)
+
+    def expand(self, terms: Iterable[str]) -> FrozenSet[str]:
+        """词本身加上词典中列出的所有同义词（不做传递闭包），结果按词集合缓存"""
+        return self._expand(frozenset(terms))
+
+
+_tables: Dict[str, tuple] = {}
+
+def load_synonym_table(path: str) -> SynonymTable:
+    """读取并编译同义词词典文件，同一文件未修改时复用已编译的结果"""
+    mtime_ns = os.stat(path).st_mtime_ns
+    cached = _tables.get(path)
+    if cached is None or cached[0] != mtime_ns:
+        with open(path, "r", encoding="utf-8") as f:
+            cached = (mtime_ns, SynonymTable(json.load(f)["synonyms"]))
+        _tables[path] = cached
+    return cached[1]
+
+
+# ================== 同义词候选词对 ==================
+
+RECALL_SAMPLE_SIZE = 200
+
+
+def _token_grams(token: str, n: int) -> Set[str]:
+    """单词的字符n-gram，短于n的单词整体作为一个gram"""
+    if len(token) < n:
+        return {token}
+    return {token[i:i + n] for i in range(len(token) - n + 1)}
+
+
+def ngram_candidate_pairs(terms: List[str], top_k: int, n: int = 3, max_postings: int = 1000) -> np.ndarray:
+    """字符n-gram分块：每个词只和"包含它的单词"最多的top_k个词组成候选词对
+
+    一个单词的所有n-gram都出现在另一个词里，近似于该单词是另一个词的子串（两个服饰生成器判断"单词重叠"的方式）；
+    包含这些n-gram的词由倒排表求交得到，出现在超过max_postings个词中的n-gram区分度太低，不参与求交。
+    返回去重后的 (i, j)，i < j，按 (i, j) 排序。
+    """
+    term_tokens = [[_token_grams(token, n) for token in dict.fromkeys(term.lower().split())] for term in terms]
+    postings: Dict[str, Set[int]] = {}
+    for i, tokens in enumerate(term_tokens):
+        for grams in tokens:
+            for gram in grams:
+                postings.setdefault(gram, set()).add(i)
+    pairs = set()
+    for i, tokens in enumerate(term_tokens):
+        contained = Counter()
+        for grams in tokens:
+            selective = sorted((postings[gram] for gram in grams if len(postings[gram]) <= max_postings), key=len)
+            if not selective:
+                continue
+            matched = set(selective[0])
+            for posting in selective[1:]:
+                matched &= posting
+            contained.update(matched)
+        contained.pop(i, None)
+        # 包含的单词越多越靠前，相同时优先较短的词
+        ranked = sorted(contained.items(), key=lambda item: (-item[1], len(terms[item[0]]), item[0]))
+        for j, _ in ranked[:top_k]:
+            pairs.add((min(i, j), max(i, j)))
+    return np.array(sorted(pairs), dtype=np.int64).reshape(-1, 2)
+
+
+def overlap_pairs(terms: List[str], n: int = 3) -> np.ndarray:
+    """所有"一方的某个单词是另一方的子串"的词对，和两个服饰生成器的wording_overlap判定完全一致（区分大小写）
+
+    不枚举所有词对：长度不小于n的单词，用它的n-gram倒排表求交得到候选，再逐个确认子串关系；
+    更短的单词直接查所有词中单词的短子串倒排表（单词不含空白，是某个词的子串当且仅当是其中某个单词的子串）。
+    返回 (i, j)，i < j，按 (i, j) 排序，即itertools.combinations的顺序。
+    """
+    term_tokens = [list(dict.fromkeys(term.split())) for term in terms]
+    gram_postings: Dict[str, Set[int]] = {}
+    short_postings: Dict[str, Set[int]] = {}
+    for i, tokens in enumerate(term_tokens):
+        for token in tokens:
+            for start in range(len(token)):
+                for length in range(1, n):
+                    if start + length <= len(token):
+                        short_postings.setdefault(token[start:start + length], set()).add(i)
+                if start + n <= len(token):
+                    gram_postings.setdefault(token[start:start + n], set()).add(i)
+    pairs = set()
+    for i, tokens in enumerate(term_tokens):
+        for token in tokens:
+            if len(token) < n:
+                matched = short_postings.get(token, set())
+            else:
+                grams = sorted((gram_postings[token[start:start + n]] for start in range(len(token) - n + 1)), key=len)
+                candidates = set(grams[0])
+                for posting in grams[1:]:
+                    candidates &= posting
+                matched = [j for j in candidates if token in terms[j]]
+            for j in matched:
+                if j != i:
+                    pairs.add((min(i, j), max(i, j)))
+    return np.array(sorted(pairs), dtype=np.int64).reshape(-1, 2)
+
+
+def report_candidate_recall(label: str, candidate_pairs: np.ndarray, n_terms: int, reference_pairs_of: Callable[[List[int]], Iterable[Tuple[int, int]]], sample_size: int = RECALL_SAMPLE_SIZE, seed: int = 0) -> float:
+    """在抽样的词上估计候选词对相对穷举方法的召回率并打印
+
+    Args:
+        label: 打印用的名称
+        candidate_pairs: 分块得到的 (i, j) 词对
+        n_terms: 词表大小
+        reference_pairs_of: 给定抽样词的下标列表，返回穷举方法会保留的、包含其中某个词的 (i, j) 词对
+    """
+    rows = random.Random(seed).sample(range(n_terms), min(sample_size, n_terms))
+    sampled = set(rows)
+    reference = {(min(i, j), max(i, j)) for i, j in reference_pairs_of(rows)}
+    candidates = {(i, j) for i, j in candidate_pairs.tolist() if i in sampled or j in sampled}
+    if not reference:
+        print(f"{label}: no exhaustive pairs among {len(rows)} sampled terms, recall not measured.")
+        return 1.0
+    hit = len(reference & candidates)
+    print(f"{label}: recall {hit / len(reference):.1%} ({hit}/{len(reference)} exhaustive pairs over {len(rows)} sampled terms).")
+    return hit / len(reference)
+
+
+# ================== 批量判定同义词对 ==================
+
+PAIR_BATCH_SIZE = 20
+
+
+def pair_batches(pairs: List[tuple], batch_size: int) -> List[List[tuple]]:
+    """把词对按batch_size切分成批，batch_size不大于1时每个词对单独一批（即逐对提问）"""
+    batch_size = max(1, batch_size or 1)
+    return [pairs[start:start + batch_size] for start in range(0, len(pairs), batch_size)]
+
+
+def batch_pair_prompt(pairs: List[tuple], subject: str, criterion: str) -> str:
+    """把多个词对编号后放进一个问题，要求以JSON对象 {编号: "yes"/"no"} 回答"""
+    lines = "\n".join(f"{i}. '{a}' and '{b}'" for i, (a, b) in enumerate(pairs, 1))
+    return (
+        f"Each numbered line below is a pair of {subject}. For every pair, consider their meanings and decide {criterion}.\n\n"
+        f"{lines}\n\n"
+        f"Reply with only a JSON object that maps every line number from 1 to {len(pairs)} to \"yes\" if the pair is this kind of synonymous "
+        f"or \"no\" if it is not, for example {{\"1\": \"yes\", \"2\": \"no\"}}."
+    )
+
+
+def parse_batch_verdicts(ans: str, n_pairs: int) -> Dict[int, bool]:
+    """从批量回答中取出 {编号: 是否同义}，编号越界、答案不是yes/no的条目直接忽略"""
+    start, end = ans.find("{"), ans.rfind("}")
+    if start == -1 or end <= start:
+        return {}
+    try:
+        data = json.loads(ans[start:end + 1])
+    except json.JSONDecodeError:
+        return {}
+    if not isinstance(data, dict):
+        return {}
+    verdicts = {}
+    for key, value in data.items():
+        try:
+            index = int(key)
+        except (TypeError, ValueError):
+            continue
+        if isinstance(value, str):
+            value = value.strip().lower()
+        if not 1 <= index <= n_pairs:
+            continue
+        if value in ("yes", True):
+            verdicts[index] = True
+        elif value in ("no", False):
+            verdicts[index] = False
+    return verdicts
+
+
+async def judge_pair_batch(pairs: List[tuple], subject: str, criterion: str, judge_single: Callable[[tuple], Awaitable[tuple]]) -> List[tuple]:
+    """一次请求判定一批词对，返回 [(词1, 词2, 是否同义), ...]
+
+    批量回答中缺失或无法解析的词对交给异步的judge_single并发地逐个提问（也就是原来的单对判定函数），只有一个词对时直接逐对提问。
+    """
+    if len(pairs) == 1:
+        return [await judge_single(pairs[0])]
+    verdicts = parse_batch_verdicts(await ask_question_async(batch_pair_prompt(pairs, subject, criterion), json_format=True), len(pairs))
+    missing = [pair for i, pair in enumerate(pairs, 1) if i not in verdicts]
+    if missing:
+        print(f"{len(missing)} of {len(pairs)} pairs missing from the batched verdicts, asking them one by one.")
+    singles = iter(await asyncio.gather(*(judge_single(pair) for pair in missing)))
+    return [(a, b, verdicts[i]) if i in verdicts else next(singles) for i, (a, b) in enumerate(pairs, 1)]
@@ -1,12 +1,12 @@
 import json
 import os
-from copy import deepcopy
 import pickle
-from typing import Dict, List, Set, Tuple
+from typing import Dict, FrozenSet, List, Set, Tuple
 import numpy as np
-from functools import cache
+from functools import wraps
 
 from utils import ask_question, key_points_to_bounding_box, bounding_box_iou
+from dataset_store import DatasetStore, compile_dataset, ingest_json_files, sync_store, STORE_DIRNAME, DETAILING_FLAGS, HEADPOSE_KEYS
 from thefuzz import fuzz
 
 DATASET_PATH = os.getenv("DATASET_PATH", "./final_labeling")
@@ -14,6 +14,7 @@ DATASET_PATH = os.getenv("DATASET_PATH", "./final_labeling")
 FACE_ATTR_NAMES = ['5 oClock Shadow', 'Arched Eyebrows', 'Attractive', 'Bags Under Eyes', 'Bald', 'Bangs', 'Big Lips', 'Big Nose', 'Black Hair', 'Blond Hair', 'Blurry', 'Brown Hair', 'Bushy Eyebrows', 'Chubby', 'Double Chin', 'Eyeglasses', 'Goatee', 'Gray Hair', 'Heavy Makeup', 'High Cheekbones', 'Male', 'Mouth Slightly Open', 'Mustache', 'Narrow Eyes', 'No Beard', 'Oval Face', 'Pale Skin', 'Pointy Nose', 'Receding Hairline', 'Rosy Cheeks', 'Sideburns', 'Smiling', 'Straight Hair', 'Wavy Hair', 'Wearing Earrings', 'Wearing Hat', 'Wearing Lipstick', 'Wearing Necklace', 'Wearing Necktie', 'Young']
 FACE_ATTR_ADMIT_THRESHOLD = np.array([0.80, 0.70, 0.80, 0.50, 0.20, 0.90,                                   0.70,       0.95,       0.50,        0.50,         0.70,     0.70,         0.80,             0.95,      0.80,         0.92,         0.50,      0.50,        0.75,           0.80,              0.98,   0.995,                0.30,        0.75,         0.98,       0.70,        0.40,        0.40,           0.60,                0.14,         0.60,        0.80,      0.70,            0.70,        0.70,                0.75,         0.60,               0.50,               0.70,              0.98])
 FACE_ATTR_DENY_THRESHOLD =  np.array([0.10, 0.05, 0.02, 0.05, 0.01, 0.05,                                   0.05,       0.05,       0.005,       0.01,         0.05,     0.01,         0.30,             0.40,      0.10,         0.005,        0.02,      0.005,       0.003,          0.01,              0.002,  0.02,                 0.005,       0.08,         0.40,       0.08,        0.004,       0.02,           0.01,                0.001,        0.02,        0.04,      0.05,            0.05,        0.02,                0.001,        0.01,               0.01,               0.001,             0.50])
+FACE_ATTR_INDEX = {name: i for i, name in enumerate(FACE_ATTR_NAMES)}
 POSITION_SIMPLIFIER = {
     'headscarf': "head",
     'shoulder': "body", 
@@ -64,38 +65,144 @@ POSITION_EXCLUDE_MAP = {
 }
 
 
-_full_data = None
+_full_store = None
+# 派生出的不可变集合在图片之间高度重复（词表很小），统一驻留以共享同一份对象
+_interned_values = {}
+_INTERN_LIMIT = 1 << 20
+
+def _intern(value):
+    if len(_interned_values) >= _INTERN_LIMIT:
+        return _interned_values.get(value, value)
+    return _interned_values.setdefault(value, value)
+
+def cached_method(func):
+    """按实例缓存无参方法的结果
+
+    结果存放在实例自己的 _cache 槽里，随实例一起被回收，不会像 functools.cache 那样让实例永远存活；
+    每个实例的缓存条目数以被装饰的方法个数为上限，可以用 invalidate_cache() 清除。
+    """
+    name = func.__name__
+
+    @wraps(func)
+    def wrapper(self):
+        cache = self._cache
+        if cache is None:
+            cache = self._cache = {}
+        if name not in cache:
+            cache[name] = func(self)
+        return cache[name]
+    return wrapper
+
+def clear_caches():
+    """释放模块级缓存：已打开的数据集和驻留的派生集合，之后丢弃图片列表即可真正回收内存"""
+    global _full_store, _face_attr_table
+    _full_store = None
+    _face_attr_table = None
+    _interned_values.clear()
 
 class HoiObject:
+    __slots__ = ("_raw_data", "_picture", "_raw_index", "box", "name", "possible_names", "name_set")
+
     def __init__(self, data):
-        self.raw_data = data
+        self._raw_data = data
+        self._picture = None
+        self._raw_index = None
         self.box = data.get("box", None)
+        self.name = data.get("name", "")
+        self.possible_names = data.get("possible_names", [])
+        self.name_set = _intern(frozenset(self.possible_names))
+
+    @classmethod
+    def from_store(cls, store: DatasetStore, row: int, picture: "Picture", raw_index: int):
+        """从列式数据集读取物体，已删除的物体返回None"""
+        cols = store.columns
+        if cols["object_deleted"][row]:
+            return None
+        self = cls.__new__(cls)
+        self._raw_data = None
+        self._picture = picture
+        self._raw_index = raw_index
+        box = cols["object_box"][row]
+        self.box = None if np.isnan(box[0]) else box.tolist()
+        self.name = store.strings[cols["object_name"][row]]
+        start = int(cols["object_possible_name_start"][row])
+        count = int(cols["object_possible_name_count"][row])
+        self.possible_names = _intern(tuple(store.strings[i] for i in cols["object_possible_name"][start:start + count].tolist()))
+        self.name_set = _intern(frozenset(self.possible_names))
+        return self
+
+    @property
+    def raw_data(self):
+        if self._raw_data is None and self._picture is not None:
+            self._raw_data = self._picture.raw_data["objects"][self._raw_index]
+        return self._raw_data
+
     def get_name(self):
-        return self.raw_data.get("name", "")
+        return self.name
 
 class Hoi:
+    __slots__ = ("_raw_data", "_person", "_raw_index", "obj", "actions", "positions", "position_action_pairs")
+
     def __init__(self, data, obj: HoiObject):
-        self.raw_data = data
+        self._raw_data = data
+        self._person = None
+        self._raw_index = None
         self.obj: HoiObject = obj
+        self._derive([(i[0], i[1]) for i in data.get("action", [])])
+
+    @classmethod
+    def from_store(cls, store: DatasetStore, row: int, person: "Person", obj: HoiObject):
+        cols = store.columns
+        self = cls.__new__(cls)
+        self._raw_data = None
+        self._person = person
+        self._raw_index = int(cols["hoi_raw_index"][row])
+        self.obj = obj
+        start = int(cols["hoi_action_start"][row])
+        count = int(cols["hoi_action_count"][row])
+        self._derive([(store.strings[pos], store.strings[act]) for pos, act in cols["hoi_action"][start:start + count].tolist()])
+        return self
+
+    def _derive(self, action_pairs: List[Tuple[str, str]]):
+        """构造时一次性算好动作、化简后的部位以及部位-动作对，查询时直接返回"""
+        self.actions: FrozenSet[str] = _intern(frozenset(i[1] for i in action_pairs))
+        self.positions: FrozenSet[str] = _intern(frozenset(POSITION_SIMPLIFIER.get(i[0], i[0]) for i in action_pairs))
+        self.position_action_pairs: FrozenSet[Tuple[str, str]] = _intern(frozenset((POSITION_SIMPLIFIER.get(i[0], i[0]), i[1]) for i in action_pairs))
+
+    @property
+    def raw_data(self):
+        if self._raw_data is None and self._person is not None:
+            self._raw_data = self._person.raw_data["hoi"][self._raw_index]["relationship"]
+        return self._raw_data
+
     def get_actions(self):
-        return set([i[1] for i in self.raw_data.get("action", [])])
+        return self.actions
     def get_positions(self):
-        org_pose = set([i[0] for i in self.raw_data.get("action", [])])
-        return set([POSITION_SIMPLIFIER.get(p, p) for p in org_pose])
+        return self.positions
     def get_object_box(self):
         return self.obj.box
     def get_object_names(self):
-        return self.obj.raw_data.get("possible_names", [])
+        return self.obj.possible_names
+    def get_object_name_set(self):
+        return self.obj.name_set
     def get_object_name(self):
-        return self.obj.raw_data.get("name", "")
+        return self.obj.name
     def get_negative_actions(self):
         return self.raw_data.get("negative_action", [])
     def get_position_action_pairs(self):
-        return set((POSITION_SIMPLIFIER.get(i[0], i[0]), i[1]) for i in self.raw_data.get("action", []))
+        return self.position_action_pairs
 
 class Person:
+    __slots__ = ("_raw_data", "_picture", "_raw_index", "_store", "_row", "_has_facex", "_skeleton", "_skeleton_index", "_cache", "hois", "face_box", "body_box")
+
     def __init__(self, data, detect_results):
-        self.raw_data = data
+        self._raw_data = data
+        self._picture = None
+        self._raw_index = None
+        self._store = None
+        self._row = None
+        self._has_facex = bool(data.get("facex_detailing"))
+        self._cache = None
         self.hois: List[Hoi] = []
         if data.get("without_face") is not True and data.get("face_box") is not None:
             self.face_box:List[float] = detect_results["face_boxes"][data.get("face_box")]
@@ -108,9 +215,48 @@ class Person:
             self.body_box = None
 
         if data.get("skeleton") is not None:
-            self.skeleton:List[List[float]] = detect_results["skeletons"][data.get("skeleton")]
+            self._skeleton = detect_results["skeletons"][data.get("skeleton")]
         else:
-            self.skeleton = None
+            self._skeleton = None
+        self._skeleton_index = None
+
+    @classmethod
+    def from_store(cls, store: DatasetStore, row: int, picture: "Picture"):
+        """从列式数据集读取人物，数值特征直接引用内存映射的列，不做拷贝"""
+        cols = store.columns
+        self = cls.__new__(cls)
+        self._raw_data = None
+        self._picture = picture
+        self._raw_index = int(cols["person_raw_index"][row])
+        self._store = store
+        self._row = row
+        face_box = cols["person_face_box"][row]
+        self.face_box = None if np.isnan(face_box[0]) else face_box.tolist()
+        body_box = cols["person_body_box"][row]
+        self.body_box = None if np.isnan(body_box[0]) else body_box.tolist()
+        self._skeleton = None
+        skeleton_index = int(cols["person_skeleton"][row])
+        self._skeleton_index = skeleton_index if skeleton_index >= 0 else None
+        self._has_facex = bool(cols["person_has_facex"][row])
+        self._cache = None
+        self.hois = []
+        start = int(cols["person_hoi_start"][row])
+        for hoi_row in range(start, start + int(cols["person_hoi_count"][row])):
+            obj = picture.hoi_objects[cols["hoi_object"][hoi_row]]
+            self.hois.append(Hoi.from_store(store, hoi_row, self, obj))
+        return self
+
+    @property
+    def raw_data(self):
+        if self._raw_data is None and self._picture is not None:
+            self._raw_data = self._picture.raw_data["persons"][self._raw_index]
+        return self._raw_data
+
+    @property
+    def skeleton(self):
+        if self._skeleton is None and self._skeleton_index is not None:
+            self._skeleton = self._picture.raw_data["detect_results"]["skeletons"][self._skeleton_index]
+        return self._skeleton
 
     def init_hoi_objects(self, objs: list[HoiObject]):
         for hoi in self.raw_data.get("hoi", []):
@@ -120,20 +266,37 @@ class Person:
             if hoi.get("deleted") is not True and objs[hoi.get("object")] is not None:
                 self.hois.append(Hoi(hoi["relationship"], objs[hoi.get("object")]))
 
+    def invalidate_cache(self):
+        """清除本人物的缓存结果，修改了人脸框等字段后需要调用"""
+        self._cache = None
+
     def get_face_box(self):
         return self.raw_data.get("face_box", None)
     
     def detailing_property(self, key, default=None):
+        if self._store is not None and key in DETAILING_FLAGS:
+            value = self._store.detailing_flag(self._row, key)
+            return default if value is None else value
         return self.raw_data.get("qwen_detailing", {}).get(key, default)
 
-    @cache
+    def has_face_attrs(self):
+        """是否有facex属性检测结果"""
+        return self._has_facex
+
+    def get_headpose(self):
+        """头部姿态，包含pitch、yaw、roll"""
+        if self._store is not None:
+            return dict(zip(HEADPOSE_KEYS, self._store.columns["person_headpose"][self._row].tolist()))
+        return self.raw_data["facex_detailing"]["headpose"]
+
+    @cached_method
     def face_area(self):
         """计算人脸区域占整张图片的比例，整张图片大小为1"""
         if self.face_box is not None:
             return (self.face_box[3] - self.face_box[1]) * (self.face_box[2] - self.face_box[0])
         return 0
     
-    @cache
+    @cached_method
     def body_area(self):
         """计算身体区域占整张图片的比例，整张图片大小为1"""
         if self.body_box is not None:
@@ -141,15 +304,21 @@ class Person:
         return 0
 
     def get_face_attr_vec(self, attr_names = None):
-        if self.raw_data.get("facex_detailing"):
+        if self._store is not None and self._has_facex:
+            # 直接返回内存映射列中的一行，不做拷贝
+            face_attr = self._store.columns["person_face_attr"][self._row]
+            if attr_names is not None:
+                return np.array([face_attr[self._store.face_attr_index[name]] if name in self._store.face_attr_index else 0 for name in attr_names])
+            return face_attr
+        if self.has_face_attrs():
             if attr_names is not None:
                 return np.array([self.raw_data["facex_detailing"]["attributes"].get(name, 0) for name in attr_names])
             return np.array([i for i in self.raw_data["facex_detailing"]["attributes"].values()])
         return None
 
-    @cache
+    @cached_method
     def get_face_attr_admit_list(self):
-        if self.raw_data.get("facex_detailing"):
+        if self.has_face_attrs():
             ans = []
             feat_vec = self.get_face_attr_vec()
             admit_vec = feat_vec >= FACE_ATTR_ADMIT_THRESHOLD
@@ -157,9 +326,9 @@ class Person:
             return frozenset(ans)
         return frozenset()
     
-    @cache
+    @cached_method
     def get_face_attr_deny_list(self):
-        if self.raw_data.get("facex_detailing"):
+        if self.has_face_attrs():
             ans = []
             feat_vec = self.get_face_attr_vec()
             deny_vec = feat_vec < FACE_ATTR_ADMIT_THRESHOLD
@@ -168,7 +337,16 @@ class Person:
         return frozenset()
 
     def get_face_attr_assert_belief(self, admit_set, deny_set):
-        if self.raw_data.get("facex_detailing"):
+        if self._store is not None and self._has_facex:
+            face_attr = self._store.columns["person_face_attr"][self._row]
+            index = self._store.face_attr_index
+            result = 1.0
+            for admit in admit_set:
+                result *= face_attr[index[admit]] if admit in index else 0
+            for deny in deny_set:
+                result *= (1 - (face_attr[index[deny]] if deny in index else 0))
+            return float(result)
+        if self.has_face_attrs():
             result = 1.0
             for admit in admit_set:
                 result *= self.raw_data["facex_detailing"]["attributes"].get(admit, 0)
@@ -194,7 +372,7 @@ class Person:
         """获取完整特征集合"""
         feature_set = []
         # 面部特征
-        if self.face_box is not None and self.raw_data.get("facex_detailing") and self.detailing_property("face_seen", False):
+        if self.face_box is not None and self.has_face_attrs() and self.detailing_property("face_seen", False):
             for attr_name, attr_value, accept_thresh, deny_thresh in zip(FACE_ATTR_NAMES, self.get_face_attr_vec(), FACE_ATTR_ADMIT_THRESHOLD, FACE_ATTR_DENY_THRESHOLD):
                 # 只保留纯面部特征，防打架
                 if attr_name not in ['5 oClock Shadow', 'Arched Eyebrows', 'Attractive', 'Bags Under Eyes', 'Bald', 'Bangs', 'Big Lips', 'Big Nose', 'Black Hair', 'Blond Hair', 'Blurry', 'Brown Hair', 'Bushy Eyebrows', 'Chubby', 'Double Chin', 'Goatee', 'Gray Hair', 'Heavy Makeup', 'High Cheekbones', 'Mouth Slightly Open', 'Mustache', 'Narrow Eyes', 'No Beard', 'Oval Face', 'Pale Skin', 'Pointy Nose', 'Receding Hairline', 'Rosy Cheeks', 'Sideburns', 'Smiling', 'Straight Hair', 'Wavy Hair']:
@@ -234,19 +412,20 @@ class Person:
                 if bounding_box_iou(facex_reyebrow, wpose_reyebrow) > 0.5:
                     feature_set.append( {"attr_type":"bbox", "attr_name": "right_eyebrow", "attr_value": facex_reyebrow} )
             # 头部姿态
-            if self.raw_data["facex_detailing"]["headpose"]["pitch"] < -15:
-                feature_set.append( {"attr_type":"facial", "attr_name": "pitch", "attr_value": "down", "real_value": self.raw_data["facex_detailing"]["headpose"]["pitch"]} )
-            elif self.raw_data["facex_detailing"]["headpose"]["pitch"] > 15:
-                feature_set.append( {"attr_type":"facial", "attr_name": "pitch", "attr_value": "up", "real_value": self.raw_data["facex_detailing"]["headpose"]["pitch"]} )
+            headpose = self.get_headpose()
+            if headpose["pitch"] < -15:
+                feature_set.append( {"attr_type":"facial", "attr_name": "pitch", "attr_value": "down", "real_value": headpose["pitch"]} )
+            elif headpose["pitch"] > 15:
+                feature_set.append( {"attr_type":"facial", "attr_name": "pitch", "attr_value": "up", "real_value": headpose["pitch"]} )
             else:
-                feature_set.append( {"attr_type":"facial", "attr_name": "pitch", "attr_value": None, "real_value": self.raw_data["facex_detailing"]["headpose"]["pitch"]} )
+                feature_set.append( {"attr_type":"facial", "attr_name": "pitch", "attr_value": None, "real_value": headpose["pitch"]} )
 
-            if self.raw_data["facex_detailing"]["headpose"]["yaw"] < -15:
-                feature_set.append( {"attr_type":"facial", "attr_name": "yaw", "attr_value": "left", "real_value": self.raw_data["facex_detailing"]["headpose"]["yaw"]} )
-            elif self.raw_data["facex_detailing"]["headpose"]["yaw"] > 15:
-                feature_set.append( {"attr_type":"facial", "attr_name": "yaw", "attr_value": "right", "real_value": self.raw_data["facex_detailing"]["headpose"]["yaw"]} )
+            if headpose["yaw"] < -15:
+                feature_set.append( {"attr_type":"facial", "attr_name": "yaw", "attr_value": "left", "real_value": headpose["yaw"]} )
+            elif headpose["yaw"] > 15:
+                feature_set.append( {"attr_type":"facial", "attr_name": "yaw", "attr_value": "right", "real_value": headpose["yaw"]} )
             else:
-                feature_set.append( {"attr_type":"facial", "attr_name": "yaw", "attr_value": None, "real_value": self.raw_data["facex_detailing"]["headpose"]["yaw"]} )
+                feature_set.append( {"attr_type":"facial", "attr_name": "yaw", "attr_value": None, "real_value": headpose["yaw"]} )
             # 面部全框
             feature_set.append( {"attr_type":"bbox", "attr_name": "face", "attr_value": self.face_box} )
 
@@ -283,8 +462,13 @@ class Person:
         return len(left_hand_items & right_hand_items) > 0
 
 class Picture:
+    __slots__ = ("_raw_data", "_store", "_index", "_image_path", "persons", "hoi_objects", "_full_hoi", "object_name_set")
+
     def __init__(self, data):
-        self.raw_data = data
+        self._raw_data = data
+        self._store = None
+        self._index = None
+        self._image_path = data.get("image_path")
         self.persons:List[Person] = [Person(p, data["detect_results"]) for p in data.get("persons", []) if p.get("deleted") is not True]
         self.hoi_objects: List[HoiObject] = []
         for obj in data.get("objects", []):
@@ -294,15 +478,62 @@ class Picture:
                 self.hoi_objects.append(None)
         for person in self.persons:
             person.init_hoi_objects(self.hoi_objects)
+        self._derive()
+
+    @classmethod
+    def from_store(cls, store: DatasetStore, index: int):
+        """从列式数据集读取图片，原始json只在访问raw_data时才解码"""
+        cols = store.columns
+        self = cls.__new__(cls)
+        self._raw_data = None
+        self._store = store
+        self._index = index
+        self._image_path = store.strings[cols["picture_image_path"][index]]
+        start = int(cols["picture_object_start"][index])
+        self.hoi_objects = [HoiObject.from_store(store, start + k, self, k) for k in range(int(cols["picture_object_count"][index]))]
+        start = int(cols["picture_person_start"][index])
+        self.persons = [Person.from_store(store, row, self) for row in range(start, start + int(cols["picture_person_count"][index]))]
+        self._derive()
+        return self
+
+    def _derive(self):
+        self._full_hoi: Tuple[Hoi, ...] = tuple(hoi for person in self.persons for hoi in person.hois)
+        self.object_name_set: FrozenSet[str] = _intern(frozenset(self.object_names()))
+
+    def drop_raw_data(self):
+        """释放原始json，派生字段已在构造时算好
+
+        从列式数据集读取的图片之后访问raw_data时会按需重新解码；直接由json构造的图片只释放图片级和物体的原始数据，
+        人物和交互仍保留各自的原始数据（服饰、qwen_detailing、negative_action等字段只存在于其中）。
+        """
+        self._raw_data = None
+        for obj in self.hoi_objects:
+            if obj is not None:
+                obj._raw_data = None
+        for person in self.persons:
+            if person._picture is None:
+                continue
+            person._raw_data = None
+            person._skeleton = None
+            for hoi in person.hois:
+                hoi._raw_data = None
+
+    @property
+    def raw_data(self):
+        if self._raw_data is None and self._store is not None:
+            self._raw_data = self._store.picture_raw(self._index)
+        return self._raw_data
 
     def image_path(self):
-        return os.path.join(DATASET_PATH, self.raw_data.get("image_path").split("/")[-1])
+        return os.path.join(DATASET_PATH, self._image_path.split("/")[-1])
 
-    def full_hoi(self):
-        result = []
+    def invalidate_cache(self):
+        """清除图中所有人物的缓存结果"""
         for person in self.persons:
-            result.extend(person.hois)
-        return result
+            person.invalidate_cache()
+
+    def full_hoi(self):
+        return self._full_hoi
 
     def object_names(self):
         result = []
@@ -311,29 +542,155 @@ class Picture:
                 result.append(obj.get_name())
         return result
 
+def get_full_store(workers=None) -> DatasetStore:
+    """打开内存映射的列式数据集，首次调用时编译，之后按manifest增量同步新增、修改和删除的标注文件
+
+    Args:
+        workers: 解析标注json使用的进程数，默认读取环境变量INGEST_WORKERS，再默认为CPU核数
+    """
+    global _full_store
+    if _full_store is not None:
+        return _full_store
+    if workers is None and os.getenv("INGEST_WORKERS"):
+        workers = int(os.getenv("INGEST_WORKERS"))
+    store_path = os.path.join(DATASET_PATH, STORE_DIRNAME)
+    paths = [os.path.join(DATASET_PATH, filename) for filename in sorted(os.listdir(DATASET_PATH)) if filename.endswith(".json")]
+    legacy_path = os.path.join(DATASET_PATH, "full_data.pkl")
+    store = DatasetStore(store_path) if DatasetStore.exists(store_path) else None
+    if store is not None and store.manifest is not None:
+        _full_store, _ = sync_store(store_path, DATASET_PATH, FACE_ATTR_NAMES, workers=workers, store=store)
+    elif paths or not os.path.exists(legacy_path):
+        _full_store, _ = ingest_json_files(paths, store_path, FACE_ATTR_NAMES, workers=workers)
+    else:
+        # 只有旧缓存full_data.pkl时直接迁移，此时没有文件信息，无法增量同步
+        if store is None:
+            with open(legacy_path, "rb") as f:
+                compile_dataset(pickle.load(f), store_path, FACE_ATTR_NAMES)
+            store = DatasetStore(store_path)
+        _full_store = store
+    return _full_store
+
+def get_full_pictures() -> List[Picture]:
+    """从列式数据集构造全部图片对象"""
+    store = get_full_store()
+    return [Picture.from_store(store, i) for i in store.live_indices()]
+
 def get_full_data():
-    global _full_data
-    if _full_data is not None:
-        return _full_data
-    if os.path.exists(os.path.join(DATASET_PATH, "full_data.pkl")):
-        with open(os.path.join(DATASET_PATH, "full_data.pkl"), "rb") as f:
-            _full_data = pickle.load(f)
-            return deepcopy(_full_data)
-    data = []
-    for filename in os.listdir(DATASET_PATH):
-        if filename.endswith(".json"):
-            with open(os.path.join(DATASET_PATH, filename), "r") as f:
-                file_data = json.load(f)
-                data.append(file_data)
-    _full_data = data
-    if not os.path.exists(os.path.join(DATASET_PATH, "full_data.pkl")):
-        with open(os.path.join(DATASET_PATH, "full_data.pkl"), "wb") as f:
-            pickle.dump(_full_data, f)
-    return deepcopy(_full_data)
+    """返回全部图片的原始json，每次调用都从数据集重新解码，调用方可以随意修改"""
+    store = get_full_store()
+    return [store.picture_raw(i) for i in store.live_indices()]
+
+class FaceAttrTable:
+    """全语料的人脸属性表：每个人一行的属性矩阵、admit/deny位掩码以及人物到图片的偏移
+
+    第k个属性对应掩码的第k位，admit/deny的判定规则与 Person.get_face_attr_admit_list / get_face_attr_deny_list 一致，
+    没有facex结果的人两个掩码都为0、属性全为0。
+    """
+
+    def __init__(self, pictures: List[Picture]):
+        self.pictures = pictures
+        self.picture_index: Dict[Picture, int] = {picture: i for i, picture in enumerate(pictures)}
+        self.persons: List[Person] = [person for picture in pictures for person in picture.persons]
+        counts = np.array([len(picture.persons) for picture in pictures], dtype=np.int64)
+        # 第i张图片的人物是 [picture_offsets[i], picture_offsets[i+1]) 这些行
+        self.picture_offsets = np.zeros(len(pictures) + 1, dtype=np.int64)
+        np.cumsum(counts, out=self.picture_offsets[1:])
+        self.person_picture = np.repeat(np.arange(len(pictures), dtype=np.int64), counts)
+
+        n = len(self.persons)
+        values = np.zeros((n, len(FACE_ATTR_NAMES)), dtype=np.float64)
+        self.has_attrs = np.array([person.has_face_attrs() for person in self.persons], dtype=bool)
+        # 同一个数据集的人物直接从列里按行号批量取，其余的逐人取
+        store_rows: Dict[int, Tuple[DatasetStore, List[int], List[int]]] = {}
+        for i, person in enumerate(self.persons):
+            if not self.has_attrs[i]:
+                continue
+            if person._store is not None:
+                entry = store_rows.setdefault(id(person._store), (person._store, [], []))
+                entry[1].append(i)
+                entry[2].append(person._row)
+            else:
+                values[i] = person.get_face_attr_vec(FACE_ATTR_NAMES)
+        for store, indices, rows in store_rows.values():
+            columns = [store.face_attr_index[name] for name in FACE_ATTR_NAMES]
+            values[indices] = store.columns["person_face_attr"][rows][:, columns]
+
+        # 保留float64，阈值比较和置信度乘积都和逐人计算的结果完全一致
+        self.attrs = values
+        admit = (values >= FACE_ATTR_ADMIT_THRESHOLD) & self.has_attrs[:, None]
+        deny = (values < FACE_ATTR_ADMIT_THRESHOLD) & self.has_attrs[:, None]
+        self.admit_mask = self._pack(admit)
+        self.deny_mask = self._pack(deny)
+        self.face_area = np.array([person.face_area() for person in self.persons], dtype=np.float64)
+        self.has_face_box = np.array([person.face_box is not None for person in self.persons], dtype=bool)
+
+    @staticmethod
+    def _pack(bits: np.ndarray) -> np.ndarray:
+        weights = np.left_shift(np.uint64(1), np.arange(bits.shape[1], dtype=np.uint64))
+        return (bits.astype(np.uint64) * weights).sum(axis=1, dtype=np.uint64)
+
+    @staticmethod
+    def mask_of(attr_names) -> int:
+        """把属性名集合转换成位掩码"""
+        mask = 0
+        for name in attr_names:
+            mask |= 1 << FACE_ATTR_INDEX[name]
+        return mask
+
+    @staticmethod
+    def names_of(mask: int) -> FrozenSet[str]:
+        """把位掩码转换回属性名集合"""
+        return frozenset(name for i, name in enumerate(FACE_ATTR_NAMES) if (mask >> i) & 1)
+
+    def person_rows(self, picture: Picture) -> slice:
+        i = self.picture_index[picture]
+        return slice(int(self.picture_offsets[i]), int(self.picture_offsets[i + 1]))
+
+    def assert_belief(self, admit_attrs=(), deny_attrs=(), rows=None) -> np.ndarray:
+        """向量化的 Person.get_face_attr_assert_belief：返回每个人同时满足admit、否定deny的置信度"""
+        attrs = self.attrs if rows is None else self.attrs[rows]
+        has_attrs = self.has_attrs if rows is None else self.has_attrs[rows]
+        belief = np.ones(len(attrs), dtype=np.float64)
+        for name in admit_attrs:
+            belief *= attrs[:, FACE_ATTR_INDEX[name]]
+        for name in deny_attrs:
+            belief *= 1 - attrs[:, FACE_ATTR_INDEX[name]]
+        return np.where(has_attrs, belief, 0)
+
+    def picture_confidence(self, picture_indices: np.ndarray, admit_attrs=(), deny_attrs=()) -> np.ndarray:
+        """向量化的逐图片置信度：每张图片中所有人assert_belief的最大值，不低于0
+
+        乘法顺序和 Person.get_face_attr_assert_belief 相同，结果逐位一致。
+        """
+        starts = self.picture_offsets[picture_indices]
+        counts = self.picture_offsets[picture_indices + 1] - starts
+        segments = np.repeat(np.arange(len(picture_indices)), counts)
+        # 各图片人物行号首尾相接：每段从starts开始连续递增
+        rows = np.repeat(starts - np.cumsum(counts) + counts, counts) + np.arange(counts.sum())
+        result = np.zeros(len(picture_indices), dtype=np.float64)
+        np.maximum.at(result, segments, self.assert_belief(admit_attrs, deny_attrs, rows))
+        return result
+
+    def picture_max(self, person_values: np.ndarray) -> np.ndarray:
+        """把每人一个的数值按图片取最大值，没有人的图片得到0"""
+        result = np.zeros(len(self.pictures), dtype=person_values.dtype)
+        np.maximum.at(result, self.person_picture, person_values)
+        return result
+
+_face_attr_table = None
+
+def get_face_attr_table(pictures: List[Picture]) -> FaceAttrTable:
+    """构建（或复用对同一个图片列表已经构建的）全语料人脸属性表"""
+    global _face_attr_table
+    if _face_attr_table is None or _face_attr_table.pictures is not pictures:
+        _face_attr_table = FaceAttrTable(pictures)
+    return _face_attr_table
 
 def set_default(obj):
-    if isinstance(obj, set):
+    if isinstance(obj, (set, frozenset)):
         return list(obj)
+    if isinstance(obj, (np.ndarray, np.generic)):
+        return obj.tolist()
     raise TypeError
 # ================== 题型生成器基类 ==================
 
@@ -1,6 +1,6 @@
 from dotenv import load_dotenv
 from multi_hoi_generator import MultiImageHoiFeatureQuestionGenerator
-from test_framework import get_full_data, Picture
+from test_framework import get_full_pictures
 from multi_face_feature_generator import MultiFaceFeatureQuestionGenerator
 from multi_clothing_feature_generator import MultiPersonClothingFeatureQuestionGenerator
 from many_person_mixed_feature_generator import ManyPersonMixedFeatureQuestionGenerator
@@ -8,9 +8,8 @@ from many_person_mixed_feature_generator import ManyPersonMixedFeatureQuestionGe
 load_dotenv()
 
 if __name__ == "__main__":
-    full_data = get_full_data()
-    dataset_pictures = [Picture(p) for p in full_data]
-    print(f"Loaded {len(full_data)} records from dataset.")
+    dataset_pictures = get_full_pictures()
+    print(f"Loaded {len(dataset_pictures)} records from dataset.")
 
     # 生成多图人体服装特征题目
     # multi_clothing_generator = MultiPersonClothingFeatureQuestionGenerator(dataset_pictures)
@@ -2,37 +2,252 @@ import numpy as np
 import os
 import cv2 as cv
 import base64
-from openai import OpenAI
+import hashlib
+from collections import OrderedDict
+from typing import Union
 import json
 import time
+import asyncio
+import concurrent.futures
+import functools
+import contextlib
+import contextvars
+import sys
 import requests
 from requests.exceptions import RequestException, ConnectionError, Timeout
 import threading
 import signal
+from response_cache import ResponseCache, cache_key
+from llm_router import EndpointPool, endpoint_urls
+from single_flight import SingleFlight
+from llm_metrics import LLMMetrics
+
+def _resolve(future):
+    if not future.done():
+        future.set_result(None)
+
+def _wake_async(loop, future):
+    """从任意线程唤醒某个事件循环中等待的future，事件循环已关闭时忽略"""
+    try:
+        loop.call_soon_threadsafe(_resolve, future)
+    except RuntimeError:
+        pass
+
+class RetryState:
+    """一次API调用自己的重试状态，并发调用之间互不干扰"""
+    def __init__(self, function_name, max_retries, base_delay, max_delay):
+        self.function_name = function_name
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.attempt = 0
+        self.deadline = self._new_deadline()
+        self.woken = threading.Event()
+        self._async_waiter = None
+
+    def _new_deadline(self):
+        # 和原来逐次退避的总等待时间相同：超过后即使服务没有恢复也放弃
+        return time.monotonic() + sum(self.retry_delay(attempt) for attempt in range(self.max_retries))
+
+    def retry_delay(self, attempt=None):
+        attempt = self.attempt if attempt is None else attempt
+        return min(self.base_delay * (2 ** attempt), self.max_delay)
+
+    def wake(self):
+        """手动重试：重置重试次数，并打断当前的退避等待"""
+        self.attempt = 0
+        self.deadline = self._new_deadline()
+        self.woken.set()
+        waiter = self._async_waiter
+        if waiter is not None:
+            _wake_async(*waiter)
+
+    def sleep(self, delay) -> bool:
+        """等待delay秒，被手动唤醒时提前返回True"""
+        woken = self.woken.wait(delay)
+        self.woken.clear()
+        return woken
+
+    async def sleep_async(self, delay) -> bool:
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._async_waiter = (loop, future)
+        try:
+            if not self.woken.is_set():
+                await asyncio.wait_for(future, delay)
+        except asyncio.TimeoutError:
+            pass
+        finally:
+            self._async_waiter = None
+        woken = self.woken.is_set()
+        self.woken.clear()
+        return woken
+
+class CircuitBreaker:
+    """所有API调用共享的熔断器
+
+    连续failure_threshold次连接失败后熔断：所有调用暂停，冷却结束后只放行一个探测请求，
+    探测成功则全部恢复，失败则冷却时间加倍（不超过max_cooldown）后再探测。
+    同步调用等待在条件变量上，异步调用等待在future上，状态变化时统一唤醒，不轮询。
+    """
+    def __init__(self, failure_threshold=3, base_cooldown=2, max_cooldown=600):
+        self.failure_threshold = failure_threshold
+        self.base_cooldown = base_cooldown
+        self.max_cooldown = max_cooldown
+        self.consecutive_failures = 0
+        self.trips = 0
+        self.open_until = None
+        self.probing = False
+        self._condition = threading.Condition()
+        self._async_waiters = []
+
+    @property
+    def is_open(self):
+        return self.open_until is not None
+
+    def _try_pass(self):
+        """持有锁时调用，返回 (是否放行, 是否为探测请求, 最多等待多少秒)"""
+        if self.open_until is None:
+            return True, False, None
+        remaining = self.open_until - time.monotonic()
+        if remaining <= 0 and not self.probing:
+            self.probing = True
+            return True, True, None
+        return False, False, remaining if remaining > 0 else None
+
+    def _notify(self):
+        self._condition.notify_all()
+        for loop, future in self._async_waiters:
+            _wake_async(loop, future)
+        self._async_waiters = []
+
+    def before_call(self, deadline) -> bool:
+        """阻塞到允许发送请求为止，返回这次请求是否为探测请求；等到deadline仍在熔断则抛出ConnectionError"""
+        with self._condition:
+            while True:
+                allowed, probe, timeout = self._try_pass()
+                if allowed:
+                    return probe
+                left = deadline - time.monotonic()
+                if left <= 0:
+                    raise ConnectionError("服务不可用，已达到最长等待时间")
+                self._condition.wait(left if timeout is None else min(timeout, left))
+
+    async def before_call_async(self, deadline) -> bool:
+        loop = asyncio.get_running_loop()
+        while True:
+            with self._condition:
+                allowed, probe, timeout = self._try_pass()
+                if allowed:
+                    return probe
+                left = deadline - time.monotonic()
+                if left <= 0:
+                    raise ConnectionError("服务不可用，已达到最长等待时间")
+                future = loop.create_future()
+                self._async_waiters.append((loop, future))
+            try:
+                await asyncio.wait_for(future, left if timeout is None else min(timeout, left))
+            except asyncio.TimeoutError:
+                pass
+
+    def record_success(self):
+        """服务有响应（包括非连接类的错误），关闭熔断"""
+        with self._condition:
+            if self.open_until is not None:
+                print("✅ 服务已恢复，继续所有API调用")
+            self.consecutive_failures = 0
+            self.trips = 0
+            self.open_until = None
+            self.probing = False
+            self._notify()
+
+    def record_failure(self, probe):
+        with self._condition:
+            self.consecutive_failures += 1
+            if probe:
+                self.probing = False
+            if probe or (self.open_until is None and self.consecutive_failures >= self.failure_threshold):
+                cooldown = min(self.base_cooldown * (2 ** self.trips), self.max_cooldown)
+                self.trips += 1
+                self.open_until = time.monotonic() + cooldown
+                print(f"⚠️ 连续 {self.consecutive_failures} 次连接失败，暂停所有API调用，{cooldown} 秒后探测服务... (您可以调用 manual_retry() 立即重试)")
+                self._notify()
+
+    def abandon(self, probe):
+        """探测请求被中断（如KeyboardInterrupt、任务取消）时让出探测名额"""
+        if probe:
+            with self._condition:
+                self.probing = False
+                self._notify()
+
+    def reset(self):
+        with self._condition:
+            self.consecutive_failures = 0
+            self.open_until = None
+            self.probing = False
+            self._notify()
 
 class RetryController:
-    """重试控制器，用于手动触发重试"""
+    """重试控制器，登记正在进行的API调用，用于手动触发重试"""
     def __init__(self):
-        self.force_retry = False
-        self.retry_signal = threading.Event()
-        self.current_attempt = 0
-        self.current_function = None
+        self._lock = threading.Lock()
+        self.active = set()
+
+    def start(self, function_name, max_retries, base_delay, max_delay) -> RetryState:
+        state = RetryState(function_name, max_retries, base_delay, max_delay)
+        with self._lock:
+            self.active.add(state)
+        return state
+
+    def finish(self, state):
+        with self._lock:
+            self.active.discard(state)
         
     def trigger_retry(self):
-        """手动触发重试"""
+        """手动触发重试：关闭熔断，所有等待中的调用立即重试并重新计数"""
         print("手动触发重试...")
-        self.force_retry = True
-        self.retry_signal.set()
-        
-    def reset(self):
-        """重置重试状态"""
-        self.force_retry = False
-        self.retry_signal.clear()
-        self.current_attempt = 0
-        self.current_function = None
+        circuit_breaker.reset()
+        with self._lock:
+            states = list(self.active)
+        for state in states:
+            state.wake()
 
-# 全局重试控制器实例
+# 全局重试控制器和熔断器实例，所有API调用共享
 retry_controller = RetryController()
+circuit_breaker = CircuitBreaker()
+
+# LLM调用统计：运行中可在其他线程读取 llm_metrics.snapshot() / llm_metrics.to_prometheus()，结束时 llm_metrics.dump(路径)
+llm_metrics = LLMMetrics()
+# 当前API调用的 (函数名, 调用者)，由重试装饰器设置，请求统计按它分组
+_call_labels = contextvars.ContextVar("llm_call_labels", default=("unknown", "unknown"))
+# 本次尝试的失败是否来自合并到的别人的请求；这种失败已由执行者记入熔断器、端点和重试统计
+_request_shared = contextvars.ContextVar("llm_request_shared", default=False)
+# 生成器用 with llm_call_label("..."): 显式标注的调用者，asyncio任务和llm_map会把它带进并发的请求
+_caller_label = contextvars.ContextVar("llm_caller_label", default=None)
+# 推断调用者时跳过的模块：LLM调用链本身和线程池、事件循环的框架代码
+_INTERNAL_MODULES = {"utils", "synonyms", "single_flight", "llm_router", "llm_metrics", "response_cache", "threading", "functools", "contextlib", "contextvars"}
+_INTERNAL_MODULE_PREFIXES = ("asyncio.", "concurrent.futures.")
+
+@contextlib.contextmanager
+def llm_call_label(label: str):
+    """with llm_call_label("hoi actions"): 期间发出的LLM请求在统计中记为该调用者"""
+    token = _caller_label.set(label)
+    try:
+        yield
+    finally:
+        _caller_label.reset(token)
+
+def _caller_name(frame) -> str:
+    """显式标注的调用者，没有标注时沿调用栈找到第一个不属于LLM调用链和并发框架的函数"""
+    label = _caller_label.get()
+    if label is not None:
+        return label
+    while frame is not None:
+        module = frame.f_globals.get("__name__", "")
+        if module not in _INTERNAL_MODULES and not module.startswith(_INTERNAL_MODULE_PREFIXES):
+            return frame.f_code.co_name
+        frame = frame.f_back
+    return "unknown"
 
 def manual_retry():
     """手动触发重试的便捷函数"""
@@ -40,9 +255,13 @@ def manual_retry():
     
 def check_retry_status():
     """检查当前重试状态"""
-    if retry_controller.current_function:
-        print(f"当前正在执行: {retry_controller.current_function}")
-        print(f"当前重试次数: {retry_controller.current_attempt}")
+    with retry_controller._lock:
+        states = list(retry_controller.active)
+    if circuit_breaker.is_open:
+        print(f"熔断中，{max(0.0, circuit_breaker.open_until - time.monotonic()):.0f} 秒后探测服务")
+    if states:
+        for state in states:
+            print(f"当前正在执行: {state.function_name}，当前重试次数: {state.attempt}")
     else:
         print("当前没有正在执行的API调用")
 
@@ -50,85 +269,80 @@ class ManualRetryException(Exception):
     """手动重试异常"""
     pass
 
+def _is_retryable_error(e: Exception) -> bool:
+    """连接相关的错误才重试；OpenAI库的异常按错误信息判断"""
+    if isinstance(e, (ConnectionError, Timeout, RequestException)):
+        return True
+    return "Connection" in str(e) or "timeout" in str(e).lower() or "failed" in str(e).lower()
+
+def _is_overload_error(e: Exception) -> bool:
+    """说明服务过载的错误：连接类错误，或HTTP 429/5xx"""
+    status_code = getattr(e, "status_code", None)
+    return _is_retryable_error(e) or status_code == 429 or (isinstance(status_code, int) and status_code >= 500)
+
+def _handle_retryable_error(state: RetryState, probe: bool, e: Exception) -> float:
+    """记录一次连接失败，返回本次调用自己需要退避的秒数（熔断中为0，由熔断器统一等待）；次数用尽时抛出
+
+    共享别人请求的失败时只重试，不再计入熔断器和重试统计，避免一次失败被记N次。
+    """
+    shared = _request_shared.get()
+    if shared:
+        circuit_breaker.abandon(probe)
+    # 还有健康的副本时失败的副本已被路由移出，不熔断
+    elif probe or not endpoint_pool.has_healthy():
+        circuit_breaker.record_failure(probe)
+    if state.attempt == state.max_retries:
+        print(f"API调用失败，已达到最大重试次数 {state.max_retries}")
+        raise e
+    if not shared:
+        llm_metrics.record_retry(*_call_labels.get(), e)
+    delay = 0 if circuit_breaker.is_open else state.retry_delay()
+    print(f"API调用失败 (尝试 {state.attempt + 1}/{state.max_retries + 1}): {str(e)}")
+    if delay:
+        print(f"等待 {delay} 秒后重试... (您可以调用 manual_retry() 立即重试)")
+    state.attempt += 1
+    return delay
+
 def retry_api_call(max_retries=5, base_delay=2, max_delay=60):
     """
     重试装饰器，用于自动重试API调用，支持手动触发重试
     
+    每次调用有自己的重试计数；连接失败同时计入全局熔断器，服务不可用时所有调用一起暂停，只由一个探测请求检查恢复。
+    
     Args:
         max_retries: 最大重试次数
         base_delay: 基础延迟时间（秒）
         max_delay: 最大延迟时间（秒）
     """
     def decorator(func):
+        @functools.wraps(func)
         def wrapper(*args, **kwargs):
-            retry_controller.reset()
-            retry_controller.current_function = func.__name__
-            
-            for attempt in range(max_retries + 1):
-                retry_controller.current_attempt = attempt
-                
-                try:
-                    # 检查是否有手动重试信号
-                    if retry_controller.force_retry:
-                        retry_controller.reset()
-                        print("检测到手动重试信号，重新开始API调用...")
-                        raise ManualRetryException("手动触发重试")
-                    
-                    result = func(*args, **kwargs)
-                    retry_controller.reset()
-                    return result
-                    
-                except ManualRetryException:
-                    # 手动重试，重置计数器
-                    attempt = -1  # 下次循环会变成0
-                    continue
-                    
-                except (ConnectionError, Timeout, RequestException) as e:
-                    if attempt == max_retries:
-                        print(f"API调用失败，已达到最大重试次数 {max_retries}")
-                        retry_controller.reset()
-                        raise e
-                    
-                    delay = min(base_delay * (2 ** attempt), max_delay)
-                    print(f"API调用失败 (尝试 {attempt + 1}/{max_retries + 1}): {str(e)}")
-                    print(f"等待 {delay} 秒后重试... (您可以调用 manual_retry() 立即重试)")
-                    
-                    # 可中断的等待，支持手动重试
-                    start_time = time.time()
-                    while time.time() - start_time < delay:
-                        if retry_controller.force_retry:
-                            print("检测到手动重试信号，立即重试...")
-                            retry_controller.reset()
-                            break
-                        time.sleep(0.1)  # 短暂睡眠，避免CPU占用过高
-                    
-                except Exception as e:
-                    # 对于OpenAI库的异常，也进行重试
-                    if "Connection" in str(e) or "timeout" in str(e).lower() or "failed" in str(e).lower():
-                        if attempt == max_retries:
-                            print(f"API调用失败，已达到最大重试次数 {max_retries}")
-                            retry_controller.reset()
-                            raise e
-                        
-                        delay = min(base_delay * (2 ** attempt), max_delay)
-                        print(f"API调用失败 (尝试 {attempt + 1}/{max_retries + 1}): {str(e)}")
-                        print(f"等待 {delay} 秒后重试... (您可以调用 manual_retry() 立即重试)")
-                        
+            labels = _call_labels.set((func.__name__, _caller_name(sys._getframe(1))))
+            state = retry_controller.start(func.__name__, max_retries, base_delay, max_delay)
+            try:
+                while True:
+                    probe = circuit_breaker.before_call(state.deadline)
+                    _request_shared.set(False)
+                    try:
+                        result = func(*args, **kwargs)
+                    except Exception as e:
+                        if not _is_retryable_error(e):
+                            # 其他异常直接抛出
+                            circuit_breaker.record_success()
+                            raise
+                        delay = _handle_retryable_error(state, probe, e)
                         # 可中断的等待，支持手动重试
-                        start_time = time.time()
-                        while time.time() - start_time < delay:
-                            if retry_controller.force_retry:
-                                print("检测到手动重试信号，立即重试...")
-                                retry_controller.reset()
-                                break
-                            time.sleep(0.1)
-                    else:
-                        # 其他异常直接抛出
-                        retry_controller.reset()
-                        raise e
-            
-            retry_controller.reset()
-            return None
+                        if delay and state.sleep(delay):
+                            print("检测到手动重试信号，立即重试...")
+                        continue
+                    except BaseException:
+                        circuit_breaker.abandon(probe)
+                        raise
+                    circuit_breaker.record_success()
+                    return result
+            finally:
+                retry_controller.finish(state)
+                _call_labels.reset(labels)
         return wrapper
     return decorator
 
@@ -160,10 +374,52 @@ def bounding_box_iou(box1, box2):
         return intersection / union if union > 0 else 0
     return 0
 
-openai = OpenAI(
-    base_url="http://localhost:2336/v1", 
-    api_key="NONONO",
-)
+LLM_BASE_URL = "http://localhost:2336/v1"
+LLM_API_KEY = "NONONO"
+LLM_MODEL = "qwen2.5-vl-72b"
+
+# 推理服务副本池：环境变量 LLM_ENDPOINTS 可以配置多个逗号分隔的地址，请求发给在途请求最少的健康副本
+endpoint_pool = EndpointPool(endpoint_urls(LLM_BASE_URL), LLM_API_KEY)
+# 第一个副本的客户端，保留给直接使用 utils.openai 的代码
+openai = endpoint_pool.endpoints[0].client
+
+# 相同请求（模型、消息、解码参数）的回答缓存在磁盘上，重跑时不再请求模型；设置环境变量 LLM_CACHE=0 关闭
+response_cache = ResponseCache() if os.getenv("LLM_CACHE", "1") != "0" else None
+
+# 同时进行的相同请求（同一个缓存键）只向服务发送一次，其余调用共享结果；stats()中shared即省下的请求数
+llm_single_flight = SingleFlight()
+
+def _cached_completion(request: dict, **options) -> str:
+    """发送请求并返回回答文本，命中response_cache时直接返回缓存；options（如timeout）不参与缓存键"""
+    key = cache_key(request)
+    if response_cache is not None:
+        cached = response_cache.get(key)
+        if cached is not None:
+            llm_metrics.record_cache_hit(*_call_labels.get())
+            return cached
+
+    executed = False
+
+    def complete():
+        nonlocal executed
+        executed = True
+        with endpoint_pool.route(_is_retryable_error) as endpoint:
+            with llm_metrics.measure(*_call_labels.get(), endpoint.base_url) as measurement:
+                chat_response = endpoint.client.chat.completions.create(**request, **options)
+                measurement.usage = chat_response.usage
+        content = chat_response.choices[0].message.content
+        if response_cache is not None and content is not None:
+            response_cache.put(key, content)
+        return content
+
+    try:
+        content = llm_single_flight.do(key, complete)
+    except Exception:
+        _request_shared.set(not executed)
+        raise
+    if not executed:
+        llm_metrics.record_shared(*_call_labels.get())
+    return content
 
 def scale_down_image(image, max_size=1920):
     h, w = image.shape[:2]
@@ -183,68 +439,198 @@ def scale_down_image(image, max_size=1920):
     
     return image
 
+# 边长不超过1920、没有EXIF旋转且不超过这个大小的JPEG文件原样发送，不重新编码
+MAX_ORIGINAL_JPEG_BYTES = 4 * 1024 * 1024
+IMAGE_PAYLOAD_CACHE_BYTES = int(os.getenv("IMAGE_PAYLOAD_CACHE_BYTES", str(512 * 1024 ** 2)))
+
+class ImagePayloadCache:
+    """编码好的图片data URL的LRU缓存，总字节数不超过max_bytes"""
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            value = self._entries.get(key)
+            if value is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._entries.move_to_end(key)
+            return value
+
+    def put(self, key, value: str):
+        with self._lock:
+            if key in self._entries:
+                self.bytes -= len(self._entries.pop(key))
+            if len(value) > self.max_bytes:
+                return
+            self._entries[key] = value
+            self.bytes += len(value)
+            while self.bytes > self.max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self.bytes -= len(evicted)
+
+image_payload_cache = ImagePayloadCache(IMAGE_PAYLOAD_CACHE_BYTES)
+
+def _exif_orientation(tiff: bytes) -> int:
+    """EXIF（TIFF格式）第一个IFD中的方向标记，没有时为1"""
+    if len(tiff) < 8:
+        return 1
+    order = "little" if tiff[:2] == b"II" else "big"
+    ifd = int.from_bytes(tiff[4:8], order)
+    if ifd + 2 > len(tiff):
+        return 1
+    for i in range(int.from_bytes(tiff[ifd:ifd + 2], order)):
+        entry = ifd + 2 + 12 * i
+        if entry + 12 > len(tiff):
+            break
+        if int.from_bytes(tiff[entry:entry + 2], order) == 0x0112:
+            return int.from_bytes(tiff[entry + 8:entry + 10], order)
+    return 1
+
+def _jpeg_info(data: bytes):
+    """从JPEG文件头读出 (宽, 高, EXIF方向)，不需要解码；不是JPEG或文件头无法解析时返回None"""
+    if data[:2] != b"\xff\xd8":
+        return None
+    orientation = 1
+    pos = 2
+    while pos + 4 <= len(data):
+        if data[pos] != 0xFF:
+            return None
+        marker = data[pos + 1]
+        if marker == 0xFF:
+            pos += 1
+            continue
+        if marker == 0x01 or 0xD0 <= marker <= 0xD8:
+            pos += 2
+            continue
+        length = int.from_bytes(data[pos + 2:pos + 4], "big")
+        segment = data[pos + 4:pos + 2 + length]
+        if marker == 0xE1 and segment[:6] == b"Exif\x00\x00":
+            orientation = _exif_orientation(segment[6:])
+        elif 0xC0 <= marker <= 0xCF and marker not in (0xC4, 0xC8, 0xCC):
+            # SOF段：精度(1) 高(2) 宽(2)
+            if len(segment) < 5:
+                return None
+            return int.from_bytes(segment[3:5], "big"), int.from_bytes(segment[1:3], "big"), orientation
+        elif marker == 0xDA:
+            return None
+        pos += 2 + length
+    return None
+
+def _encode_image_file(path: str, max_size: int) -> bytes:
+    """图片文件发送用的JPEG字节：符合要求的JPEG原样返回，大图用OpenCV降分辨率解码后再缩小到max_size以内"""
+    with open(path, "rb") as f:
+        data = f.read()
+    flag = cv.IMREAD_COLOR
+    info = _jpeg_info(data)
+    if info is not None:
+        width, height, orientation = info
+        if orientation == 1 and max(width, height) <= max_size and len(data) <= MAX_ORIGINAL_JPEG_BYTES:
+            return data
+        # 解码时直接按1/2、1/4、1/8缩小，解码结果不小于max_size，再用INTER_AREA缩到最终大小
+        for factor, reduced_flag in ((8, cv.IMREAD_REDUCED_COLOR_8), (4, cv.IMREAD_REDUCED_COLOR_4), (2, cv.IMREAD_REDUCED_COLOR_2)):
+            if max(width, height) // factor >= max_size:
+                flag = reduced_flag
+                break
+    image = cv.imdecode(np.frombuffer(data, dtype=np.uint8), flag)
+    if image is None:
+        raise ValueError(f"Cannot decode image {path}")
+    return cv.imencode('.jpg', scale_down_image(image, max_size))[1].tobytes()
+
+def image_data_url(image: Union[np.ndarray, str], max_size: int = 1920) -> str:
+    """图片的base64 data URL（JPEG，边长不超过max_size），按文件路径和修改时间、或数组内容缓存在image_payload_cache中"""
+    if isinstance(image, (str, os.PathLike)):
+        stat = os.stat(image)
+        key = ("path", os.path.realpath(image), stat.st_mtime_ns, stat.st_size, max_size)
+    else:
+        digest = hashlib.blake2b(np.ascontiguousarray(image).data).hexdigest()
+        key = ("array", image.shape, image.dtype.str, digest, max_size)
+    url = image_payload_cache.get(key)
+    if url is None:
+        if key[0] == "path":
+            byte_array = _encode_image_file(image, max_size)
+        else:
+            # Resize image to 1920x1920 if it's larger
+            byte_array = cv.imencode('.jpg', scale_down_image(image, max_size))[1].tobytes()
+        url = "data:image/jpeg;base64," + base64.b64encode(byte_array).decode('utf-8')
+        image_payload_cache.put(key, url)
+    return url
+
+def _image_message(image: Union[np.ndarray, str]) -> dict:
+    """把图片（数组或文件路径）包装成base64的image_url消息"""
+    return {
+        "type": "image_url",
+        "image_url": {
+            "url": image_data_url(image),
+        }
+    }
+
+def _image_question_messages(image_message: dict, question: str) -> list:
+    return [
+        {"role": "system", "content": "You are a helpful assistant that can answer questions about images."},
+        {"role": "user", "content": [
+            image_message,
+            {"type": "text", "text": question}
+        ]}
+    ]
+
+def _extract_json_text(json_text: str) -> str:
+    """去掉回答中```代码块标记之外的内容，只保留json文本"""
+    # 如果有一行以```开头，则默认不在json文本内，否则默认在json文本内
+    in_json = not any(line.startswith("```") for line in json_text.splitlines())
+    json_lines = []
+    for lines in json_text.splitlines():
+        if in_json and not lines.startswith("```"):
+            json_lines.append(lines)
+        if lines.startswith("```"):
+            in_json = not in_json
+    return "\n".join(json_lines)
+
+def _raise_connection_error(e: Exception):
+    """连接相关的错误统一转换成ConnectionError以触发重试，其他错误原样抛出"""
+    if any(keyword in str(e).lower() for keyword in ['connection', 'timeout', 'network', 'socket']):
+        print(f"⚠️ 连接相关错误，将触发重试: {e}")
+        raise ConnectionError(f"连接错误: {e}")
+    raise e
+
 @retry_api_call(max_retries=7, base_delay=2, max_delay=600)
-def ask_about_image(image: np.ndarray, question: str, json_format: bool = False) -> str:
+def ask_about_image(image: Union[np.ndarray, str], question: str, json_format: bool = False) -> str:
     """
     Ask a question about an image using a vision-language model.
     
     Args:
-        image: Input image as numpy array
+        image: Input image as numpy array, or path to an image file (JPEGs within 1920px are sent without re-encoding)
         question: Question to ask about the image
         json_format: Whether to request JSON formatted response
         
     Returns:
         Model response as string
     """
-    # Resize image to 1920x1920 if it's larger
-    image = scale_down_image(image)
-
-    # Encode image to base64
-    byte_array = cv.imencode('.jpg', image)[1].tobytes()
-    image_message = {
-        "type": "image_url",
-        "image_url": {
-            "url": "data:image/jpeg;base64," + base64.b64encode(byte_array).decode('utf-8'),
-        }
-    }
+    image_message = _image_message(image)
     
     # Query the model
     try:
-        chat_response = openai.chat.completions.create(
-            model="qwen2.5-vl-72b",
-            messages=[
-                {"role": "system", "content": "You are a helpful assistant that can answer questions about images."},
-                {"role": "user", "content": [
-                    image_message,
-                    {"type": "text", "text": question}
-                ]}
-            ],
-            # response_format={"type": "json_object" if json_format else "text"},
+        content = _cached_completion(
+            dict(
+                model=LLM_MODEL,
+                messages=_image_question_messages(image_message, question),
+                # response_format={"type": "json_object" if json_format else "text"},
+            ),
             timeout=1000  # 设置超时时间为1000秒
         )
         if not json_format:
-            return chat_response.choices[0].message.content
+            return content
         else:
-            json_text = chat_response.choices[0].message.content
-
-            # 如果有一行以```开头，则默认不在json文本内，否则默认在json文本内
-            in_json = not any(line.startswith("```") for line in json_text.splitlines())
-            json_lines = []
-            for lines in json_text.splitlines():
-                if in_json and not lines.startswith("```"):
-                    json_lines.append(lines)
-                if lines.startswith("```"):
-                    in_json = not in_json
-            json_text = "\n".join(json_lines)
-            return json_text
+            return _extract_json_text(content)
     except Exception as e:
-        # 确保连接错误被正确处理和重试
-        if any(keyword in str(e).lower() for keyword in ['connection', 'timeout', 'network', 'socket']):
-            print(f"⚠️ 连接相关错误，将触发重试: {e}")
-            raise ConnectionError(f"连接错误: {e}")
-        else:
-            # 非连接错误直接抛出
-            raise
+        # 确保连接错误被正确处理和重试，非连接错误直接抛出
+        _raise_connection_error(e)
 
 
 @retry_api_call(max_retries=7, base_delay=2, max_delay=600)
@@ -259,16 +645,234 @@ def ask_question(question: str, json_format: bool = False) -> str:
     Returns:
         Model response as string
     """
-    chat_response = openai.chat.completions.create(
-        model="qwen2.5-vl-72b",
-        messages=[
-            {"role": "user", "content": [
-                {"type": "text", "text": question}
-            ]}
-        ],
+    return _cached_completion(dict(
+        model=LLM_MODEL,
+        messages=_question_messages(question),
         response_format={"type": "json_object" if json_format else "text"}
-    )
-    return chat_response.choices[0].message.content
+    ))
+
+def _question_messages(question: str) -> list:
+    return [
+        {"role": "user", "content": [
+            {"type": "text", "text": question}
+        ]}
+    ]
+
+# ================== 异步调用与自适应并发 ==================
+
+class AdaptiveConcurrencyLimiter:
+    """AIMD自适应并发上限，用 async with limiter: 包住一次请求
+
+    - 加性增：每个成功且延迟正常的请求让上限增加 1/上限，即每一轮（上限个请求）增加1
+    - 乘性减：连接错误、429/5xx，或短期平均延迟超过长期平均延迟的latency_tolerance倍时上限减半，
+      两次减半之间至少间隔一个长期平均延迟，避免同一批在途请求连续触发
+    - 其他错误（4xx、解析错误等）和任务取消只归还名额，不调整上限
+    """
+
+    def __init__(self, initial_limit=16, min_limit=1, max_limit=512, latency_tolerance=2.0):
+        self.limit = float(initial_limit)
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.latency_tolerance = latency_tolerance
+        self.in_flight = 0
+        self.short_latency = None
+        self.long_latency = None
+        self._last_decrease = 0.0
+        self._condition = None
+        self._loop = None
+        self._start_times = {}
+
+    def _get_condition(self):
+        # asyncio.Condition绑定事件循环，每个事件循环单独创建
+        loop = asyncio.get_running_loop()
+        if self._loop is not loop:
+            self._loop = loop
+            self._condition = asyncio.Condition()
+            self.in_flight = 0
+        return self._condition
+
+    async def __aenter__(self):
+        condition = self._get_condition()
+        async with condition:
+            await condition.wait_for(lambda: self.in_flight < int(self.limit))
+            self.in_flight += 1
+        self._start_times[asyncio.current_task()] = time.monotonic()
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        latency = time.monotonic() - self._start_times.pop(asyncio.current_task())
+        condition = self._get_condition()
+        async with condition:
+            self.in_flight -= 1
+            if exc_type is None:
+                self._adjust(latency, False)
+            elif isinstance(exc, Exception) and _is_overload_error(exc):
+                self._adjust(latency, True)
+            condition.notify_all()
+        return False
+
+    def _adjust(self, latency, overload_error):
+        now = time.monotonic()
+        if not overload_error:
+            self.short_latency = latency if self.short_latency is None else 0.7 * self.short_latency + 0.3 * latency
+            self.long_latency = latency if self.long_latency is None else 0.95 * self.long_latency + 0.05 * latency
+        overloaded = overload_error or self.short_latency > self.long_latency * self.latency_tolerance
+        if overloaded:
+            if now - self._last_decrease >= (self.long_latency or 1.0):
+                self.limit = max(self.min_limit, self.limit / 2)
+                self._last_decrease = now
+        else:
+            self.limit = min(self.max_limit, self.limit + 1 / self.limit)
+
+# 全局并发控制器，所有异步API调用共享
+llm_limiter = AdaptiveConcurrencyLimiter()
+
+def async_retry_api_call(max_retries=5, base_delay=2, max_delay=60):
+    """retry_api_call的异步版本，共享重试控制器和熔断器，等待期间不占用线程"""
+    def decorator(func):
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            labels = _call_labels.set((func.__name__, _caller_name(sys._getframe(1))))
+            state = retry_controller.start(func.__name__, max_retries, base_delay, max_delay)
+            try:
+                while True:
+                    probe = await circuit_breaker.before_call_async(state.deadline)
+                    _request_shared.set(False)
+                    try:
+                        result = await func(*args, **kwargs)
+                    except Exception as e:
+                        if not _is_retryable_error(e):
+                            circuit_breaker.record_success()
+                            raise
+                        delay = _handle_retryable_error(state, probe, e)
+                        if delay and await state.sleep_async(delay):
+                            print("检测到手动重试信号，立即重试...")
+                        continue
+                    except BaseException:
+                        circuit_breaker.abandon(probe)
+                        raise
+                    circuit_breaker.record_success()
+                    return result
+            finally:
+                retry_controller.finish(state)
+                _call_labels.reset(labels)
+        return wrapper
+    return decorator
+
+async def _cached_completion_async(request: dict, **options) -> str:
+    """_cached_completion的异步版本，只有真正发出的请求占用llm_limiter的并发名额
+
+    缓存的SQLite读写（可能等锁、淘汰时扫描全表）放到线程中进行，不阻塞事件循环。
+    """
+    key = cache_key(request)
+    if response_cache is not None:
+        cached = await asyncio.to_thread(response_cache.get, key)
+        if cached is not None:
+            llm_metrics.record_cache_hit(*_call_labels.get())
+            return cached
+
+    executed = False
+
+    async def complete():
+        nonlocal executed
+        executed = True
+        async with llm_limiter:
+            with endpoint_pool.route(_is_retryable_error) as endpoint:
+                with llm_metrics.measure(*_call_labels.get(), endpoint.base_url) as measurement:
+                    chat_response = await endpoint.async_client().chat.completions.create(**request, **options)
+                    measurement.usage = chat_response.usage
+        content = chat_response.choices[0].message.content
+        if response_cache is not None and content is not None:
+            await asyncio.to_thread(response_cache.put, key, content)
+        return content
+
+    try:
+        content = await llm_single_flight.do_async(key, complete)
+    except Exception:
+        _request_shared.set(not executed)
+        raise
+    if not executed:
+        llm_metrics.record_shared(*_call_labels.get())
+    return content
+
+@async_retry_api_call(max_retries=7, base_delay=2, max_delay=600)
+async def ask_question_async(question: str, json_format: bool = False) -> str:
+    """ask_question的异步版本，并发度由llm_limiter自适应控制"""
+    return await _cached_completion_async(dict(
+        model=LLM_MODEL,
+        messages=_question_messages(question),
+        response_format={"type": "json_object" if json_format else "text"}
+    ))
+
+@async_retry_api_call(max_retries=7, base_delay=2, max_delay=600)
+async def ask_about_image_async(image: Union[np.ndarray, str], question: str, json_format: bool = False) -> str:
+    """ask_about_image的异步版本，图片编码在线程中进行，并发度由llm_limiter自适应控制"""
+    image_message = await asyncio.to_thread(_image_message, image)
+    try:
+        content = await _cached_completion_async(
+            dict(model=LLM_MODEL, messages=_image_question_messages(image_message, question)),
+            timeout=1000
+        )
+    except Exception as e:
+        _raise_connection_error(e)
+    if not json_format:
+        return content
+    return _extract_json_text(content)
+
+async def llm_map_async(func, items, on_result=None, return_exceptions=False) -> list:
+    """并发地对items逐个调用异步函数func，按输入顺序返回结果
+
+    只启动固定数量的worker依次取任务，实际在途请求数由llm_limiter决定，不会为每个item都创建协程。
+
+    Args:
+        func: 接受一个item的异步函数，如 lambda q: ask_question_async(q)
+        items: 输入列表
+        on_result: 每完成一个item时调用 on_result(下标, item, 结果)，可用于打印进度或中途保存
+        return_exceptions: 为True时把异常作为结果返回，否则第一个异常会取消其余请求并抛出
+    """
+    items = list(items)
+    results = [None] * len(items)
+    next_index = 0
+
+    async def worker():
+        nonlocal next_index
+        while next_index < len(items):
+            index = next_index
+            next_index += 1
+            try:
+                results[index] = await func(items[index])
+            except Exception as e:
+                if not return_exceptions:
+                    raise
+                results[index] = e
+            if on_result is not None:
+                on_result(index, items[index], results[index])
+
+    workers = [asyncio.create_task(worker()) for _ in range(min(len(items), llm_limiter.max_limit))]
+    try:
+        await asyncio.gather(*workers)
+    finally:
+        for task in workers:
+            task.cancel()
+    return results
+
+def llm_map(func, items, on_result=None, return_exceptions=False) -> list:
+    """llm_map_async的同步入口，供生成器等同步代码使用；在已有事件循环中（如Jupyter）调用时改在新线程中运行"""
+    async def run():
+        try:
+            return await llm_map_async(func, items, on_result=on_result, return_exceptions=return_exceptions)
+        finally:
+            # 事件循环是这里新建的，结束前关闭它的客户端，释放连接池
+            await endpoint_pool.aclose_async_clients()
+
+    coroutine = run()
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        return asyncio.run(coroutine)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=1) as executor:
+        # 线程不继承contextvars，复制当前上下文以保留llm_call_label
+        return executor.submit(contextvars.copy_context().run, asyncio.run, coroutine).result()
 
 # 手动重试使用示例：
 """
@@ -283,6 +887,7 @@ def ask_question(question: str, json_format: bool = False) -> str:
 
 3. 在程序运行过程中，如果遇到连接问题：
    - 程序会自动重试
+   - 连续多次连接失败时所有调用一起暂停，只由一个探测请求检查服务是否恢复
    - 在等待期间，你可以调用 manual_retry() 立即重试
    - 即使没有错误，你也可以手动触发重连
 